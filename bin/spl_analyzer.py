@@ -0,0 +1,178 @@
+import bin.spl_ast as ast
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_lib as lib
+
+# errors of resolving a type that the program would raise when running the node, the node is then left unresolved
+UNRESOLVED_ERRORS = lib.CompileTimeException, en.EnvironmentException, KeyError, StopIteration, AttributeError
+
+
+class Analyzer:
+    """
+    Static type inference of the functions of an initialized program.
+
+    Every expression node of a function body is annotated with the Type it evaluates to, and every call of an
+    overloaded function with the args type hash of the called overload. The interpreter reads these annotations
+    instead of resolving the types each time the node runs.
+
+    The types are resolved by the same rules as get_tal_of_evaluated_node, in scopes built like the interpreter builds
+    them. A name cannot shadow a name of an outer scope, so a name in a function body always refers to the same
+    variable. Nodes whose type depends on the run, such as variables of arrays whose length is computed, are left to
+    be resolved while running.
+    """
+
+    def __init__(self, global_env: en.GlobalEnvironment):
+        """
+        :param global_env: the global environment of the initialized program, which is not modified
+        """
+        self.global_env = global_env
+
+    def analyze(self):
+        for func_group in self.global_env.functions.values():
+            for func in func_group.values():
+                if isinstance(func, itp.Function):
+                    self.analyze_function(func)
+
+    def analyze_function(self, func: itp.Function):
+        scope = en.FunctionEnvironment(func.outer_scope)
+        for param in func.params:
+            scope.define_var(param.name, param.tal, 0)
+        self.walk(func.body, scope)
+
+    def walk(self, node: ast.Node, scope: en.Environment):
+        """ Annotates the statement <node>, and defines the variables it declares in <scope>. """
+        if node is None:
+            return
+        node_type = node.node_type
+        if node_type == ast.BLOCK_STMT:
+            for line in node.lines:
+                self.walk(line, scope)
+        elif node_type == ast.ASSIGNMENT_NODE:
+            self.walk_assignment(node, scope)
+        elif node_type == ast.IF_STMT:
+            self.infer(node.condition, scope)
+            # only one branch runs in the scope of the if statement, so each branch is walked in a scope of its own
+            self.walk(node.then_block, en.BlockEnvironment(scope))
+            self.walk(node.else_block, en.BlockEnvironment(scope))
+        elif node_type == ast.FOR_LOOP_STMT:
+            title_scope = en.LoopEnvironment(scope)
+            start, stop, step = node.condition.lines
+            self.walk(start, title_scope)
+            self.infer(stop, title_scope)
+            self.walk(step, title_scope)
+            self.walk(node.body, en.BlockEnvironment(title_scope))
+        elif node_type == ast.WHILE_STMT:
+            title_scope = en.LoopEnvironment(scope)
+            self.infer(node.condition, title_scope)
+            self.walk(node.body, en.BlockEnvironment(title_scope))
+        elif node_type == ast.RETURN_STMT:
+            if node.value is not None:
+                self.infer(node.value, scope)
+        else:
+            self.infer(node, scope)
+
+    def walk_assignment(self, node: ast.AssignmentNode, scope: en.Environment):
+        left = node.left
+        if node.level == ast.FUNC_DEFINE:
+            # a nested function is defined while running, so the calls of its name are left unresolved
+            scope.functions[left.name] = {}
+        elif left.node_type == ast.TYPE_NODE:
+            r_tal = self.infer(node.right, scope)
+            tal = self.defining_type(left.right, scope)
+            if tal is not None and tal.total_len(scope.memory) == 0:  # array with undefined length
+                tal = r_tal
+            try:
+                scope.define_var(left.left.name, tal, 0)
+            except en.EnvironmentException:
+                pass
+        else:
+            self.infer(left, scope)
+            self.infer(node.right, scope)
+
+    def infer(self, node: ast.Node, scope: en.Environment):
+        """ Annotates the expression <node> and its operands, and returns its Type, or None if it is unresolved. """
+        node_type = node.node_type
+        if node_type == ast.NAME_NODE:
+            try:
+                if scope.get_type_arr_len(node.name, (node.line_num, node.file)) is None:
+                    return None  # the variable is an array whose length is computed
+            except en.EnvironmentException:
+                return None
+        elif node_type == ast.UNARY_OPERATOR or node_type == ast.IN_DECREMENT_OPERATOR:
+            if self.infer(node.value, scope) is None:
+                return None
+        elif node_type == ast.BINARY_OPERATOR:
+            self.infer(node.right, scope)
+            if self.infer(node.left, scope) is None:  # the type of a binary operation is the type of its left
+                return None
+        elif node_type == ast.DOT:
+            if self.infer(node.left, scope) is None:
+                return None
+        elif node_type == ast.INDEXING_NODE:
+            for line in node.arg.lines:
+                self.infer(line, scope)
+            if self.infer(node.call_obj, scope) is None:
+                return None
+        elif node_type == ast.FUNCTION_CALL:
+            return self.infer_call(node, scope)
+        elif node_type == ast.BLOCK_STMT:  # a condition, evaluated to its last line
+            tal = None
+            for line in node.lines:
+                tal = self.infer(line, scope)
+            return tal
+        elif node_type not in (ast.LITERAL, ast.STRING_LITERAL, ast.NULL_STMT):
+            return None
+        return self.resolve(node, scope)
+
+    def infer_call(self, node: ast.FuncCall, scope: en.Environment):
+        arg_types = [self.infer(arg, scope) for arg in node.args.lines]
+        if node.call_obj.node_type != ast.NAME_NODE:
+            return None
+        try:
+            func_group = scope.get_function(node.call_obj.name, (node.line_num, node.file))
+        except en.EnvironmentException:
+            return None
+        if not func_group:
+            return None
+        if not isinstance(next(iter(func_group.values())), itp.NativeFunction):
+            if None in arg_types:
+                return None
+            types_id = en.args_type_hash(arg_types)
+            if types_id not in func_group:
+                return None
+            node.overload = types_id
+        return self.resolve(node, scope)
+
+    def resolve(self, node: ast.Node, scope: en.Environment):
+        try:
+            tal = itp.get_tal_of_evaluated_node(node, scope)
+        except UNRESOLVED_ERRORS:
+            tal = None
+        if tal is not None:
+            node.tal = tal
+        return tal
+
+    def defining_type(self, node: ast.Node, scope: en.Environment):
+        """
+        Returns the Type declared by <node> like get_tal_of_defining_node, or None if an array length is not a
+        literal.
+        """
+        if node.node_type == ast.NAME_NODE:
+            return en.Type(node.name)
+        elif node.node_type == ast.INDEXING_NODE:
+            inner = self.defining_type(node.call_obj, scope)
+            if inner is None:
+                return None
+            if len(node.arg.lines) == 0:
+                return en.Type(inner.type_name, 0)
+            if len(node.arg.lines) != 1 or node.arg.lines[0].node_type != ast.LITERAL or \
+                    node.arg.lines[0].lit_type != 0:
+                return None
+            length = scope.memory.get_int(itp.evaluate(node.arg.lines[0], scope))
+            return en.Type(inner.type_name, *inner.array_lengths, length)
+        elif node.node_type == ast.UNARY_OPERATOR and node.operation == "unpack":
+            inner = self.defining_type(node.value, scope)
+            if inner is None:
+                return None
+            return en.Type("*" + inner.type_name, *inner.array_lengths)
+        return None
@@ -78,6 +78,7 @@ class Node:
     line_num = 0
     file = None
     node_type = 0
+    tal = None  # the type of the evaluated node, if resolved by the analyzer
 
     def __init__(self, line: tuple):
         self.line_num = line[0]
@@ -505,6 +506,7 @@ class StructNode(Node):
 class FuncCall(Node):
     call_obj = None
     args: BlockStmt = None
+    overload = None  # the args type hash of the called function, if resolved by the analyzer
 
     def __init__(self, line, call_obj):
         Node.__init__(self, line)
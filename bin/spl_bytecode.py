@@ -0,0 +1,636 @@
+import operator
+import bin.spl_analyzer as ana
+import bin.spl_ast as ast
+import bin.spl_closures as clo
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_lib as lib
+import bin.spl_memory as mem
+
+# opcodes, the argument of each instruction is described after its name
+CONST = 0  # value: pushes the value
+LOAD_INT = 1  # offset: pushes the int of the frame at offset
+LOAD = 2  # (offset, getter): pushes the value of the frame at offset
+STORE_INT = 3  # offset: pops an int to the frame at offset
+STORE = 4  # (offset, setter): pops a value to the frame at offset
+ADDR = 5  # offset: pushes the address of the frame at offset
+LOADI = 6  # getter: replaces the address on top by the value at it
+STOREI = 7  # setter: pops an address, and pops the value written at it
+COPY = 8  # length: pops a destination address and a source address, and copies the bytes
+POP = 9  # None: discards the top
+ADD = 10  # None: pops two ints and pushes their sum, same for SUB and MUL
+SUB = 11
+MUL = 12
+BINOP = 13  # function: pops two values and pushes the function of them
+NEG = 14  # None: negates the int on top
+LT = 15  # None: pops two values and pushes whether the first is less than the second, same for LE ... NE
+LE = 16
+GT = 17
+GE = 18
+EQ = 19
+NE = 20
+CMP = 21  # function: pops two values and pushes the function of their difference
+INPLACE_LOCAL = 22  # (offset, getter, setter, function): pops a value and operates the frame at offset with it
+INPLACE = 23  # (getter, setter, function): pops a value and an address, and operates the value at the address with it
+OFFSET = 24  # offset: adds the offset to the address on top
+INDEX = 25  # unit length: pops an index, and moves the address on top by index units
+CHECK = 26  # length: checks the access to the bytes at the address on top
+JUMP = 27  # target
+JUMP_IF_FALSE = 28  # target: pops a boolean and jumps if it is false
+CALL = 29  # (Function, argument count, address flags, frame offset of the returned struct or None)
+CALL_NATIVE = 30  # (function, argument allocators, (getter, length, frame offset) of the returned value)
+CALL_NATIVE_NODES = 31  # (function, argument nodes, visible variables, (getter, length, frame offset))
+RETURN = 32  # None: returns the value on top
+RETURN_COPY = 33  # length: copies the bytes at the address on top to the returned location, and returns it
+RETURN_VOID = 34  # None
+MISSING_RETURN = 35  # None: raises the error of a function that ends without returning
+CLEAR = 36  # (offset, length): zeros the bytes of the frame at offset
+
+OP_NAMES = {
+    CONST: "CONST", LOAD_INT: "LOAD_INT", LOAD: "LOAD", STORE_INT: "STORE_INT", STORE: "STORE", ADDR: "ADDR",
+    LOADI: "LOADI", STOREI: "STOREI", COPY: "COPY", POP: "POP", ADD: "ADD", SUB: "SUB", MUL: "MUL", BINOP: "BINOP",
+    NEG: "NEG", LT: "LT", LE: "LE", GT: "GT", GE: "GE", EQ: "EQ", NE: "NE", CMP: "CMP",
+    INPLACE_LOCAL: "INPLACE_LOCAL", INPLACE: "INPLACE", OFFSET: "OFFSET", INDEX: "INDEX", CHECK: "CHECK",
+    JUMP: "JUMP", JUMP_IF_FALSE: "JUMP_IF_FALSE", CALL: "CALL", CALL_NATIVE: "CALL_NATIVE",
+    CALL_NATIVE_NODES: "CALL_NATIVE_NODES", RETURN: "RETURN", RETURN_COPY: "RETURN_COPY",
+    RETURN_VOID: "RETURN_VOID", MISSING_RETURN: "MISSING_RETURN", CLEAR: "CLEAR"
+}
+
+# kinds of the result of a compiled expression, besides the name of the class of a pushed value
+ADDRESS = "address"  # the address of the bytes of the value is pushed
+VOID = "void"  # nothing is pushed
+
+# accessors of the value classes, a pointer is an int
+GETTERS = clo.GETTERS
+SETTERS = {"int": "set_int", "float": "set_float", "char": "set_char", "boolean": "set_bool"}
+
+INT_OPS = {operator.add: ADD, operator.sub: SUB, operator.mul: MUL}
+
+COMPARE_OPS = {"<": LT, "<=": LE, ">": GT, ">=": GE, "==": EQ, "!=": NE}
+
+
+class NotCompilable(Exception):
+    """ Raised when a function uses something that its bytecode would not run exactly like the tree walker. """
+
+
+class Code:
+    """ The bytecode of a function. """
+
+    def __init__(self, func: itp.Function):
+        self.func = func
+        self.instructions = []  # (opcode, argument)
+        self.frame_size = 0
+        self.params = []  # (offset, length, setter or None for a struct or an array) of each parameter
+        self.variables = []  # (offset, Type) of every variable, where the collector finds pointers
+
+    def __str__(self):
+        lines = []
+        for i, (op, arg) in enumerate(self.instructions):
+            lines.append("{:>5} {:<18}{}".format(i, OP_NAMES[op], "" if arg is None else arg))
+        return "\n".join(lines)
+
+
+class Scope:
+    """ The variables declared in a block of a function while compiling, with their frame offsets. """
+
+    def __init__(self, outer):
+        self.outer: Scope = outer
+        self.slots = {}  # name: (offset, Type)
+
+    def lookup(self, name: str):
+        scope = self
+        while scope is not None:
+            if name in scope.slots:
+                return scope.slots[name]
+            scope = scope.outer
+        return None
+
+    def visible(self) -> list:
+        """ Returns the (name, Type, offset) of all variables visible in this scope. """
+        result = []
+        scope = self
+        while scope is not None:
+            for name, (offset, tal) in scope.slots.items():
+                result.append((name, tal, offset))
+            scope = scope.outer
+        return result
+
+
+class Compiler:
+    """
+    Compiles analyzed functions to bytecode, see spl_vm.VirtualMachine.
+
+    Every variable of a function has a fixed offset in the frame of the function, which is allocated on the stack
+    of the memory when the function is called. Primitive values and pointers are computed on the operand stack of
+    the machine, other values, such as structs and arrays, by their addresses.
+
+    A function is compiled only if its bytecode runs exactly like the tree walker, so the types of all its
+    expressions and the overloads of all its calls must be resolved by the analyzer, and every value must be read
+    as the type it is written. Other functions are run by the tree walker.
+    """
+
+    def __init__(self, global_env: en.GlobalEnvironment):
+        self.global_env = global_env
+        self.memory = global_env.memory
+        self.analyzer = ana.Analyzer(global_env)
+        memory = self.memory
+        self.getters = {cls: getattr(memory, name) for cls, name in GETTERS.items()}
+        self.setters = {cls: getattr(memory, name) for cls, name in SETTERS.items()}
+        self.allocators = value_allocators(memory)
+        # accesses to computed pointers are only checked by an unchecked memory, see Memory.check_access
+        self.checks = type(memory).check_access is not mem.Memory.check_access
+        # the tree walker releases the variables of a loop body after each round, so that the collector does not
+        # find them on the stack, with a collector the machine clears them after the loop
+        self.collecting = memory.collector is not None
+        self.code = None
+
+    def compile_function(self, func: itp.Function):
+        """ Returns the Code of <func>, or None if it must be run by the tree walker. """
+        self.code = Code(func)
+        try:
+            self._compile_function(func)
+        except (NotCompilable,) + ana.UNRESOLVED_ERRORS:
+            return None
+        finally:
+            code = self.code
+            self.code = None
+        return code
+
+    def _compile_function(self, func: itp.Function):
+        code = self.code
+        scope = Scope(None)
+        for param in func.params:
+            offset = self.declare(param.name, param.tal, scope)
+            cls = value_class(param.tal)
+            code.params.append((offset, param.tal.total_len(self.memory),
+                                None if cls is None else self.setters[cls]))
+        rtn_len = func.r_tal.total_len(self.memory)
+        if rtn_len > 0 and not ends_with_return(func.body):
+            raise NotCompilable()  # the function returns the value of its last statement
+        self.statement(func.body, scope)
+        self.emit(RETURN_VOID if rtn_len == 0 else MISSING_RETURN)
+
+    def emit(self, op: int, arg=None) -> int:
+        self.code.instructions.append((op, arg))
+        return len(self.code.instructions) - 1
+
+    def patch(self, index: int):
+        """ Sets the target of the jump at <index> to the next instruction. """
+        self.code.instructions[index] = self.code.instructions[index][0], len(self.code.instructions)
+
+    def reserve(self, length: int) -> int:
+        offset = self.code.frame_size
+        self.code.frame_size += length
+        return offset
+
+    def clear_from(self, offset: int):
+        """ Clears the frame from <offset> to its end with a collector, see self.collecting. """
+        if self.collecting and offset < self.code.frame_size:
+            self.emit(CLEAR, (offset, self.code.frame_size - offset))
+
+    def declare(self, name: str, tal: en.Type, scope: Scope) -> int:
+        if scope.lookup(name) is not None or self.global_env.contains_ptr(name):
+            raise NotCompilable()  # defining the name raises an error
+        offset = self.reserve(tal.total_len(self.memory))
+        scope.slots[name] = offset, tal
+        self.code.variables.append((offset, tal))
+        return offset
+
+    def statement(self, node: ast.Node, scope: Scope):
+        node_type = node.node_type
+        if node_type == ast.BLOCK_STMT:
+            for line in node.lines:
+                self.statement(line, scope)
+        elif node_type == ast.ASSIGNMENT_NODE:
+            self.assignment(node, scope)
+        elif node_type == ast.IF_STMT:
+            self.condition(node.condition, scope)
+            to_else = self.emit(JUMP_IF_FALSE)
+            self.statement(node.then_block, Scope(scope))
+            if node.else_block is None:
+                self.patch(to_else)
+            else:
+                to_end = self.emit(JUMP)
+                self.patch(to_else)
+                self.statement(node.else_block, Scope(scope))
+                self.patch(to_end)
+        elif node_type == ast.FOR_LOOP_STMT:
+            title_scope = Scope(scope)
+            start, stop, step = node.condition.lines
+            step_first = step.node_type == ast.IN_DECREMENT_OPERATOR and not step.is_post
+            self.statement(start, title_scope)
+            loop = len(self.code.instructions)
+            self.condition(stop, title_scope)
+            to_end = self.emit(JUMP_IF_FALSE)
+            if step_first:
+                self.statement(step, title_scope)
+            body_start = self.code.frame_size
+            self.statement(node.body, Scope(title_scope))
+            if not step_first:
+                self.statement(step, title_scope)
+            self.emit(JUMP, loop)
+            self.patch(to_end)
+            self.clear_from(body_start)
+        elif node_type == ast.WHILE_STMT:
+            title_scope = Scope(scope)
+            loop = len(self.code.instructions)
+            self.condition(node.condition, title_scope)
+            to_end = self.emit(JUMP_IF_FALSE)
+            body_start = self.code.frame_size
+            self.statement(node.body, Scope(title_scope))
+            self.emit(JUMP, loop)
+            self.patch(to_end)
+            self.clear_from(body_start)
+        elif node_type == ast.RETURN_STMT:
+            self.return_statement(node, scope)
+        elif node_type == ast.BINARY_OPERATOR and node.assignment:
+            self.arithmetic_assignment(node, scope)
+        else:
+            if self.expression(node, scope) != VOID:
+                self.emit(POP)
+
+    def return_statement(self, node: ast.ReturnStmt, scope: Scope):
+        if node.value is None:
+            raise NotCompilable()
+        r_tal = self.code.func.r_tal
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            if self.expression(node.value, scope) != VOID:
+                self.emit(POP)
+            self.emit(RETURN_VOID)
+            return
+        cls = value_class(r_tal)
+        self.operand(node.value, scope, cls)
+        if cls is None:
+            self.emit(RETURN_COPY, rtn_len)
+        else:
+            self.emit(RETURN)
+
+    def condition(self, node: ast.Node, scope: Scope):
+        self.operand(node, scope, "boolean")
+
+    def assignment(self, node: ast.AssignmentNode, scope: Scope):
+        left = node.left
+        left_type = left.node_type
+        if node.level == ast.FUNC_DEFINE:
+            raise NotCompilable()
+        if left_type == ast.TYPE_NODE:
+            self.declaration(node, scope)
+        elif left_type == ast.NAME_NODE:
+            slot = scope.lookup(left.name)
+            if slot is None:
+                if left.name not in self.global_env.variables:
+                    raise NotCompilable()
+                tal = self.global_env.var_types[left.name]
+                self.store(node.right, scope, tal, lambda: self.emit(CONST, self.global_env.variables[left.name]))
+            else:
+                self.store_local(node.right, scope, *slot)
+        elif left_type == ast.DOT:
+            struct = self.global_env.get_struct(left.left.tal.type_name)
+            attr_tal = struct.get_attr_tal(left.right.name)
+            self.store(node.right, scope, attr_tal, lambda: self.address(left, scope))
+        elif left_type == ast.INDEXING_NODE:
+            unit_length = self.indexing_unit(left)
+            if unit_length != left.tal.total_len(self.memory):
+                raise NotCompilable()  # the element is copied as another type
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope))
+        elif left_type == ast.UNARY_OPERATOR and left.operation == "unpack":
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope))
+        else:
+            raise NotCompilable()
+
+    def declaration(self, node: ast.AssignmentNode, scope: Scope):
+        if node.level != ast.VAR and node.level != ast.CONST:
+            raise NotCompilable()
+        type_node: ast.TypeNode = node.left
+        tal = self.analyzer.defining_type(type_node.right, self.global_env)
+        if tal is not None and tal.total_len(self.memory) == 0:  # array with undefined length
+            tal = node.right.tal
+        if tal is None:
+            raise NotCompilable()
+        if node.right.node_type == ast.UNDEFINED_NODE:
+            self.declare(type_node.left.name, tal, scope)
+            return
+        cls = value_class(tal)
+        self.operand(node.right, scope, cls)
+        offset = self.declare(type_node.left.name, tal, scope)
+        self.emit_store_local(offset, tal, cls)
+
+    def store_local(self, right: ast.Node, scope: Scope, offset: int, tal: en.Type):
+        cls = value_class(tal)
+        self.operand(right, scope, cls)
+        self.emit_store_local(offset, tal, cls)
+
+    def emit_store_local(self, offset: int, tal: en.Type, cls):
+        if cls is None:
+            self.emit(ADDR, offset)
+            self.emit(COPY, tal.total_len(self.memory))
+        elif cls == "int":
+            self.emit(STORE_INT, offset)
+        else:
+            self.emit(STORE, (offset, self.setters[cls]))
+
+    def store(self, right: ast.Node, scope: Scope, tal: en.Type, emit_address):
+        """ Compiles writing <right> as <tal>, the address written is pushed by <emit_address> after <right>. """
+        cls = value_class(tal)
+        self.operand(right, scope, cls)
+        emit_address()
+        if cls is None:
+            self.emit(COPY, tal.total_len(self.memory))
+        else:
+            self.emit(STOREI, self.setters[cls])
+
+    def arithmetic_assignment(self, node: ast.BinaryOperator, scope: Scope):
+        op_set = itp.BINARY_OP_TABLE.get(node.operation[:-1])
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if op_set is None or l_tal is None or r_tal is None:
+            raise NotCompilable()
+        func = clo.arithmetic_function(op_set, l_tal, r_tal)
+        if func is None:
+            raise NotCompilable()
+        l_name = clo.arithmetic_name(l_tal)
+        getter = self.getters[l_name]
+        setter = self.setters["float" if l_name == "float" else "int"]
+        slot = scope.lookup(node.left.name) if node.left.node_type == ast.NAME_NODE else None
+        if slot is not None:
+            self.operand(node.right, scope, clo.arithmetic_name(r_tal))
+            self.emit(INPLACE_LOCAL, (slot[0], getter, setter, func))
+        else:
+            self.address(node.left, scope)
+            self.operand(node.right, scope, clo.arithmetic_name(r_tal))
+            self.emit(INPLACE, (getter, setter, func))
+
+    def operand(self, node: ast.Node, scope: Scope, cls):
+        """ Compiles pushing the value of <node> as a value of class <cls>, or its address if <cls> is None. """
+        if cls is None:
+            self.address(node, scope)
+            return
+        kind = self.expression(node, scope)
+        if kind == ADDRESS:
+            self.emit(LOADI, self.getters[cls])
+        elif kind != cls:
+            raise NotCompilable()  # the tree walker reads the bytes of the value as another type
+
+    def address(self, node: ast.Node, scope: Scope):
+        """ Compiles pushing the address of the value of <node>, like evaluating it in the tree walker. """
+        if node.node_type == ast.NAME_NODE:
+            slot = scope.lookup(node.name)
+            if slot is not None:
+                self.emit(ADDR, slot[0])
+            elif node.name in self.global_env.variables:
+                self.emit(CONST, self.global_env.variables[node.name])
+            else:
+                raise NotCompilable()
+        elif self.expression(node, scope) != ADDRESS:
+            raise NotCompilable()
+
+    def expression(self, node: ast.Node, scope: Scope) -> str:
+        """ Compiles pushing the result of <node>, and returns its kind. """
+        node_type = node.node_type
+        if node_type == ast.LITERAL:
+            return self.literal(node)
+        elif node_type == ast.STRING_LITERAL:
+            self.emit(CONST, self.memory.get_literal_ptr(node.literal.lit_pos))
+            return ADDRESS
+        elif node_type == ast.NULL_STMT:
+            self.emit(CONST, 0)
+            return "int"
+        elif node_type == ast.NAME_NODE:
+            return self.name(node, scope)
+        elif node_type == ast.BINARY_OPERATOR:
+            return self.binary_operation(node, scope)
+        elif node_type == ast.UNARY_OPERATOR:
+            return self.unary_operation(node, scope)
+        elif node_type == ast.DOT:
+            struct = self.global_env.get_struct(node.left.tal.type_name)
+            self.address(node.left, scope)
+            self.emit(OFFSET, struct.get_attr_pos(node.right.name))
+            return ADDRESS
+        elif node_type == ast.INDEXING_NODE:
+            self.indexing(node, scope)
+            return ADDRESS
+        elif node_type == ast.FUNCTION_CALL:
+            return self.call(node, scope)
+        elif node_type == ast.BLOCK_STMT and len(node.lines) == 1:  # a condition or an index
+            return self.expression(node.lines[0], scope)
+        raise NotCompilable()
+
+    def literal(self, node: ast.Literal) -> str:
+        memory = self.memory
+        ptr = memory.get_literal_ptr(node.lit_pos)
+        if node.lit_type == 0:
+            self.emit(CONST, memory.get_int(ptr))
+            return "int"
+        elif node.lit_type == 1:
+            self.emit(CONST, memory.get_float(ptr))
+            return "float"
+        elif node.lit_type == 2:
+            self.emit(CONST, memory.get_bool(ptr))
+            return "boolean"
+        elif node.lit_type == 4:
+            self.emit(CONST, memory.get_char(ptr))
+            return "char"
+        self.emit(CONST, ptr)
+        return ADDRESS
+
+    def name(self, node: ast.NameNode, scope: Scope) -> str:
+        slot = scope.lookup(node.name)
+        if slot is None:
+            if node.name not in self.global_env.variables:
+                raise NotCompilable()
+            self.emit(CONST, self.global_env.variables[node.name])
+            cls = value_class(self.global_env.var_types[node.name])
+            if cls is None:
+                return ADDRESS
+            self.emit(LOADI, self.getters[cls])
+            return cls
+        offset, tal = slot
+        cls = value_class(tal)
+        if cls is None:
+            self.emit(ADDR, offset)
+            return ADDRESS
+        if cls == "int":
+            self.emit(LOAD_INT, offset)
+        else:
+            self.emit(LOAD, (offset, self.getters[cls]))
+        return cls
+
+    def binary_operation(self, node: ast.BinaryOperator, scope: Scope) -> str:
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if node.assignment or l_tal is None or r_tal is None:
+            raise NotCompilable()
+        if node.operation in itp.BINARY_OP_TABLE:
+            func = clo.arithmetic_function(itp.BINARY_OP_TABLE[node.operation], l_tal, r_tal)
+            if func is None:
+                raise NotCompilable()
+            l_name = clo.arithmetic_name(l_tal)
+            r_name = clo.arithmetic_name(r_tal)
+            self.operand(node.left, scope, l_name)
+            self.operand(node.right, scope, r_name)
+            if l_name == "int" and r_name == "int" and func in INT_OPS:
+                self.emit(INT_OPS[func])
+            else:
+                self.emit(BINOP, func)
+            return "float" if l_name == "float" else "int"
+        elif node.operation in itp.COMPARE_TABLE:
+            if l_tal.type_name in itp.PRIMITIVE_TYPES and r_tal.type_name in itp.PRIMITIVE_TYPES and \
+                    not en.is_array(l_tal) and not en.is_array(r_tal):
+                l_name = l_tal.type_name
+                r_name = r_tal.type_name
+            elif l_tal.type_name[0] == "*" and r_tal.type_name[0] == "*":
+                l_name = r_name = "int"
+            else:
+                raise NotCompilable()
+            self.operand(node.left, scope, l_name)
+            self.operand(node.right, scope, r_name)
+            if l_name != "float" and r_name != "float":
+                self.emit(COMPARE_OPS[node.operation])
+            else:
+                self.emit(CMP, itp.COMPARE_TABLE[node.operation])
+            return "boolean"
+        raise NotCompilable()
+
+    def unary_operation(self, node: ast.UnaryOperator, scope: Scope) -> str:
+        tal = node.value.tal
+        if tal is None:
+            raise NotCompilable()
+        if node.operation == "unpack":
+            if tal.type_name[0] != "*":
+                raise NotCompilable()
+            self.operand(node.value, scope, "int")
+            if self.checks:
+                self.emit(CHECK, self.memory.get_type_size(tal.type_name[1:]))
+            return ADDRESS
+        elif node.operation == "pack":
+            self.address(node.value, scope)
+            return "int"
+        elif node.operation == "neg" and tal.type_name == "int":
+            self.operand(node.value, scope, "int")
+            self.emit(NEG)
+            return "int"
+        raise NotCompilable()
+
+    def indexing_unit(self, node: ast.IndexingNode) -> int:
+        """ Returns the unit length of indexing <node>, which the tree walker takes from the indexed name. """
+        base = node
+        depth = 0
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+            depth += 1
+        l_tal = base.tal
+        if base.node_type != ast.NAME_NODE or l_tal is None:
+            raise NotCompilable()
+        if en.is_array(l_tal):
+            unit_length = l_tal.total_len(self.memory)
+            for i in range(depth):
+                unit_length //= l_tal.array_lengths[i]
+            return unit_length
+        elif l_tal.type_name[0] == "*":
+            return self.memory.get_type_size(l_tal.type_name[1:])
+        raise NotCompilable()
+
+    def indexing(self, node: ast.IndexingNode, scope: Scope):
+        unit_length = self.indexing_unit(node)
+        base = node
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+        self.address(node.call_obj, scope)
+        if not en.is_array(base.tal):
+            self.emit(LOADI, self.getters["int"])
+        self.operand(node.arg, scope, "int")
+        self.emit(INDEX, unit_length)
+        if self.checks:
+            self.emit(CHECK, unit_length)
+
+    def call(self, node: ast.FuncCall, scope: Scope) -> str:
+        name_node = node.call_obj
+        if name_node.node_type != ast.NAME_NODE or scope.lookup(name_node.name) is not None or \
+                self.global_env.contains_ptr(name_node.name):
+            raise NotCompilable()
+        func_group = self.global_env.functions.get(name_node.name)
+        if not func_group:
+            raise NotCompilable()
+        some_func = next(iter(func_group.values()))
+        if isinstance(some_func, itp.NativeFunction):
+            return self.native_call(some_func, node, scope)
+        if node.overload is None:
+            raise NotCompilable()
+        func: itp.Function = func_group[node.overload]
+        flags = []
+        for param, arg in zip(func.params, node.args.lines):
+            cls = value_class(param.tal)
+            kind = ADDRESS if cls is None else self.expression(arg, scope)
+            if cls is None:
+                self.address(arg, scope)
+            elif kind != ADDRESS and kind != cls:
+                raise NotCompilable()
+            flags.append(kind == ADDRESS)
+        kind, slot = self.returned(func.r_tal)
+        self.emit(CALL, (func, len(flags), tuple(flags), slot))
+        return kind
+
+    def native_call(self, func: itp.NativeFunction, node: ast.FuncCall, scope: Scope) -> str:
+        kind, slot = self.returned(func.r_tal)
+        rtn = (self.getters[kind] if kind not in (ADDRESS, VOID) else None, func.r_tal.total_len(self.memory), slot)
+        if func.eval_before:
+            allocators = []
+            for arg in node.args.lines:
+                arg_kind = self.expression(arg, scope)
+                if arg_kind == VOID:
+                    raise NotCompilable()
+                allocators.append(None if arg_kind == ADDRESS else self.allocators[arg_kind])
+            self.emit(CALL_NATIVE, (func.func, tuple(allocators), rtn))
+        else:
+            self.emit(CALL_NATIVE_NODES, (func.func, tuple(node.args.lines), tuple(scope.visible()), rtn))
+        return kind
+
+    def returned(self, r_tal: en.Type):
+        """ Returns the kind of the value returned as <r_tal>, and the frame offset where a struct is returned. """
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            return VOID, None
+        cls = value_class(r_tal)
+        if cls is None:
+            return ADDRESS, self.reserve(rtn_len)
+        return cls, None
+
+
+def value_class(tal: en.Type):
+    """ Returns the class of the values of <tal> on the operand stack, or None if they are used by address. """
+    if en.is_array(tal):
+        return None
+    if tal.type_name[0] == "*":
+        return "int"
+    if tal.type_name in GETTERS:
+        return tal.type_name
+    return None
+
+
+def value_allocators(memory: mem.Memory) -> dict:
+    """ Returns the functions that push a value of each class to the stack of <memory> and return its pointer. """
+    return {
+        "int": memory.allocate_int,
+        "float": memory.allocate_float,
+        "char": lambda v: memory.allocate(bytes((v,))),
+        "boolean": lambda v: memory.allocate(bytes((1 if v else 0,)))
+    }
+
+
+def ends_with_return(node: ast.Node) -> bool:
+    """ Returns whether every way through the statement <node> ends with a 'return' statement. """
+    if node is None:
+        return False
+    if node.node_type == ast.RETURN_STMT:
+        return True
+    if node.node_type == ast.BLOCK_STMT:
+        return len(node.lines) > 0 and ends_with_return(node.lines[-1])
+    if node.node_type == ast.IF_STMT:
+        return ends_with_return(node.then_block) and ends_with_return(node.else_block)
+    return False
+
+
+def missing_return(func: itp.Function) -> lib.TypeException:
+    return lib.TypeException("Missing return statement of a function declared to return type '{}'"
+                             .format(en.type_to_readable(func.r_tal)))
@@ -0,0 +1,614 @@
+import bin.spl_analyzer as ana
+import bin.spl_ast as ast
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_lib as lib
+
+# getters of the primitive values, by the type name that arithmetic_value operates them as
+GETTERS = {
+    "int": "get_int",
+    "float": "get_float",
+    "char": "get_char",
+    "boolean": "get_bool"
+}
+
+
+class ClosureEngine:
+    """
+    Runs a program by compiling its functions into nested closures, instead of walking the tree by 'evaluate'.
+
+    A node is compiled into a function of the environment, which returns the same pointer as evaluating the node.
+    The closures are specialized by the types resolved by the analyzer, so running them neither looks up NODE_TABLE
+    nor resolves types. Nodes which are not specialized, or whose types are not resolved, are compiled into a call
+    of 'evaluate', so that every program runs as in the tree walker.
+
+    A function body is compiled when the function is first called. The accessors of the memory are bound at compile
+    time, so the memory must not be switched between checked, unchecked and tracing while the engine runs.
+
+    The scope of every variable is resolved at compile time. A variable declared before it is used in the function
+    is read from the environment that many scopes out, and a global variable from the global environment, without
+    looking up the chain of environments. A name cannot shadow a name of an outer scope, so the scope declaring it
+    is the only one that contains it.
+    """
+
+    name = "closure"
+
+    def __init__(self, interpreter: itp.Interpreter):
+        self.interpreter = interpreter
+        self.memory = interpreter.memory
+        self.global_env = interpreter.global_env
+        self.analyzer = ana.Analyzer(interpreter.global_env)
+        self.bodies = {}  # Function: [compiled body], filled when the function is first called
+        self.scopes = None  # the names declared in each scope of the compiled function so far, innermost last
+
+    def run_main(self) -> int:
+        """ Calls the function 'main' of an initialized program and returns its exit value. """
+        if "main" in self.global_env.functions:
+            main_func = self.global_env.get_function("main", itp.LINE_FILE)[""]
+            r_ptr = self.compile_function_call(main_func, [])(self.global_env)
+            return self.memory.get_int(r_ptr)
+        return 0
+
+    def compile(self, node: ast.Node):
+        """ Returns the closure of <node>, which takes the environment and returns the evaluated pointer. """
+        compiler = COMPILE_TABLE.get(node.node_type)
+        if compiler is not None:
+            try:
+                closure = compiler(self, node)
+            except ana.UNRESOLVED_ERRORS:  # the error is raised when the node runs, if it runs
+                closure = None
+            if closure is not None:
+                self.declared(node)
+                return closure
+        closure = self.compile_fallback(node)
+        self.declared(node)
+        return closure
+
+    def compile_in_scope(self, node: ast.Node, scope: set = None):
+        """ Returns the closure of <node>, which runs in a new environment declaring the names of <scope> first. """
+        self.scopes.append(set() if scope is None else scope)
+        try:
+            return self.compile(node)
+        finally:
+            self.scopes.pop()
+
+    def compile_body(self, func: itp.Function):
+        scopes = self.scopes
+        self.scopes = []
+        try:
+            return self.compile_in_scope(func.body, {param.name for param in func.params})
+        finally:
+            self.scopes = scopes
+
+    def declared(self, node: ast.Node):
+        """ Adds the name declared by the compiled <node> to the innermost scope. """
+        if node.node_type == ast.ASSIGNMENT_NODE and node.left.node_type == ast.TYPE_NODE and \
+                (node.level == ast.VAR or node.level == ast.CONST) and self.scopes:
+            self.scopes[-1].add(node.left.left.name)
+
+    def compile_variable(self, name: str, lf):
+        """ Returns the closure of the pointer of the variable <name>, looked up in the scope resolved for it. """
+        depth = None
+        for i, scope in enumerate(reversed(self.scopes or ())):
+            if name in scope:
+                depth = i
+                break
+        if depth == 0:
+            return lambda env: env.variables[name]
+        elif depth == 1:
+            return lambda env: env.outer.variables[name]
+        elif depth is not None:
+            def variable(env):
+                for _ in range(depth):
+                    env = env.outer
+                return env.variables[name]
+
+            return variable
+        elif name in self.global_env.variables:
+            global_variables = self.global_env.variables
+            return lambda env: global_variables[name]
+        return lambda env: env.get(name, lf)  # a variable of an enclosing function
+
+    def compile_fallback(self, node: ast.Node):
+        evaluate = itp.evaluate
+
+        def fallback(env):
+            return evaluate(node, env)
+
+        return fallback
+
+    def compile_block(self, node: ast.BlockStmt):
+        lines = [(self.compile(line), may_return(line)) for line in node.lines]
+        if not any(returns for _, returns in lines[:-1]):
+            closures = [closure for closure, _ in lines]
+            if len(closures) == 1:
+                return closures[0]
+
+            def block(env):
+                result = None
+                for closure in closures:
+                    result = closure(env)
+                return result
+
+            return block
+
+        def block_with_return(env):
+            result = None
+            for closure, returns in lines:
+                result = closure(env)
+                if returns and env.is_terminated():
+                    return env.returned_ptr()
+            return result
+
+        return block_with_return
+
+    def compile_literal(self, node: ast.Literal):
+        ptr = self.memory.get_literal_ptr(node.lit_pos)
+        return lambda env: ptr
+
+    def compile_string_literal(self, node: ast.StringLiteralNode):
+        return self.compile(node.literal)
+
+    def compile_name(self, node: ast.NameNode):
+        if node.tal is None:  # a function, or a variable of an array of computed length
+            return None
+        return self.compile_variable(node.name, (node.line_num, node.file))
+
+    def compile_binary_operation(self, node: ast.BinaryOperator):
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if l_tal is None or r_tal is None:
+            return None
+        left = self.compile(node.left)
+        right = self.compile(node.right)
+        memory = self.memory
+        if node.assignment and node.operation[:-1] in itp.BINARY_OP_TABLE:
+            return self.compile_arithmetic_assignment(itp.BINARY_OP_TABLE[node.operation[:-1]], left, l_tal,
+                                                      right, r_tal)
+        elif node.operation in itp.BINARY_OP_TABLE:
+            op = arithmetic_function(itp.BINARY_OP_TABLE[node.operation], l_tal, r_tal)
+            if op is None:
+                return None
+            l_name = arithmetic_name(l_tal)
+            l_get = getattr(memory, GETTERS[l_name])
+            r_get = getattr(memory, GETTERS[arithmetic_name(r_tal)])
+            allocate = memory.allocate_float if l_name == "float" else memory.allocate_int
+
+            def arithmetic(env):
+                lv = l_get(left(env))
+                return allocate(op(lv, r_get(right(env))))
+
+            return arithmetic
+        elif node.operation in itp.COMPARE_TABLE:
+            return self.compile_comparison(itp.COMPARE_TABLE[node.operation], left, l_tal, right, r_tal)
+        return None
+
+    def compile_arithmetic_assignment(self, op_set: dict, left, l_tal: en.Type, right, r_tal: en.Type):
+        op = arithmetic_function(op_set, l_tal, r_tal)
+        if op is None:
+            return None
+        memory = self.memory
+        l_name = arithmetic_name(l_tal)
+        l_get = getattr(memory, GETTERS[l_name])
+        r_get = getattr(memory, GETTERS[arithmetic_name(r_tal)])
+        l_set = memory.set_float if l_name == "float" else memory.set_int
+
+        def arithmetic_assignment(env):
+            lp = left(env)
+            rp = right(env)
+            l_set(lp, op(l_get(lp), r_get(rp)))
+            return lp
+
+        return arithmetic_assignment
+
+    def compile_comparison(self, cmp, left, l_tal: en.Type, right, r_tal: en.Type):
+        memory = self.memory
+        true_ptr = itp.get_bool_ptr(memory, True)
+        false_ptr = itp.get_bool_ptr(memory, False)
+        if l_tal.type_name in itp.PRIMITIVE_TYPES and r_tal.type_name in itp.PRIMITIVE_TYPES and \
+                not en.is_array(l_tal) and not en.is_array(r_tal):
+            l_get = getattr(memory, GETTERS[l_tal.type_name])
+            r_get = getattr(memory, GETTERS[r_tal.type_name])
+        elif l_tal.type_name[0] == "*" and r_tal.type_name[0] == "*":
+            l_get = r_get = memory.get_ptr
+        else:
+            return None
+
+        def comparison(env):
+            lv = l_get(left(env))
+            return true_ptr if cmp(lv - r_get(right(env))) else false_ptr
+
+        return comparison
+
+    def compile_unary_operation(self, node: ast.UnaryOperator):
+        tal = node.value.tal
+        if tal is None:
+            return None
+        value = self.compile(node.value)
+        memory = self.memory
+        if node.operation == "unpack":
+            if tal.type_name[0] != "*":
+                return None
+            get_ptr = memory.get_ptr
+            check_access = memory.check_access
+            size = memory.get_type_size(tal.type_name[1:])
+
+            def unpack(env):
+                v = get_ptr(value(env))
+                check_access(v, size)
+                return v
+
+            return unpack
+        elif node.operation == "pack":
+            allocate_int = memory.allocate_int
+            return lambda env: allocate_int(value(env))
+        elif node.operation == "neg" and tal.type_name == "int":
+            get_int = memory.get_int
+            allocate_int = memory.allocate_int
+            return lambda env: allocate_int(-get_int(value(env)))
+        return None
+
+    def compile_dot(self, node: ast.Dot):
+        l_tal = node.left.tal
+        if l_tal is None:
+            return None
+        left = self.compile(node.left)
+        pos = self.global_env.get_struct(l_tal.type_name).get_attr_pos(node.right.name)
+        return lambda env: left(env) + pos
+
+    def compile_indexing(self, node: ast.IndexingNode):
+        """ Returns the closure of the location of an element, and the length of the element. """
+        base = node
+        depth = 0
+        while base.node_type == ast.INDEXING_NODE:  # the type is taken from the indexed name, like the tree walker
+            base = base.call_obj
+            depth += 1
+        l_tal = base.tal
+        if base.node_type != ast.NAME_NODE or l_tal is None:
+            return None, 0
+        memory = self.memory
+        if en.is_array(l_tal):
+            unit_length = l_tal.total_len(memory)
+            for i in range(depth):
+                unit_length //= l_tal.array_lengths[i]
+            get_ptr = None
+        elif l_tal.type_name[0] == "*":
+            unit_length = memory.get_type_size(l_tal.type_name[1:])
+            get_ptr = memory.get_ptr
+        else:
+            return None, 0
+        call_obj = self.compile(node.call_obj)
+        arg = self.compile(node.arg)
+        get_int = memory.get_int
+        check_access = memory.check_access
+
+        def location(env):
+            l_ptr = call_obj(env)
+            if get_ptr is not None:
+                l_ptr = get_ptr(l_ptr)
+            ptr = l_ptr + get_int(arg(env)) * unit_length
+            check_access(ptr, unit_length)
+            return ptr
+
+        return location, unit_length
+
+    def compile_getitem(self, node: ast.IndexingNode):
+        return self.compile_indexing(node)[0]
+
+    def compile_assignment(self, node: ast.AssignmentNode):
+        left = node.left
+        left_type = left.node_type
+        if node.level == ast.FUNC_DEFINE:
+            return None
+        memory = self.memory
+        mem_copy = memory.mem_copy
+        right = self.compile(node.right)
+        if left_type == ast.NAME_NODE:
+            if left.tal is None:
+                return None
+            variable = self.compile_variable(left.name, (node.line_num, node.file))
+            total_len = left.tal.total_len(memory)
+
+            def assign_name(env):
+                r = right(env)
+                mem_copy(r, variable(env), total_len)
+
+            return assign_name
+        elif left_type == ast.TYPE_NODE:
+            return self.compile_declaration(node, right)
+        elif left_type == ast.DOT:
+            l_tal = left.left.tal
+            if l_tal is None:
+                return None
+            struct = self.global_env.get_struct(l_tal.type_name)
+            pos = struct.get_attr_pos(left.right.name)
+            attr_len = struct.get_attr_tal(left.right.name).total_len(memory)
+            dot_left = self.compile(left.left)
+
+            def assign_attr(env):
+                r = right(env)
+                mem_copy(r, dot_left(env) + pos, attr_len)
+
+            return assign_attr
+        elif left_type == ast.INDEXING_NODE:
+            location, unit_length = self.compile_indexing(left)
+            if location is None:
+                return None
+
+            def assign_item(env):
+                r = right(env)
+                mem_copy(r, location(env), unit_length)
+
+            return assign_item
+        elif left_type == ast.UNARY_OPERATOR and left.operation != "pack":
+            if left.tal is None:
+                return None
+            total_len = left.tal.total_len(memory)
+            target = self.compile(left)
+
+            def assign_pointed(env):
+                r = right(env)
+                mem_copy(r, target(env), total_len)
+
+            return assign_pointed
+        return None
+
+    def compile_declaration(self, node: ast.AssignmentNode, right):
+        if node.level != ast.VAR and node.level != ast.CONST:
+            return None
+        type_node: ast.TypeNode = node.left
+        tal = self.analyzer.defining_type(type_node.right, self.global_env)
+        memory = self.memory
+        if tal is not None and tal.total_len(memory) == 0:  # array with undefined length
+            tal = node.right.tal
+        if tal is None:
+            return None
+        name = type_node.left.name
+        total_len = tal.total_len(memory)
+        allocate_empty = memory.allocate_empty
+        mem_copy = memory.mem_copy
+        const = node.level == ast.CONST
+
+        def declare(env):
+            r = right(env)
+            ptr = allocate_empty(total_len)
+            if r != 0:  # is not undefined
+                mem_copy(r, ptr, total_len)
+            if const:
+                env.define_const(name, tal, ptr)
+            else:
+                env.define_var(name, tal, ptr)
+
+        return declare
+
+    def compile_call(self, node: ast.FuncCall):
+        if node.call_obj.node_type != ast.NAME_NODE:
+            return None
+        func_group = self.global_env.functions.get(node.call_obj.name)
+        if not func_group:
+            return None
+        func = next(iter(func_group.values()))
+        if isinstance(func, itp.NativeFunction):
+            return self.compile_native_call(func, node.args.lines)
+        if node.overload is None:
+            return None
+        args = [self.compile(arg) for arg in node.args.lines]
+        return self.compile_function_call(func_group[node.overload], args)
+
+    def compile_function_call(self, func: itp.Function, args: list):
+        """ Returns the closure of calling <func> with the closures of its <args>, like call_function. """
+        memory = self.memory
+        body_cell = self.bodies.get(func)
+        if body_cell is None:
+            body_cell = [None]
+            self.bodies[func] = body_cell
+        rtn_tal = func.r_tal
+        rtn_len = rtn_tal.total_len(memory)
+        params = [(param.name, param.tal, param.tal.total_len(memory), arg) for param, arg in zip(func.params, args)]
+        outer = func.outer_scope
+        allocate_empty = memory.allocate_empty
+        mem_copy = memory.mem_copy
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        call_envs = memory.call_envs
+
+        def call(env):
+            rtn_loc = allocate_empty(rtn_len)
+            scope = en.FunctionEnvironment(outer)
+            push_stack()
+            call_envs.append(env)
+
+            for name, tal, total_len, arg in params:
+                p = arg(env)
+                arg_ptr = allocate_empty(total_len)
+                scope.define_var(name, tal, arg_ptr)
+                mem_copy(p, arg_ptr, total_len)
+
+            body = body_cell[0]
+            if body is None:
+                body = self.compile_body(func)
+                body_cell[0] = body
+            r = body(scope)
+
+            if rtn_len > 0 and r is None:
+                raise lib.TypeException("Missing return statement of a function declared to return type '{}'"
+                                        .format(en.type_to_readable(rtn_tal)))
+            mem_copy(r, rtn_loc, rtn_len)
+
+            call_envs.pop()
+            restore_stack()
+            return rtn_loc
+
+        return call
+
+    def compile_native_call(self, func: itp.NativeFunction, orig_args: list):
+        memory = self.memory
+        rtn_len = func.r_tal.total_len(memory)
+        native = func.func
+        allocate_empty = memory.allocate_empty
+        mem_copy = memory.mem_copy
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        call_envs = memory.call_envs
+        args = [self.compile(arg) for arg in orig_args] if func.eval_before else None
+
+        def native_call(env):
+            rtn_loc = allocate_empty(rtn_len)
+            push_stack()
+            call_envs.append(env)
+            if args is None:
+                rtn_ptr = native(env, *orig_args)
+            else:
+                rtn_ptr = native(memory, *[arg(env) for arg in args])
+            call_envs.pop()
+            if rtn_len > 0:
+                mem_copy(rtn_ptr, rtn_loc, rtn_len)
+                restore_stack()
+                return rtn_loc
+            restore_stack()
+
+        return native_call
+
+    def compile_return(self, node: ast.ReturnStmt):
+        if node.value is None:
+            return None
+        value = self.compile(node.value)
+
+        def return_(env):
+            r = value(env)
+            env.terminate(r)
+            return r
+
+        return return_
+
+    def compile_if(self, node: ast.IfStmt):
+        condition = self.compile(node.condition)
+        then_block = self.compile_in_scope(node.then_block)
+        else_block = None if node.else_block is None else self.compile_in_scope(node.else_block)
+        get_bool = self.memory.get_bool
+        block_env = en.BlockEnvironment
+
+        def if_(env):
+            boolean = get_bool(condition(env))
+            scope = block_env(env)
+            if boolean:
+                return then_block(scope)
+            elif else_block is not None:
+                return else_block(scope)
+
+        return if_
+
+    def compile_for_loop(self, node: ast.ForLoopStmt):
+        self.scopes.append(set())  # the title scope
+        try:
+            start, stop, step = [self.compile(line) for line in node.condition.lines]
+            body = self.compile_in_scope(node.body)
+        finally:
+            self.scopes.pop()
+        step_first = node.condition.lines[2].node_type == ast.IN_DECREMENT_OPERATOR and \
+            not node.condition.lines[2].is_post
+        returns = may_return(node.body)
+        memory = self.memory
+        get_bool = memory.get_bool
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        keep_stack = memory.keep_stack
+
+        # 'break' and 'continue' are not executable, so only a return stops the loop early
+        def for_loop(env):
+            title_scope = en.LoopEnvironment(env)
+            block_scope = en.BlockEnvironment(title_scope)
+            start(title_scope)
+            while get_bool(stop(title_scope)):
+                push_stack()
+                block_scope.invalidate()
+                if step_first:
+                    step(title_scope)
+                body(block_scope)
+                if returns and env.is_terminated():  # keeps the returned value until the function returns
+                    keep_stack()
+                    break
+                if not step_first:
+                    step(title_scope)
+                restore_stack()
+
+        return for_loop
+
+    def compile_while_loop(self, node: ast.WhileStmt):
+        self.scopes.append(set())  # the title scope
+        try:
+            condition = self.compile(node.condition)
+            body = self.compile_in_scope(node.body)
+        finally:
+            self.scopes.pop()
+        returns = may_return(node.body)
+        memory = self.memory
+        get_bool = memory.get_bool
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        keep_stack = memory.keep_stack
+
+        def while_loop(env):
+            title_scope = en.LoopEnvironment(env)
+            block_scope = en.BlockEnvironment(title_scope)
+            while get_bool(condition(title_scope)):
+                push_stack()
+                block_scope.invalidate()
+                body(block_scope)
+                if returns and env.is_terminated():
+                    keep_stack()
+                    break
+                restore_stack()
+
+        return while_loop
+
+
+COMPILE_TABLE = {
+    ast.NAME_NODE: ClosureEngine.compile_name,
+    ast.ASSIGNMENT_NODE: ClosureEngine.compile_assignment,
+    ast.BLOCK_STMT: ClosureEngine.compile_block,
+    ast.FUNCTION_CALL: ClosureEngine.compile_call,
+    ast.BINARY_OPERATOR: ClosureEngine.compile_binary_operation,
+    ast.UNARY_OPERATOR: ClosureEngine.compile_unary_operation,
+    ast.LITERAL: ClosureEngine.compile_literal,
+    ast.STRING_LITERAL: ClosureEngine.compile_string_literal,
+    ast.UNDEFINED_NODE: lambda engine, node: lambda env: 0,
+    ast.DOT: ClosureEngine.compile_dot,
+    ast.INDEXING_NODE: ClosureEngine.compile_getitem,
+    ast.RETURN_STMT: ClosureEngine.compile_return,
+    ast.IF_STMT: ClosureEngine.compile_if,
+    ast.FOR_LOOP_STMT: ClosureEngine.compile_for_loop,
+    ast.WHILE_STMT: ClosureEngine.compile_while_loop,
+    ast.NULL_STMT: lambda engine, node: lambda env: 1
+}
+
+
+def may_return(node: ast.Node) -> bool:
+    """ Returns whether running the statement <node> may return from the function it is in. """
+    if node is None:
+        return False
+    node_type = node.node_type
+    if node_type == ast.RETURN_STMT:
+        return True
+    if node_type == ast.BLOCK_STMT:
+        return any(may_return(line) for line in node.lines)
+    if node_type == ast.IF_STMT:
+        return may_return(node.then_block) or may_return(node.else_block)
+    if node_type == ast.FOR_LOOP_STMT or node_type == ast.WHILE_STMT:
+        return may_return(node.body)
+    return False
+
+
+def arithmetic_name(tal: en.Type) -> str:
+    """ Returns the type name that arithmetic_value operates a value of <tal> as. """
+    return "int" if tal.type_name[0] == "*" else tal.type_name
+
+
+def arithmetic_function(op_set: dict, l_tal: en.Type, r_tal: en.Type):
+    """ Returns the function of the operation of <op_set> on the types, or None if arithmetic_value rejects them. """
+    l_name = arithmetic_name(l_tal)
+    r_name = arithmetic_name(r_tal)
+    if l_name not in GETTERS or r_name not in GETTERS:
+        return None
+    return op_set.get(l_name, {}).get(r_name)
+
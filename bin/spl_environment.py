@@ -24,18 +24,18 @@ class Type:
     def __str__(self):
         return "({}, {})".format(self.type_name, self.array_lengths)
 
-    def total_len(self):
+    def total_len(self, memory: mem.Memory):
         arr_len = 1
         for x in self.array_lengths:
             arr_len *= x
-        return mem.MEMORY.get_type_size(self.type_name) * arr_len
+        return memory.get_type_size(self.type_name) * arr_len
 
 
-def type_total_len(t: Type) -> int:
+def type_total_len(t: Type, memory: mem.Memory) -> int:
     arr_len = 1
     for x in t.array_lengths:
         arr_len *= x
-    return mem.MEMORY.get_type_size(t.type_name) * arr_len
+    return memory.get_type_size(t.type_name) * arr_len
 
 
 def type_to_readable(t: Type) -> str:
@@ -68,6 +68,7 @@ UNDEFINED = Undefined()
 class Environment:
     def __init__(self, outer):
         self.outer: Environment = outer
+        self.memory: mem.Memory = None if outer is None else outer.memory
         # self.var_count = 0
 
         self.variables: dict[str: int] = {}
@@ -93,7 +94,7 @@ class Environment:
         if self.contains_ptr(name):
             raise VariableException("Name '{}' already defined in this scope".format(name))
 
-        # self.variables[name] = Variable(type_name, mem.MEMORY.type_sizes[type_name], ptr, array_length)
+        # self.variables[name] = Variable(type_name, self.memory.type_sizes[type_name], ptr, array_length)
         self.variables[name] = ptr
         self.var_types[name] = type_
 
@@ -102,7 +103,7 @@ class Environment:
         if self.contains_ptr(name):
             raise VariableException("Name '{}' already defined in this scope".format(name))
 
-        # self.constants[name] = Variable(type_name, mem.MEMORY.type_sizes[type_name], ptr, array_length)
+        # self.constants[name] = Variable(type_name, self.memory.type_sizes[type_name], ptr, array_length)
         self.variables[name] = ptr
         self.var_types[name] = type_
 
@@ -213,9 +214,11 @@ class SubAbstractEnvironment(Environment):
 
 
 class GlobalEnvironment(MainAbstractEnvironment):
-    def __init__(self):
+    def __init__(self, memory: mem.Memory):
         MainAbstractEnvironment.__init__(self, None)
 
+        self.memory = memory
+
         self.structs = {}
 
     def is_global(self):
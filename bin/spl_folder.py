@@ -0,0 +1,260 @@
+import struct
+import bin.spl_ast as ast
+import bin.spl_interpreter as itp
+import bin.spl_memory as mem
+import bin.spl_parser as psr
+import bin.spl_types as typ
+
+# type names of the literal types which are operated as primitive values, strings are not folded
+LITERAL_TYPE_NAMES = {0: "int", 1: "float", 2: "boolean", 4: "char"}
+LITERAL_TYPES = {name: lit_type for lit_type, name in LITERAL_TYPE_NAMES.items()}
+
+# natives which take the names in their args instead of the values, so the args are not folded
+NAME_NATIVES = {"sizeof", "typeof"}
+
+
+class Folder:
+    """
+    Constant folding of a parsed program, before its literals are loaded.
+
+    Binary operations and negations of literals, reads of consts declared from literals and calls of 'sizeof' are
+    replaced by literal nodes, whose values are added to the literal bytes of the parser. The values are computed by
+    the operation tables of the interpreter, and an operation that would raise an error is left to raise it while
+    running.
+
+    The top level is folded in the order it runs, so its 'sizeof' calls only see the structs defined before them.
+    The function bodies are folded after it, since they run after the whole top level. A name cannot shadow a name
+    of an outer scope, so a const of an enclosing scope is the only variable its name refers to.
+    """
+
+    def __init__(self, parser: psr.Parser, memory: mem.Memory):
+        """
+        :param parser: the parser of the program, to which the folded literals are added
+        :param memory: the memory that will run the program, which gives the sizes of the primitive types
+        """
+        self.parser = parser
+        self.memory = memory
+        self.struct_sizes = {}  # struct name: size, or None if the size is computed while running
+        self.functions = []  # (function, scopes) of the functions defined by the top level
+
+    def fold(self, tree: ast.BlockStmt):
+        scopes = [{}]
+        for line in tree.lines:
+            if line.node_type == ast.ASSIGNMENT_NODE and line.level == ast.FUNC_DEFINE and \
+                    line.right.node_type == ast.DEF_STMT:
+                self.functions.append((line.right, scopes))
+            elif line.node_type == ast.STRUCT_NODE:
+                for field in line.block.lines:
+                    self.defining(field.left.right, scopes)
+                self.struct_sizes[line.name] = self.struct_size(line)
+            else:
+                self.statement_line(line, scopes)
+        for func, outer in self.functions:
+            self.function(func, outer)
+
+    def function(self, func: ast.DefStmt, scopes: list):
+        params = {}
+        for param in func.params.lines:
+            if param.node_type == ast.TYPE_NODE:
+                params[param.left.name] = None
+        self.statement(func.body, scopes + [params])
+
+    def struct_size(self, node: ast.StructNode):
+        """ Returns the size of the struct defined by <node> like eval_struct_node, or None if it is unknown. """
+        size = 0
+        for line in node.block.lines:
+            field_size = self.defining_size(line.left.right)
+            if field_size is None:
+                return None
+            size += field_size
+        return size
+
+    def defining_size(self, node: ast.Node):
+        """ Returns the size of the type declared by <node>, or None if an array length is not a literal. """
+        if node.node_type == ast.NAME_NODE:
+            return self.type_size(node.name)
+        elif node.node_type == ast.INDEXING_NODE:
+            inner = self.defining_size(node.call_obj)
+            if inner is None or len(node.arg.lines) == 0:
+                return None if inner is None else 0
+            length = node.arg.lines[-1]
+            if length.node_type != ast.LITERAL or length.lit_type != 0:
+                return None
+            return inner * self.value_of(length)
+        elif node.node_type == ast.UNARY_OPERATOR and node.operation == "unpack":
+            return self.memory.pointer_length
+        return None
+
+    def type_size(self, name: str):
+        if name in self.struct_sizes:
+            return self.struct_sizes[name]
+        return self.memory.type_sizes.get(name)
+
+    def statement(self, node: ast.Node, scopes: list):
+        """ Folds the statement <node>, and defines the variables it declares in the innermost of <scopes>. """
+        if node is None:
+            return
+        node_type = node.node_type
+        if node_type == ast.BLOCK_STMT:
+            node.lines = [self.statement_line(line, scopes) for line in node.lines]
+        elif node_type == ast.ASSIGNMENT_NODE:
+            self.assignment(node, scopes)
+        elif node_type == ast.IF_STMT:
+            node.condition = self.expression(node.condition, scopes)
+            self.statement(node.then_block, scopes + [{}])
+            self.statement(node.else_block, scopes + [{}])
+        elif node_type == ast.FOR_LOOP_STMT:
+            title_scopes = scopes + [{}]
+            start, stop, step = node.condition.lines
+            start = self.statement_line(start, title_scopes)
+            stop = self.expression(stop, title_scopes)
+            node.condition.lines = [start, stop, self.statement_line(step, title_scopes)]
+            self.statement(node.body, title_scopes + [{}])
+        elif node_type == ast.WHILE_STMT:
+            title_scopes = scopes + [{}]
+            node.condition = self.expression(node.condition, title_scopes)
+            self.statement(node.body, title_scopes + [{}])
+        elif node_type == ast.RETURN_STMT:
+            if node.value is not None:
+                node.value = self.expression(node.value, scopes)
+
+    def statement_line(self, node: ast.Node, scopes: list) -> ast.Node:
+        if node.node_type in (ast.BLOCK_STMT, ast.ASSIGNMENT_NODE, ast.IF_STMT, ast.FOR_LOOP_STMT, ast.WHILE_STMT,
+                              ast.RETURN_STMT):
+            self.statement(node, scopes)
+            return node
+        return self.expression(node, scopes)
+
+    def condition(self, node: ast.BlockStmt, scopes: list):
+        node.lines = [self.expression(line, scopes) for line in node.lines]
+
+    def assignment(self, node: ast.AssignmentNode, scopes: list):
+        left = node.left
+        if node.level == ast.FUNC_DEFINE:
+            # a nested function is defined while running, after the enclosing lines before it
+            if node.right.node_type == ast.DEF_STMT:
+                self.function(node.right, scopes)
+            return
+        node.right = self.expression(node.right, scopes)
+        if left.node_type == ast.TYPE_NODE:
+            self.defining(left.right, scopes)
+            const = None
+            if node.level == ast.CONST and node.right.node_type == ast.LITERAL and \
+                    left.right.node_type == ast.NAME_NODE and LITERAL_TYPES.get(left.right.name) == node.right.lit_type:
+                const = node.right
+            scopes[-1][left.left.name] = const
+        else:
+            node.left = self.target(left, scopes)
+
+    def defining(self, node: ast.Node, scopes: list):
+        """ Folds the array lengths of the type declared by <node>. """
+        if node.node_type == ast.INDEXING_NODE:
+            self.defining(node.call_obj, scopes)
+            self.condition(node.arg, scopes)
+        elif node.node_type == ast.UNARY_OPERATOR:
+            self.defining(node.value, scopes)
+
+    def target(self, node: ast.Node, scopes: list) -> ast.Node:
+        """ Folds the operands of <node>, whose location is used, so it is not replaced by a literal itself. """
+        node_type = node.node_type
+        if node_type == ast.INDEXING_NODE:
+            node.call_obj = self.target(node.call_obj, scopes)
+            self.condition(node.arg, scopes)
+        elif node_type == ast.DOT:
+            node.left = self.target(node.left, scopes)
+        elif node_type == ast.UNARY_OPERATOR and node.operation == "unpack":
+            node.value = self.expression(node.value, scopes)
+        return node
+
+    def expression(self, node: ast.Node, scopes: list) -> ast.Node:
+        """ Returns <node> with its constant operands folded, or the literal node it is folded to. """
+        node_type = node.node_type
+        if node_type == ast.NAME_NODE:
+            for scope in reversed(scopes):
+                if node.name in scope:
+                    const = scope[node.name]
+                    if const is not None:
+                        return ast.Literal((node.line_num, node.file), const.lit_pos, const.lit_type)
+                    break
+        elif node_type == ast.DOT:
+            node.left = self.target(node.left, scopes)
+        elif node_type == ast.BINARY_OPERATOR:
+            if node.assignment:
+                node.left = self.target(node.left, scopes)
+                node.right = self.expression(node.right, scopes)
+            else:
+                node.left = self.expression(node.left, scopes)
+                node.right = self.expression(node.right, scopes)
+                if node.left.node_type == ast.LITERAL and node.right.node_type == ast.LITERAL:
+                    return self.binary_operation(node)
+        elif node_type == ast.UNARY_OPERATOR:
+            if node.operation == "pack":
+                node.value = self.target(node.value, scopes)
+            else:
+                node.value = self.expression(node.value, scopes)
+                if node.operation == "neg" and node.value.node_type == ast.LITERAL and node.value.lit_type == 0:
+                    return self.literal(node, -self.value_of(node.value), "int")
+        elif node_type == ast.IN_DECREMENT_OPERATOR:
+            node.value = self.target(node.value, scopes)
+        elif node_type == ast.INDEXING_NODE:
+            node.call_obj = self.target(node.call_obj, scopes)
+            self.condition(node.arg, scopes)
+        elif node_type == ast.FUNCTION_CALL:
+            return self.call(node, scopes)
+        elif node_type == ast.BLOCK_STMT:
+            self.condition(node, scopes)
+        return node
+
+    def call(self, node: ast.FuncCall, scopes: list) -> ast.Node:
+        call_obj = node.call_obj
+        args = node.args.lines
+        if call_obj.node_type == ast.NAME_NODE and call_obj.name in NAME_NATIVES:
+            if call_obj.name == "sizeof" and len(args) == 1 and args[0].node_type == ast.NAME_NODE:
+                size = self.type_size(args[0].name)
+                if size is not None:
+                    return self.literal(node, size, "int")
+            return node
+        node.call_obj = self.target(call_obj, scopes)
+        self.condition(node.args, scopes)
+        return node
+
+    def binary_operation(self, node: ast.BinaryOperator) -> ast.Node:
+        """ Returns the literal node of the operation <node> on two literals like eval_binary_operation. """
+        l_name = LITERAL_TYPE_NAMES.get(node.left.lit_type)
+        r_name = LITERAL_TYPE_NAMES.get(node.right.lit_type)
+        if l_name is None or r_name is None:
+            return node
+        lv = self.value_of(node.left)
+        rv = self.value_of(node.right)
+        if node.operation in itp.BINARY_OP_TABLE:
+            op_funcs = itp.BINARY_OP_TABLE[node.operation].get(l_name, {})
+            if r_name not in op_funcs:
+                return node
+            return self.literal(node, op_funcs[r_name](lv, rv), l_name)
+        elif node.operation in itp.COMPARE_TABLE:
+            return self.literal(node, itp.COMPARE_TABLE[node.operation](lv - rv), "boolean")
+        return node
+
+    def value_of(self, node: ast.Literal):
+        """ Returns the value of the literal <node> of a type in LITERAL_TYPE_NAMES, chars as their codes. """
+        literal_bytes = self.parser.literal_bytes
+        pos = node.lit_pos
+        if node.lit_type == 0:
+            return typ.bytes_to_int(literal_bytes[pos: pos + self.parser.int_size])
+        elif node.lit_type == 1:
+            return typ.bytes_to_float(literal_bytes[pos: pos + 8])
+        return literal_bytes[pos] if node.lit_type == 4 else literal_bytes[pos] != 0
+
+    def literal(self, node: ast.Node, value, type_name: str) -> ast.Node:
+        """ Returns the literal node of <value> in place of <node>, or <node> if the value overflows its type. """
+        if type_name == "int":
+            value = int(value)
+            try:
+                typ.int_to_bytes(value, self.parser.int_size)
+            except struct.error:
+                return node  # the overflow is raised while running
+        elif type_name == "float":
+            value = float(value)
+        else:
+            value = bool(value)
+        return self.parser.make_literal_node((node.line_num, node.file), value, True)
@@ -0,0 +1,161 @@
+import bisect
+import bin.spl_environment as en
+
+
+class GarbageCollector:
+    """
+    Mark and sweep collector of the heap blocks allocated by the program through 'malloc' and 'pool_alloc'.
+
+    Blocks are reached from the variables of the global environment and of the environments of all active calls.
+    The type of a pointer variable tells the type of the block it points to, so a block of structs is scanned
+    field by field, and a block of primitives is not scanned at all.
+    Values which are not stored in a variable, such as arguments being evaluated, are found by scanning the stack
+    conservatively: every int long window holding the start of a block keeps the block. Blocks of unknown type are
+    scanned the same way. Pointers inside a block are only followed from typed values, since byte windows across
+    small ints would look like them.
+    Pointers stored in variables of non-pointer types, except on the stack, are not seen by the collector.
+    The variables and the operand stacks of the running virtual machines are roots too.
+    """
+
+    def __init__(self, memory, global_env: en.GlobalEnvironment, env_stack: list):
+        """
+        :param memory: the memory whose heap is collected
+        :param global_env: the global environment, which also holds the structs
+        :param env_stack: the innermost environments of the active calls, maintained by the interpreter
+        """
+        self.memory = memory
+        self.global_env = global_env
+        self.env_stack = env_stack
+        self.machines = []  # the running spl_vm.VirtualMachine
+        self.blocks = {}  # pointer: length of all allocated blocks
+        self.collections = 0
+        self.freed_bytes = 0
+
+        # state of a collection
+        self.starts = []
+        self.marked = set()
+        self.worklist = []  # (block, pointed type name or None if unknown)
+
+    def track(self, ptr: int, length: int):
+        self.blocks[ptr] = length
+
+    def untrack(self, ptr: int):
+        self.blocks.pop(ptr, None)
+
+    def collect(self) -> int:
+        """
+        Frees all unreachable blocks, and returns the emptied pool chunks to the allocator.
+
+        :return: the total length of the freed blocks
+        """
+        self.starts = sorted(self.blocks)
+        self.marked = set()
+        self.worklist = []
+
+        self._mark_environments()
+        self._mark_machines()
+        self._mark_stack()
+        self._mark_arenas()
+        while self.worklist:
+            block, type_name = self.worklist.pop()
+            self._scan_block(block, type_name)
+
+        freed = 0
+        for block in [b for b in self.blocks if b not in self.marked]:
+            freed += self.blocks[block]
+            self.memory.free(block)
+        if freed > 0:
+            self.memory.trim_pools()
+        self.collections += 1
+        self.freed_bytes += freed
+        self.starts = []
+        self.marked = set()
+        return freed
+
+    def _mark_environments(self):
+        visited = set()
+        for env in [self.global_env] + self.env_stack:
+            while env is not None and id(env) not in visited:
+                visited.add(id(env))
+                for name, ptr in env.variables.items():
+                    tal = env.var_types.get(name)
+                    if tal is not None:
+                        self._scan_typed(ptr, tal.type_name, array_count(tal))
+                env = env.outer
+
+    def _mark_machines(self):
+        for machine in self.machines:
+            for ptr, tal in machine.typed_roots():
+                self._scan_typed(ptr, tal.type_name, array_count(tal))
+            for v in machine.stack:  # computed values, which are kept like values on the stack
+                if v in self.blocks:
+                    self._reach(v, None)
+
+    def _mark_stack(self):
+        memory = self.memory
+        if memory.stack_segments:
+            self._scan_conservative(1, memory.stack_size)
+            for start, end in memory.stack_segments[:-1]:
+                self._scan_conservative(start, end)
+            self._scan_conservative(memory.stack_start, min(memory.sp, memory.stack_end))
+        else:
+            self._scan_conservative(1, min(memory.sp, memory.stack_size))
+
+    def _mark_arenas(self):
+        for arena in self.memory.arenas.values():
+            for chunk in arena.chunks[:-1]:
+                self._scan_conservative(chunk, chunk + arena.chunk_size)
+            self._scan_conservative(arena.chunks[-1], arena.ptr)
+
+    def _scan_typed(self, ptr: int, type_name: str, count: int):
+        """ Marks the blocks pointed by <count> consecutive values of type <type_name> at <ptr>. """
+        memory = self.memory
+        if type_name[0] == "*":
+            pointed = type_name[1:]
+            ptr_len = memory.pointer_length
+            for i in range(count):
+                self._reach(memory.int_struct.unpack_from(memory.memory, ptr + i * ptr_len)[0], pointed)
+        elif type_name in self.global_env.structs:
+            struct = self.global_env.structs[type_name]
+            size = memory.get_type_size(type_name)
+            for i in range(count):
+                for pos, tal in struct.vars.values():
+                    self._scan_typed(ptr + i * size + pos, tal.type_name, array_count(tal))
+        # primitive values hold no pointers
+
+    def _scan_block(self, block: int, type_name):
+        length = self.blocks[block]
+        if type_name is None or type_name == "void":
+            self._scan_conservative(block, block + length)
+        else:
+            size = self.memory.get_type_size(type_name)
+            if size > 0:
+                self._scan_typed(block, type_name, length // size)
+
+    def _scan_conservative(self, start: int, end: int):
+        memory = self.memory
+        unpack_from = memory.int_struct.unpack_from
+        blocks = self.blocks
+        buf = memory.memory
+        for offset in range(start, end - memory.pointer_length + 1):
+            v = unpack_from(buf, offset)[0]
+            if v in blocks:
+                self._reach(v, None)
+
+    def _reach(self, ptr: int, type_name):
+        """ Marks the block containing <ptr>, and schedules it to be scanned as values of <type_name>. """
+        i = bisect.bisect_right(self.starts, ptr) - 1
+        if i < 0:
+            return
+        block = self.starts[i]
+        if block in self.marked or ptr >= block + max(self.blocks[block], 1):
+            return
+        self.marked.add(block)
+        self.worklist.append((block, type_name))
+
+
+def array_count(tal: en.Type) -> int:
+    count = 1
+    for x in tal.array_lengths:
+        count *= x
+    return count
@@ -3,6 +3,9 @@ import bin.spl_memory as mem
 import bin.spl_environment as en
 import bin.spl_lib as lib
 import bin.spl_types as typ
+import bin.spl_gc as gc
+import operator
+import pickle
 import time
 import sys
 
@@ -10,35 +13,44 @@ INVALID = lib.InvalidArgument()
 
 LINE_FILE = 0, "Interpreter"
 
-INT_LEN = mem.MEMORY.get_type_size("int")
-FLOAT_LEN = mem.MEMORY.get_type_size("float")
-CHAR_LEN = mem.MEMORY.get_type_size("char")
-BOOLEAN_LEN = mem.MEMORY.get_type_size("boolean")
-PTR_LEN = mem.MEMORY.pointer_length
-
-PRIMITIVE_TYPES = {
-    "int": INT_LEN,
-    "float": FLOAT_LEN,
-    "boolean": BOOLEAN_LEN,
-    "char": CHAR_LEN
-}
+SNAPSHOT_MAGIC = b"TPL snapshot 1004\n"  # the first line of a snapshot file, checked before anything is unpickled
+
+# modules whose classes make up a snapshot, no other globals can be loaded from a snapshot
+SNAPSHOT_MODULES = {"bin.spl_ast", "bin.spl_environment", "bin.spl_interpreter", "bin.spl_memory"}
+
+CLOCK_START = time.time()  # 'clock' counts from here, so that its value also fits in a 32 bit int
+
+# the lengths of these types are looked up in the memory, since the int length is configurable
+PRIMITIVE_TYPES = {"int", "float", "boolean", "char"}
 
 
 class Interpreter:
-    def __init__(self):
+    def __init__(self, memory: mem.Memory):
+        """
+        :param memory: the memory of the program, owned by this interpreter
+        """
+        self.memory = memory
         self.ast = None
         self.literal_bytes = None
         self.string_lengths = None
-        self.global_env = en.GlobalEnvironment()
+        self.global_env = en.GlobalEnvironment(memory)
 
     def set_ast(self, tree, literal_bytes: bytes):
         self.ast = tree
         self.literal_bytes = literal_bytes
 
     def interpret(self):
-        mem.MEMORY.load_literal(self.literal_bytes)
+        self.initialize()
+        return self.run_main()
+
+    def initialize(self):
+        """ Loads the literals, and evaluates the top level of the program, which defines structs and functions. """
+        self.memory.load_literal(self.literal_bytes)
         self.add_natives()
         evaluate(self.ast, self.global_env)
+
+    def run_main(self):
+        """ Calls the function 'main' of an initialized program and returns its exit value. """
         if "main" in self.global_env.functions:
             main_group: dict = self.global_env.get_function("main", LINE_FILE)
             # main_func: Function = main_group[""]
@@ -46,27 +58,98 @@ class Interpreter:
             # if main_rt.type_name != "int" or len(main_rt.array_lengths):
             #     raise lib.SplException("Function 'main' must return 'int'")
             r_ptr = call_function(main_group, [], self.global_env)
-            rb = mem.MEMORY.get(r_ptr, mem.MEMORY.get_type_size("int"))
-            return typ.bytes_to_int(rb)
+            return self.memory.get_int(r_ptr)
         return 0
 
+    def enable_gc(self):
+        """ Reclaims unreachable heap blocks when the heap is full or 'gc' is called. """
+        self.memory.collector = gc.GarbageCollector(self.memory, self.global_env, self.memory.call_envs)
+
+    def save_snapshot(self, file_name: str):
+        """
+        Writes the memory and the global environment of an initialized program to a snapshot file, from which
+        'load_snapshot' restores the program without parsing and initializing it again.
+        """
+        content = pickle.dumps((self.memory, self.global_env), pickle.HIGHEST_PROTOCOL)
+        with open(file_name, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(content)
+
+    def load_snapshot(self, file_name: str):
+        """
+        Restores the memory and the global environment saved by 'save_snapshot', 'run_main' can run then.
+
+        A file without the snapshot header is refused before it is unpickled. The unpickler only loads the classes
+        of SNAPSHOT_MODULES and the functions of the natives, so a snapshot cannot import or call anything else,
+        but it is still a program, which should only be run if trusted.
+        """
+        self.add_natives()
+        natives = {func.func for group in self.global_env.functions.values() for func in group.values()}
+        with open(file_name, "rb") as f:
+            if f.readline() != SNAPSHOT_MAGIC:
+                raise lib.SplException("'{}' is not a snapshot of this TPL build".format(file_name))
+            content = SnapshotUnpickler(f, natives).load()
+        if not isinstance(content, tuple) or len(content) != 2 or not isinstance(content[0], mem.Memory) or \
+                not isinstance(content[1], en.GlobalEnvironment):
+            raise lib.SplException("'{}' is not a snapshot of this TPL build".format(file_name))
+        self.memory.close()
+        self.memory = content[0]
+        self.global_env = content[1]
+
     def add_natives(self):
         self.add_native_function("printf", NativeFunction(printf, en.Type("void"), eval_before=False))
         self.add_native_function("malloc", NativeFunction(malloc, en.Type("int")))
         self.add_native_function("free", NativeFunction(free, en.Type("void")))
+        self.add_native_function("calloc", NativeFunction(calloc, en.Type("int")))
+        self.add_native_function("realloc", NativeFunction(realloc, en.Type("int")))
+        self.add_native_function("pool_alloc", NativeFunction(pool_alloc, en.Type("int")))
         self.add_native_function("sizeof", NativeFunction(sizeof, en.Type("int"), eval_before=False))
         self.add_native_function("typeof", NativeFunction(typeof, en.Type("void"), eval_before=False))
         self.add_native_function("memory_view", NativeFunction(memory_view, en.Type("void")))
         self.add_native_function("memory_ava", NativeFunction(memory_ava, en.Type("void")))
         self.add_native_function("memory_sp", NativeFunction(memory_sp, en.Type("void")))
         self.add_native_function("heap_ava", NativeFunction(heap_ava, en.Type("int")))
+        self.add_native_function("heap_frag", NativeFunction(heap_frag, en.Type("float")))
+        self.add_native_function("mem_stats", NativeFunction(mem_stats, en.Type("int"), eval_before=False))
+        self.add_native_function("gc", NativeFunction(collect_garbage, en.Type("int")))
         self.add_native_function("mem_copy", NativeFunction(mem_copy, en.Type("void")))
+        self.add_native_function("strlen", NativeFunction(strlen, en.Type("int"), eval_before=False))
+        self.add_native_function("strcmp", NativeFunction(strcmp, en.Type("int"), eval_before=False))
+        self.add_native_function("strcpy", NativeFunction(strcpy, en.Type("*char"), eval_before=False))
+        self.add_native_function("strcat", NativeFunction(strcat, en.Type("*char"), eval_before=False))
+        self.add_native_function("strchr", NativeFunction(strchr, en.Type("*char"), eval_before=False))
+        self.add_native_function("strstr", NativeFunction(strstr, en.Type("*char"), eval_before=False))
+        self.add_native_function("memset", NativeFunction(memset, en.Type("void"), eval_before=False))
+        self.add_native_function("memcmp", NativeFunction(memcmp, en.Type("int"), eval_before=False))
+        self.add_native_function("memmove", NativeFunction(memmove, en.Type("*void"), eval_before=False))
+        self.add_native_function("arena_new", NativeFunction(arena_new, en.Type("int")))
+        self.add_native_function("arena_alloc", NativeFunction(arena_alloc, en.Type("int")))
+        self.add_native_function("arena_reset", NativeFunction(arena_reset, en.Type("void")))
+        self.add_native_function("arena_free", NativeFunction(arena_free, en.Type("void")))
         self.add_native_function("clock", NativeFunction(clock, en.Type("int")))
 
     def add_native_function(self, name, func):
         self.global_env.define_function(name, func)
 
 
+class SnapshotUnpickler(pickle.Unpickler):
+    """ Unpickles a snapshot, refusing every global which is not a class of SNAPSHOT_MODULES or a native. """
+
+    def __init__(self, file, natives: set):
+        """
+        :param natives: the functions of the natives, which are saved in a snapshot by reference
+        """
+        pickle.Unpickler.__init__(self, file)
+        self.natives = natives
+
+    def find_class(self, module: str, name: str):
+        if module in SNAPSHOT_MODULES and "." not in name:
+            obj = getattr(sys.modules[module], name, None)
+            if isinstance(obj, type) and obj.__module__ == module or callable(obj) and obj in self.natives:
+                return obj
+        raise lib.SplException("A snapshot cannot load '{}.{}'".format(module, name))
+
+
 class ParameterPair:
     def __init__(self, name: str, tal: en.Type):
         self.name: str = name
@@ -127,13 +210,14 @@ def print_warning(txt: str):
 
 
 def printf(env: en.Environment, *args_node):
+    memory = env.memory
     fmt_node = args_node[0]
     # print(fmt_ptr)
-    # fmt_b: bytes = mem.MEMORY.get_string(fmt_ptr)
+    # fmt_b: bytes = memory.get_string(fmt_ptr)
     fmt_tal = get_tal_of_evaluated_node(fmt_node, env)
-    fmt_len = fmt_tal.total_len()
+    fmt_len = fmt_tal.total_len(memory)
     fmt_ptr = evaluate(fmt_node, env)
-    fmt_b = mem.MEMORY.get(fmt_ptr, fmt_len)
+    fmt_b = memory.get(fmt_ptr, fmt_len)
     fmt: str = fmt_b.decode("utf-8")
     i = 0
     a_index = 0
@@ -149,15 +233,13 @@ def printf(env: en.Environment, *args_node):
                 f = False
                 num_ptr = args[a_index]
                 a_index += 1
-                bs = mem.MEMORY.get(num_ptr, INT_LEN)
-                lst.append(str(typ.bytes_to_int(bs)))
+                lst.append(str(memory.get_int(num_ptr)))
             elif ch == "f":
                 f = False
                 # TODO: get more pref
                 num_ptr = args[a_index]
                 a_index += 1
-                bs = mem.MEMORY.get(num_ptr, FLOAT_LEN)
-                lst.append(str(typ.bytes_to_float(bs)))
+                lst.append(str(memory.get_float(num_ptr)))
             elif ch == "s":
                 f = False
                 ch_ptr = args[a_index]
@@ -165,13 +247,13 @@ def printf(env: en.Environment, *args_node):
                 ch_tal = get_tal_of_evaluated_node(ch_node, env)
                 # print(ch_tal)
                 if en.is_array(ch_tal):
-                    b = mem.MEMORY.get(ch_ptr, ch_tal.total_len())
+                    b = memory.get(ch_ptr, ch_tal.total_len(memory))
                     s = typ.bytes_to_string(b)
                     lst.append(s)
                 elif ch_tal.type_name == "*char":
-                    content_ptr_b = mem.MEMORY.get(ch_ptr, PTR_LEN)
-                    content_ptr = typ.bytes_to_int(content_ptr_b)
-                    b = mem.MEMORY.get_char_array(content_ptr)
+                    content_ptr = memory.get_ptr(ch_ptr)
+                    memory.check_access(content_ptr, 1)
+                    b = memory.get_char_array(content_ptr)
                     s = typ.bytes_to_string(b)
                     lst.append(s)
                 else:
@@ -181,14 +263,12 @@ def printf(env: en.Environment, *args_node):
                 f = False
                 c_ptr = args[a_index]
                 a_index += 1
-                bs = mem.MEMORY.get(c_ptr, CHAR_LEN)
-                lst.append(typ.bytes_to_string(bs))
+                lst.append(chr(memory.get_char(c_ptr)))
             elif ch == "b":
                 f = False
                 bool_ptr = args[a_index]
                 a_index += 1
-                bb = mem.MEMORY.get(bool_ptr, BOOLEAN_LEN)
-                bv = typ.bytes_to_bool(bb)
+                bv = memory.get_bool(bool_ptr)
                 lst.append("true" if bv else "false")
             else:
                 print_warning("Unknown identifier '%{}'".format(ch))
@@ -200,30 +280,58 @@ def printf(env: en.Environment, *args_node):
     print(string)
 
 
-def malloc(length_ptr: int) -> int:
-    int_len = mem.MEMORY.get_type_size("int")
-    b = mem.MEMORY.get(length_ptr, int_len)
-    v = typ.bytes_to_int(b)
-    ptr = mem.MEMORY.malloc(v)
-    ptr_b = typ.int_to_bytes(ptr)
-    rtn = mem.MEMORY.allocate(ptr_b)
-    return rtn
+def malloc(memory: mem.Memory, length_ptr: int) -> int:
+    v = memory.get_int(length_ptr)
+    ptr = memory.malloc(v)
+    return memory.allocate_int(ptr)
+
+
+def calloc(memory: mem.Memory, count_ptr: int, size_ptr: int) -> int:
+    ptr = memory.calloc(memory.get_int(count_ptr), memory.get_int(size_ptr))
+    return memory.allocate_int(ptr)
+
+
+def realloc(memory: mem.Memory, ptr, length_ptr: int) -> int:
+    loc = memory.realloc(memory.get_ptr(ptr), memory.get_int(length_ptr))
+    return memory.allocate_int(loc)
+
+
+def pool_alloc(memory: mem.Memory, length_ptr: int) -> int:
+    ptr = memory.pool_alloc(memory.get_int(length_ptr))
+    return memory.allocate_int(ptr)
+
+
+def free(memory: mem.Memory, ptr):
+    loc = memory.get_ptr(ptr)
+    memory.free(loc)
 
 
-def free(ptr):
-    b = mem.MEMORY.get(ptr, mem.MEMORY.pointer_length)
-    loc = typ.bytes_to_int(b)
-    mem.MEMORY.free(loc)
+def arena_new(memory: mem.Memory, size_ptr: int) -> int:
+    handle = memory.arena_new(memory.get_int(size_ptr))
+    return memory.allocate_int(handle)
+
+
+def arena_alloc(memory: mem.Memory, arena_ptr: int, length_ptr: int) -> int:
+    ptr = memory.arena_alloc(memory.get_int(arena_ptr), memory.get_int(length_ptr))
+    return memory.allocate_int(ptr)
+
+
+def arena_reset(memory: mem.Memory, arena_ptr: int):
+    memory.arena_reset(memory.get_int(arena_ptr))
+
+
+def arena_free(memory: mem.Memory, arena_ptr: int):
+    memory.arena_free(memory.get_int(arena_ptr))
 
 
 def sizeof(env: en.Environment, node: ast.NameNode) -> int:
-    size = mem.MEMORY.get_type_size(node.name)
+    memory = env.memory
+    size = memory.get_type_size(node.name)
 
     # struct: Struct = evaluate(node, env)
     # s_name = struct.name
-    # struct_size = mem.MEMORY.get_type_size(s_name)
-    b = typ.int_to_bytes(size)
-    return mem.MEMORY.allocate(b)
+    # struct_size = memory.get_type_size(s_name)
+    return memory.allocate_int(size)
 
 
 def typeof(env: en.Environment, node: ast.Node):
@@ -232,40 +340,174 @@ def typeof(env: en.Environment, node: ast.Node):
     print(s)
 
 
-def memory_view():
-    mem.MEMORY.print_memory()
+def memory_view(memory: mem.Memory):
+    memory.print_memory()
+
+
+def memory_ava(memory: mem.Memory):
+    print(memory.free_blocks())
+
+
+def memory_sp(memory: mem.Memory):
+    print(memory.sp)
 
 
-def memory_ava():
-    mem.MEMORY.available2.print_sorted()
-    # print(mem.MEMORY.available)
-    # mem.MEMORY.available2.print_heap()
+def heap_ava(memory: mem.Memory) -> int:
+    size = memory.heap_available()
+    return memory.allocate_int(size)
 
 
-def memory_sp():
-    print(mem.MEMORY.sp)
+def heap_frag(memory: mem.Memory) -> int:
+    """ Returns the pointer to the fragmentation of the heap, a float, like every native returns a pointer. """
+    frag = memory.allocator.fragmentation()
+    return memory.allocate_float(frag)
 
 
-def heap_ava() -> int:
-    size = len(mem.MEMORY.available2)
-    b = typ.int_to_bytes(size)
-    return mem.MEMORY.allocate(b)
+def mem_stats(env: en.Environment, name_node: ast.Node) -> int:
+    """ Returns the integer counter of Memory.stats() named by the string argument. """
+    memory = env.memory
+    name = memory.get(*evaluate_string(name_node, env)).decode()
+    value = memory.stats().get(name)
+    if not isinstance(value, int):
+        raise lib.SplException("'{}' is not an integer memory statistic".format(name))
+    return memory.allocate_int(value)
 
 
-def mem_copy(from_ptr, to_ptr, len_ptr):
-    fb = mem.MEMORY.get(from_ptr, PTR_LEN)
-    tb = mem.MEMORY.get(to_ptr, PTR_LEN)
-    lb = mem.MEMORY.get(len_ptr, PTR_LEN)
-    fi, ti, li = typ.bytes_to_int(fb), typ.bytes_to_int(tb), typ.bytes_to_int(lb)
+def collect_garbage(memory: mem.Memory) -> int:
+    if memory.collector is None:
+        return memory.allocate_int(0)
+    freed = memory.collector.collect()
+    return memory.allocate_int(freed)
+
+
+def mem_copy(memory: mem.Memory, from_ptr, to_ptr, len_ptr):
+    fi, ti, li = memory.get_ptr(from_ptr), memory.get_ptr(to_ptr), memory.get_int(len_ptr)
     # print(fi, ti, li)
-    mem.MEMORY.mem_copy(fi, ti, li)
+    memory.check_access(fi, li)
+    memory.check_access(ti, li)
+    memory.mem_copy(fi, ti, li)
+
+
+# string functions work on the whole strings in the memory at once, a pointer not found is returned as null
+
+
+def strlen(env: en.Environment, s_node: ast.Node) -> int:
+    s, length = evaluate_string(s_node, env)
+    return env.memory.allocate_int(length)
+
+
+def strcmp(env: en.Environment, s1_node: ast.Node, s2_node: ast.Node) -> int:
+    memory = env.memory
+    b1 = memory.get(*evaluate_string(s1_node, env))
+    b2 = memory.get(*evaluate_string(s2_node, env))
+    return memory.allocate_int((b1 > b2) - (b1 < b2))
+
+
+def strcpy(env: en.Environment, dest_node: ast.Node, src_node: ast.Node) -> int:
+    memory = env.memory
+    dest = evaluate_address(dest_node, env)
+    src, length = evaluate_string(src_node, env)
+    copy_string(memory, src, dest, length)
+    return memory.allocate_int(dest)
+
+
+def strcat(env: en.Environment, dest_node: ast.Node, src_node: ast.Node) -> int:
+    memory = env.memory
+    dest, dest_len = evaluate_string(dest_node, env)
+    src, length = evaluate_string(src_node, env)
+    copy_string(memory, src, dest + dest_len, length)
+    return memory.allocate_int(dest)
+
+
+def strchr(env: en.Environment, s_node: ast.Node, c_node: ast.Node) -> int:
+    memory = env.memory
+    s, length = evaluate_string(s_node, env)
+    c = evaluate_code(c_node, env) & 0xff
+    if c == 0:  # the terminator is part of the string, as in C
+        return memory.allocate_int(s + length)
+    return memory.allocate_int(memory.find(s, length, bytes((c,))))
+
+
+def strstr(env: en.Environment, s_node: ast.Node, sub_node: ast.Node) -> int:
+    memory = env.memory
+    s, length = evaluate_string(s_node, env)
+    sub = memory.get(*evaluate_string(sub_node, env))
+    if not sub:
+        return memory.allocate_int(s)
+    return memory.allocate_int(memory.find(s, length, sub))
+
+
+def copy_string(memory: mem.Memory, src: int, dest: int, length: int):
+    """ Copies <length> chars from <src> to <dest>, followed by a terminator. """
+    memory.check_access(dest, length + 1)
+    memory.mem_copy(src, dest, length)
+    memory.set_char(dest + length, 0)
+
+
+def memset(env: en.Environment, ptr_node: ast.Node, value_node: ast.Node, length_node: ast.Node):
+    memory = env.memory
+    ptr = evaluate_address(ptr_node, env)
+    value = evaluate_code(value_node, env)
+    length = memory.get_int(evaluate(length_node, env))
+    memory.check_access(ptr, length)
+    memory.mem_set(ptr, value, length)
+
 
+def memcmp(env: en.Environment, ptr1_node: ast.Node, ptr2_node: ast.Node, length_node: ast.Node) -> int:
+    memory = env.memory
+    p1 = evaluate_address(ptr1_node, env)
+    p2 = evaluate_address(ptr2_node, env)
+    length = memory.get_int(evaluate(length_node, env))
+    memory.check_access(p1, length)
+    memory.check_access(p2, length)
+    return memory.allocate_int(memory.mem_compare(p1, p2, length))
 
-def clock() -> int:
-    t_s = time.time()
+
+def memmove(env: en.Environment, dest_node: ast.Node, src_node: ast.Node, length_node: ast.Node) -> int:
+    memory = env.memory
+    dest = evaluate_address(dest_node, env)
+    src = evaluate_address(src_node, env)
+    length = memory.get_int(evaluate(length_node, env))
+    memory.check_access(dest, length)
+    memory.check_access(src, length)
+    memory.mem_copy(src, dest, length)
+    return memory.allocate_int(dest)
+
+
+def evaluate_address(node: ast.Node, env: en.Environment) -> int:
+    """ Evaluates an argument which may be an array or a pointer, and returns the address of the pointed memory. """
+    ptr = evaluate(node, env)
+    tal = get_tal_of_evaluated_node(node, env)
+    if not en.is_array(tal):
+        ptr = env.memory.get_ptr(ptr)
+    env.memory.check_access(ptr, 1)
+    return ptr
+
+
+def evaluate_string(node: ast.Node, env: en.Environment) -> (int, int):
+    """ Evaluates an argument which is a char array or a pointer to chars, and returns its address and length. """
+    memory = env.memory
+    ptr = evaluate(node, env)
+    tal = get_tal_of_evaluated_node(node, env)
+    if en.is_array(tal):
+        return ptr, memory.string_length(ptr, tal.total_len(memory))
+    ptr = memory.get_ptr(ptr)
+    memory.check_access(ptr, 1)
+    return ptr, memory.string_length(ptr)
+
+
+def evaluate_code(node: ast.Node, env: en.Environment) -> int:
+    """ Evaluates an argument which may be a char or an int, and returns its value as an int. """
+    ptr = evaluate(node, env)
+    if get_tal_of_evaluated_node(node, env).type_name == "char":
+        return env.memory.get_char(ptr)
+    return env.memory.get_int(ptr)
+
+
+def clock(memory: mem.Memory) -> int:
+    t_s = time.time() - CLOCK_START
     t_ms = int(t_s * 1000)
-    b = typ.int_to_bytes(t_ms)
-    return mem.MEMORY.allocate(b)
+    return memory.allocate_int(t_ms)
 
 
 # #### Evaluation functions #### #
@@ -313,7 +555,7 @@ def eval_call(node: ast.FuncCall, env: en.Environment):
     some_func = list(func_group.values())[0]
 
     if isinstance(some_func, Function):
-        return call_function(func_group, node.args.lines, env)
+        return call_function(func_group, node.args.lines, env, node.overload)
     elif isinstance(some_func, NativeFunction):
         return call_native_function(some_func, node.args.lines, env)
     else:
@@ -321,11 +563,13 @@ def eval_call(node: ast.FuncCall, env: en.Environment):
 
 
 def call_native_function(func: NativeFunction, orig_args: list, call_env: en.Environment):
+    memory = call_env.memory
     rtn_type = func.r_tal
-    rtn_len = rtn_type.total_len()
-    rtn_loc = mem.MEMORY.allocate_empty(rtn_len)
+    rtn_len = rtn_type.total_len(memory)
+    rtn_loc = memory.allocate_empty(rtn_len)
 
-    mem.MEMORY.push_stack()
+    memory.push_stack()
+    memory.call_envs.append(call_env)
 
     if func.eval_before:
         args = []
@@ -335,51 +579,55 @@ def call_native_function(func: NativeFunction, orig_args: list, call_env: en.Env
             value = evaluate(orig_arg, call_env)
             args.append(value)
 
-        rtn_ptr = func.call(*args)
+        rtn_ptr = func.call(memory, *args)
     else:
         rtn_ptr = func.call(call_env, *orig_args)
 
+    memory.call_envs.pop()
     if rtn_len > 0:
-        mem.MEMORY.mem_copy(rtn_ptr, rtn_loc, rtn_len)
-
-        mem.MEMORY.restore_stack()
+        memory.mem_copy(rtn_ptr, rtn_loc, rtn_len)
+        memory.restore_stack()
         return rtn_loc
+    memory.restore_stack()
 
 
-def call_function(func_group: dict, orig_args: list, call_env: en.Environment):
-    arg_types = []
-    for orig_arg in orig_args:
-        tal = get_tal_of_evaluated_node(orig_arg, call_env)
-        arg_types.append(tal)
-
-    types_id = en.args_type_hash(arg_types)
+def call_function(func_group: dict, orig_args: list, call_env: en.Environment, types_id: str = None):
+    memory = call_env.memory
+    if types_id is None:
+        arg_types = []
+        for orig_arg in orig_args:
+            tal = get_tal_of_evaluated_node(orig_arg, call_env)
+            arg_types.append(tal)
+        types_id = en.args_type_hash(arg_types)
     func = func_group[types_id]
 
     rtn_type = func.r_tal
-    rtn_len = rtn_type.total_len()
-    rtn_loc = mem.MEMORY.allocate_empty(rtn_len)
+    rtn_len = rtn_type.total_len(memory)
+    rtn_loc = memory.allocate_empty(rtn_len)
 
     scope = en.FunctionEnvironment(func.outer_scope)
-    mem.MEMORY.push_stack()
+    memory.push_stack()
+    memory.call_envs.append(call_env)
 
     for i in range(len(orig_args)):
         param: ParameterPair = func.params[i]
         orig_arg = orig_args[i]
         p = evaluate(orig_arg, call_env)
         tal = param.tal
-        total_len = tal.total_len()
-        arg_ptr = mem.MEMORY.allocate_empty(total_len)
+        total_len = tal.total_len(memory)
+        arg_ptr = memory.allocate_empty(total_len)
         scope.define_var(param.name, tal, arg_ptr)
-        mem.MEMORY.mem_copy(p, arg_ptr, total_len)
+        memory.mem_copy(p, arg_ptr, total_len)
 
     r = evaluate(func.body, scope)
 
     if rtn_len > 0 and r is None:
         raise lib.TypeException("Missing return statement of a function declared to return type '{}'"
                                 .format(en.type_to_readable(rtn_type)))
-    mem.MEMORY.mem_copy(r, rtn_loc, rtn_len)
+    memory.mem_copy(r, rtn_loc, rtn_len)
 
-    mem.MEMORY.restore_stack()
+    memory.call_envs.pop()
+    memory.restore_stack()
     return rtn_loc
 
 
@@ -393,8 +641,7 @@ def get_tal_of_defining_node(node: ast.Node, env: en.Environment) -> en.Type:
         if len(node.arg.lines) == 0:
             return en.Type(tn_al_inner.type_name, 0)
         arr_len_ptr = evaluate(node.arg, env)
-        arr_len_b = mem.MEMORY.get(arr_len_ptr, INT_LEN)
-        arr_len_v = typ.bytes_to_int(arr_len_b)
+        arr_len_v = env.memory.get_int(arr_len_ptr)
         # return type_name, arr_len_inner * typ.bytes_to_int(arr_len_b)
         return en.Type(tn_al_inner.type_name, *tn_al_inner.array_lengths, arr_len_v)
     elif node.node_type == ast.UNARY_OPERATOR:
@@ -428,6 +675,8 @@ def get_tal_of_node_self(node: ast.Node, env: en.Environment) -> en.Type:
 
 
 def get_tal_of_evaluated_node(node: ast.Node, env: en.Environment) -> en.Type:
+    if node.tal is not None:
+        return node.tal
     if node.node_type == ast.LITERAL:
         node: ast.Literal
         return LITERAL_TYPE_TABLE[node.lit_type]
@@ -457,6 +706,9 @@ def get_tal_of_evaluated_node(node: ast.Node, env: en.Environment) -> en.Type:
         call_obj = node.call_obj
         if call_obj.node_type == ast.NAME_NODE:
             func_group: dict = env.get_function(call_obj.name, (node.line_num, node.file))
+            some_func = next(iter(func_group.values()))
+            if isinstance(some_func, NativeFunction):  # not overloaded, and its args may be type names
+                return some_func.r_tal
             arg_types = []
             for orig_arg in node.args.lines:
                 tal = get_tal_of_evaluated_node(orig_arg, env)
@@ -477,11 +729,16 @@ def get_tal_of_evaluated_node(node: ast.Node, env: en.Environment) -> en.Type:
     elif node.node_type == ast.IN_DECREMENT_OPERATOR:
         node: ast.InDecrementOperator
         return get_tal_of_evaluated_node(node.value, env)
+    elif node.node_type == ast.DOT:
+        node: ast.Dot
+        l_tal = get_tal_of_evaluated_node(node.left, env)
+        return env.get_struct(l_tal.type_name).get_attr_tal(node.right.name)
     elif node.node_type == ast.NULL_STMT:
         return en.Type("*void")
 
 
 def eval_assignment_node(node: ast.AssignmentNode, env: en.Environment):
+    memory = env.memory
     r = evaluate(node.right, env)
     lf = node.line_num, node.file
 
@@ -493,23 +750,22 @@ def eval_assignment_node(node: ast.AssignmentNode, env: en.Environment):
             env.define_function(name, r)
         else:
             tal = get_tal_of_evaluated_node(node.left, env)
-            total_len = tal.total_len()
-            rv = mem.MEMORY.get(r, total_len)
+            total_len = tal.total_len(memory)
             current_ptr = env.get(name, lf)
-            mem.MEMORY.set(current_ptr, rv)
+            memory.mem_copy(r, current_ptr, total_len)
             # env.assign(name, r, lf)
     elif node.left.node_type == ast.TYPE_NODE:
         type_node: ast.TypeNode = node.left
         tal = get_tal_of_defining_node(type_node.right, env)
         name: str = type_node.left.name
-        total_len = tal.total_len()
+        total_len = tal.total_len(memory)
         if total_len == 0:  # array with undefined length
             tal = get_tal_of_evaluated_node(node.right, env)
-            total_len = tal.total_len()
+            total_len = tal.total_len(memory)
 
-        ptr = mem.MEMORY.allocate_empty(total_len)
+        ptr = memory.allocate_empty(total_len)
         if r != 0:  # is not undefined
-            mem.MEMORY.mem_copy(r, ptr, total_len)
+            memory.mem_copy(r, ptr, total_len)
 
         if node.level == ast.VAR:
             env.define_var(name, tal, ptr)
@@ -524,31 +780,29 @@ def eval_assignment_node(node: ast.AssignmentNode, env: en.Environment):
         attr: ast.NameNode = dot.right
         pos_in_struct = struct.get_attr_pos(attr.name)
         attr_tal = struct.get_attr_tal(attr.name)
-        attr_len = attr_tal.total_len()
-        rv = mem.MEMORY.get(r, attr_len)
-        mem.MEMORY.set(l_ptr + pos_in_struct, rv)
+        attr_len = attr_tal.total_len(memory)
+        memory.mem_copy(r, l_ptr + pos_in_struct, attr_len)
     elif node.left.node_type == ast.INDEXING_NODE:
         eval_setitem(node.left, r, env)
     elif node.left.node_type == ast.UNARY_OPERATOR:
         uo: ast.UnaryOperator = node.left
         tal = get_tal_of_evaluated_node(uo, env)
-        total_len = tal.total_len()
+        total_len = tal.total_len(memory)
         l_ptr = evaluate(uo, env)
-        rv = mem.MEMORY.get(r, total_len)
         if uo.operation == "pack" and uo.value.node_type == ast.NAME_NODE:
-            ri = typ.bytes_to_int(rv)
+            ri = typ.bytes_to_int(memory.get(r, total_len))
             env.assign(uo.value.name, ri, lf)
         else:
-            mem.MEMORY.set(l_ptr, rv)
+            memory.mem_copy(r, l_ptr, total_len)
     else:
         raise lib.TypeException("Currently unimplemented")
 
 
 def eval_setitem(left: ast.IndexingNode, right_ptr: int, env: en.Environment):
+    memory = env.memory
     modifying_ptr, unit_length = get_indexing_location_and_unit_len(left, env)
     # print(modifying_ptr, unit_length)
-    rb = mem.MEMORY.get(right_ptr, unit_length)
-    mem.MEMORY.set(modifying_ptr, rb)
+    memory.mem_copy(right_ptr, modifying_ptr, unit_length)
 
 
 def eval_getitem(node: ast.IndexingNode, env: en.Environment):
@@ -557,24 +811,25 @@ def eval_getitem(node: ast.IndexingNode, env: en.Environment):
 
 
 def get_indexing_location_and_unit_len(node: ast.IndexingNode, env: en.Environment) -> (int, int):
+    memory = env.memory
     l_ptr = evaluate(node.call_obj, env)
     l_tal = get_tal_of_node_self(node, env)
     if en.is_array(l_tal):
         depth = index_node_depth(node)
-        unit_length = l_tal.total_len()
+        unit_length = l_tal.total_len(memory)
         for i in range(depth):
             unit_length //= l_tal.array_lengths[i]
     elif l_tal.type_name[0] == "*":
-        ptr_b = mem.MEMORY.get(l_ptr, PTR_LEN)
-        l_ptr = typ.bytes_to_int(ptr_b)
-        unit_length = mem.MEMORY.get_type_size(l_tal.type_name[1:])
+        l_ptr = memory.get_ptr(l_ptr)
+        unit_length = memory.get_type_size(l_tal.type_name[1:])
     else:
         raise lib.TypeException("Type '{}' not supporting indexing".format(en.type_to_readable(l_tal)))
 
     arg_ptr = evaluate(node.arg, env)  # arg type must be int
-    arg_b = mem.MEMORY.get(arg_ptr, mem.MEMORY.get_type_size("int"))
-    arg_v = typ.bytes_to_int(arg_b)
-    return l_ptr + arg_v * unit_length, unit_length
+    arg_v = memory.get_int(arg_ptr)
+    ptr = l_ptr + arg_v * unit_length
+    memory.check_access(ptr, unit_length)
+    return ptr, unit_length
 
 
 def index_node_depth(node: ast.IndexingNode):
@@ -586,8 +841,7 @@ def index_node_depth(node: ast.IndexingNode):
 
 def get_array_len_of_node(node: ast.IndexingNode, env: en.Environment) -> int:
     arr_len_ptr = evaluate(node.arg, env)
-    arr_len_b = mem.MEMORY.get(arr_len_ptr, mem.MEMORY.get_type_size("int"))
-    return typ.bytes_to_int(arr_len_b)
+    return env.memory.get_int(arr_len_ptr)
 
 
 def fill_array(ptr, type_length: int, array: list):
@@ -600,25 +854,24 @@ def assignment():
 
 ADD_SET = {
     "int": {
-        "int": typ.int_add_int,
-        "float": typ.int_add_float
+        "int": operator.add,
+        "float": typ.int_add_float_value
     },
     "float": {
-        "int": typ.float_add_int
+        "int": operator.add
     }
 }
 
 SUB_SET = {
     "int": {
-        "int": typ.int_sub_int,
-        "float": typ.int_sub_float
+        "int": operator.sub,
+        "float": typ.int_sub_float_value
     }
 }
 
 MUL_SET = {
     "int": {
-        "int": typ.int_mul_int,
-        "float": None
+        "int": operator.mul
     }
 }
 
@@ -643,63 +896,57 @@ def eval_subtraction(left_ptr: int, left_tal: en.Type, right_ptr: int, right_tal
 
 def basic_arithmetic(op_set: dict, left_ptr: int, left_tal: en.Type, right_ptr: int, right_tal: en.Type,
                      env: en.Environment) -> int:
-    if left_tal.type_name in op_set:
-        left_len = left_tal.total_len()
-        lv = mem.MEMORY.get(left_ptr, left_len)
-        # print(right_ptr)
-        return int_op_any(lv, right_ptr, right_tal, op_set[left_tal.type_name])
-    elif left_tal.type_name[0] == "*":
-        ptr_len = mem.MEMORY.pointer_length
-        lv = mem.MEMORY.get(left_ptr, ptr_len)
-        return int_op_any(lv, right_ptr, right_tal, op_set["int"])
+    memory = env.memory
+    l_name, res = arithmetic_value(memory, op_set, left_ptr, left_tal, right_ptr, right_tal)
+    if l_name == "float":
+        return memory.allocate_float(res)
+    return memory.allocate_int(res)
+
+
+def arithmetic_value(memory: mem.Memory, op_set: dict, left_ptr: int, left_tal: en.Type, right_ptr: int,
+                     right_tal: en.Type):
+    """
+    Computes the value of an arithmetic operation, pointers are operated as ints.
+
+    :return: the type name of the result, which is the type of the left operand, and the value
+    """
+    l_name = "int" if left_tal.type_name[0] == "*" else left_tal.type_name
+    r_name = "int" if right_tal.type_name[0] == "*" else right_tal.type_name
+    if l_name not in op_set:
+        raise lib.TypeException("Cannot operates {}".format(en.type_to_readable(left_tal)))
+    op_funcs = op_set[l_name]
+    if r_name not in op_funcs:
+        raise lib.TypeException("Cannot operates {} with {}".format(l_name, en.type_to_readable(right_tal)))
+    lv = get_primitive_value(memory, left_ptr, l_name)
+    rv = get_primitive_value(memory, right_ptr, r_name)
+    return l_name, op_funcs[r_name](lv, rv)
+
+
+def get_primitive_value(memory: mem.Memory, ptr: int, type_name: str):
+    """ Reads the value of primitive type <type_name> at <ptr>, chars are read as their codes. """
+    if type_name == "int":
+        return memory.get_int(ptr)
+    elif type_name == "float":
+        return memory.get_float(ptr)
+    elif type_name == "char":
+        return memory.get_char(ptr)
+    elif type_name == "boolean":
+        return memory.get_bool(ptr)
     else:
-        raise lib.TypeException("Cannot operates {}".format(en.type_to_readable(right_tal)))
-
-
-def int_op_any(lv: bytes, right_ptr: int, right_tal: en.Type, op_set: dict) -> int:
-    if right_tal.type_name in op_set:
-        rv = mem.MEMORY.get(right_ptr, right_tal.total_len())
-        op_func = op_set[right_tal.type_name]
-        res = op_func(lv, rv)
-        return mem.MEMORY.allocate(res)
-    elif right_tal.type_name[0] == "*":
-        rv = mem.MEMORY.get(right_ptr, PTR_LEN)
-        op_func = op_set["int"]
-        res = op_func(lv, rv)
-        return mem.MEMORY.allocate(res)
-    else:
-        raise lib.TypeException("Cannot operates int with {}".format(en.type_to_readable(right_tal)))
-
-
-def primitive_comparison(cmp_func, ) -> int:
-    pass
+        return memory.get_ptr(ptr)
 
 
 def eval_comparison(cmp_func, lp, l_tal: en.Type, rp, r_tal: en.Type, env) -> int:
+    memory = env.memory
     if l_tal.type_name in PRIMITIVE_TYPES and r_tal.type_name in PRIMITIVE_TYPES and not en.is_array(l_tal) and \
             not en.is_array(r_tal):
-        l_len = PRIMITIVE_TYPES[l_tal.type_name]
-        r_len = PRIMITIVE_TYPES[r_tal.type_name]
-        lb = mem.MEMORY.get(lp, l_len)
-        rb = mem.MEMORY.get(rp, r_len)
-
-        if l_tal.type_name == "int":
-            if r_tal.type_name == "int":
-                cmp = typ.int_cmp_int(lb, rb)
-                return cmp_func(cmp)
-        elif l_tal.type_name == "char":
-            if r_tal.type_name == "char":
-                cmp = typ.char_cmp_char(lb, rb)
-                return cmp_func(cmp)
+        lv = get_primitive_value(memory, lp, l_tal.type_name)
+        rv = get_primitive_value(memory, rp, r_tal.type_name)
+        return get_bool_ptr(memory, cmp_func(lv - rv))
     elif l_tal.type_name[0] == "*":
-        l_ptr_b = mem.MEMORY.get(lp, l_tal.total_len())
-        # l_ptr = typ.bytes_to_int(l_ptr_b)
         if r_tal.type_name[0] == "*":
-            r_ptr_b = mem.MEMORY.get(rp, r_tal.total_len())
-            # r_ptr = typ.bytes_to_int(r_ptr_b)
-            # print(l_ptr_b ,r_ptr_b)
-            cmp = typ.int_cmp_int(l_ptr_b, r_ptr_b)
-            return cmp_func(cmp)
+            cmp = memory.get_ptr(lp) - memory.get_ptr(rp)
+            return get_bool_ptr(memory, cmp_func(cmp))
         else:
             raise lib.TypeException("Comparing pointer type '{}' to primitive type '{}'"
                                     .format(en.type_to_readable(l_tal), en.type_to_readable(r_tal)))
@@ -715,21 +962,22 @@ BINARY_OP_TABLE = {
 }
 
 
-def get_bool_ptr(v: bool) -> int:
-    return mem.MEMORY.get_literal_ptr(1) if v else mem.MEMORY.get_literal_ptr(0)
+def get_bool_ptr(memory: mem.Memory, v: bool) -> int:
+    return memory.get_literal_ptr(1) if v else memory.get_literal_ptr(0)
 
 
 COMPARE_TABLE = {
-    "<": lambda v: get_bool_ptr(v < 0),
-    ">": lambda v: get_bool_ptr(v > 0),
-    "==": lambda v: get_bool_ptr(v == 0),
-    "!=": lambda v: get_bool_ptr(v != 0),
-    "<=": lambda v: get_bool_ptr(v <= 0),
-    ">=": lambda v: get_bool_ptr(v >= 0)
+    "<": lambda v: v < 0,
+    ">": lambda v: v > 0,
+    "==": lambda v: v == 0,
+    "!=": lambda v: v != 0,
+    "<=": lambda v: v <= 0,
+    ">=": lambda v: v >= 0
 }
 
 
 def eval_binary_operation(node: ast.BinaryOperator, env: en.Environment):
+    memory = env.memory
     if node.assignment and node.operation[:-1] in BINARY_OP_TABLE:
         left = evaluate(node.left, env)
         right = evaluate(node.right, env)
@@ -738,8 +986,11 @@ def eval_binary_operation(node: ast.BinaryOperator, env: en.Environment):
         rtl = get_tal_of_evaluated_node(node.right, env)
 
         op_type = BINARY_OP_TABLE[node.operation[:-1]]
-        res = basic_arithmetic(op_type, left, ltl, right, rtl, env)
-        mem.MEMORY.mem_copy(res, left, ltl.total_len())
+        l_name, res = arithmetic_value(memory, op_type, left, ltl, right, rtl)
+        if l_name == "float":
+            memory.set_float(left, res)
+        else:
+            memory.set_int(left, res)
         return left
     elif node.operation in BINARY_OP_TABLE:
         left = evaluate(node.left, env)
@@ -767,24 +1018,22 @@ def eval_binary_operation(node: ast.BinaryOperator, env: en.Environment):
 
 
 def eval_unpack(vp: int, v_tal: en.Type, env: en.Environment):
-    vb = mem.MEMORY.get(vp, INT_LEN)
-    v = typ.bytes_to_int(vb)
+    memory = env.memory
+    v = memory.get_ptr(vp)
+    memory.check_access(v, memory.get_type_size(v_tal.type_name[1:]))
     # orig_type_name = v_tal[0][1:]  # for example, *int to int, or **int to *int
-    # # rb = mem.MEMORY.get(v, mem.MEMORY.get_type_size(orig_type_name) * v_tal[1])
+    # # rb = memory.get(v, memory.get_type_size(orig_type_name) * v_tal[1])
     return v
 
 
 def eval_pack(vp: int, v_tal: en.Type, env: en.Environment):
-    b = typ.int_to_bytes(vp)
-    return mem.MEMORY.allocate(b)
+    return env.memory.allocate_int(vp)
 
 
 def eval_neg(vp: int, v_tal: en.Type, env: en.Environment):
+    memory = env.memory
     if v_tal.type_name == "int":
-        int_len = mem.MEMORY.get_type_size("int")
-        v = mem.MEMORY.get(vp, int_len)
-        res = typ.int_neg(v)
-        return mem.MEMORY.allocate(res)
+        return memory.allocate_int(-memory.get_int(vp))
 
 
 UNARY_OP_TABLE = {
@@ -803,6 +1052,7 @@ def eval_unary_operation(node: ast.UnaryOperator, env: en.Environment):
 
 
 def eval_struct_node(node: ast.StructNode, env: en.Environment):
+    memory = env.memory
     struct = Struct(node.name)
     pos = 0
     for line in node.block.lines:
@@ -810,9 +1060,9 @@ def eval_struct_node(node: ast.StructNode, env: en.Environment):
         tal = get_tal_of_defining_node(type_node.right, env)
         name: str = type_node.left.name
         struct.vars[name] = pos, tal
-        total_len = tal.total_len()
+        total_len = tal.total_len(memory)
         pos += total_len
-    mem.MEMORY.add_type(node.name, pos)
+    memory.add_type(node.name, pos)
     env.add_struct(node.name, struct)
 
 
@@ -826,7 +1076,7 @@ def eval_dot(node: ast.Dot, env: en.Environment):
 
 
 def eval_literal(node: ast.Literal, env: en.Environment):
-    return mem.MEMORY.get_literal_ptr(node.lit_pos)
+    return env.memory.get_literal_ptr(node.lit_pos)
 
 
 def eval_string_literal(node: ast.StringLiteralNode, env: en.Environment):
@@ -845,19 +1095,20 @@ def eval_if_stmt(node: ast.IfStmt, env: en.Environment):
     scope = en.BlockEnvironment(env)
     if boolean:
         res = evaluate(node.then_block, scope)
-    else:
+    elif node.else_block is not None:
         res = evaluate(node.else_block, scope)
+    else:
+        res = None
     return res
 
 
 def eval_boolean(node: ast.Node, env: en.Environment) -> bool:
     p = evaluate(node, env)
-    b = mem.MEMORY.get(p, mem.MEMORY.get_type_size("boolean"))
-    # print(b)
-    return bool(b[0])
+    return env.memory.get_bool(p)
 
 
 def eval_for_loop(node: ast.ForLoopStmt, env: en.Environment):
+    memory = env.memory
     title_scope = en.LoopEnvironment(env)
     block_scope = en.BlockEnvironment(title_scope)
 
@@ -868,34 +1119,44 @@ def eval_for_loop(node: ast.ForLoopStmt, env: en.Environment):
     evaluate(start, title_scope)
     if step.node_type == ast.IN_DECREMENT_OPERATOR and not step.is_post:
         while not title_scope.is_stopped() and eval_boolean(stop, title_scope):
-            mem.MEMORY.push_stack()
+            memory.push_stack()
             block_scope.invalidate()
             evaluate(step, title_scope)
             evaluate(node.body, block_scope)
+            if env.is_terminated():  # keeps the returned value until the function returns
+                memory.keep_stack()
+                break
             title_scope.resume_loop()
-            mem.MEMORY.restore_stack()
+            memory.restore_stack()
     else:
         while not title_scope.is_stopped() and eval_boolean(stop, title_scope):
-            mem.MEMORY.push_stack()
+            memory.push_stack()
             block_scope.invalidate()
             evaluate(node.body, block_scope)
+            if env.is_terminated():
+                memory.keep_stack()
+                break
             evaluate(step, title_scope)
             title_scope.resume_loop()
-            mem.MEMORY.restore_stack()
+            memory.restore_stack()
 
 
 def eval_while_loop(node: ast.WhileStmt, env: en.Environment):
+    memory = env.memory
     title_scope = en.LoopEnvironment(env)
     block_scope = en.BlockEnvironment(title_scope)
 
     cond = node.condition
 
     while not title_scope.is_stopped() and eval_boolean(cond, title_scope):
-        mem.MEMORY.push_stack()
+        memory.push_stack()
         block_scope.invalidate()
         evaluate(node.body, block_scope)
+        if env.is_terminated():
+            memory.keep_stack()
+            break
         title_scope.resume_loop()
-        mem.MEMORY.restore_stack()
+        memory.restore_stack()
 
 
 INCREMENT_TABLE = {
@@ -908,9 +1169,10 @@ DECREMENT_TABLE = {
 
 
 def eval_in_decrement(node: ast.InDecrementOperator, env: en.Environment):
+    memory = env.memory
     ptr = evaluate(node.value, env)
     tal = get_tal_of_evaluated_node(node, env)
-    b = mem.MEMORY.get(ptr, tal.total_len())
+    b = memory.get(ptr, tal.total_len(memory))
     if node.operation == "++" and tal.type_name in INCREMENT_TABLE:
         tup = INCREMENT_TABLE[tal.type_name]
 
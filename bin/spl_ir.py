@@ -0,0 +1,749 @@
+import operator
+import bin.spl_analyzer as ana
+import bin.spl_ast as ast
+import bin.spl_bytecode as bc
+import bin.spl_closures as clo
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_memory as mem
+import bin.spl_transpiler as tr
+
+# kinds of the result of a lowered expression, besides the name of the class of a value, see bc.ADDRESS
+ADDRESS = bc.ADDRESS  # the value is the address of the bytes of the result
+VOID = bc.VOID  # there is no value
+
+# operations whose result only depends on their operands, with the function computing it from the operand values,
+# or None if the function is the attribute of the instruction
+FOLDABLE = {
+    "add": operator.add, "sub": operator.sub, "mul": operator.mul, "neg": operator.neg,
+    "lt": operator.lt, "le": operator.le, "gt": operator.gt, "ge": operator.ge, "eq": operator.eq, "ne": operator.ne,
+    "arith": None,  # the arithmetic function of the operand types, see clo.arithmetic_function
+    "fcmp": None  # the function of the difference of the operands, see itp.COMPARE_TABLE
+}
+
+# operations which have no effect besides their result, so that they are removed if their result is not used
+PURE = set(FOLDABLE) | {"addr"}
+
+COMMUTATIVE = {"add", "mul", "eq", "ne"}
+
+INT_OPS = {operator.add: "add", operator.sub: "sub", operator.mul: "mul"}
+
+COMPARE_OPS = {"<": "lt", "<=": "le", ">": "gt", ">=": "ge", "==": "eq", "!=": "ne"}
+
+DEFAULT_VALUES = {"int": 0, "float": 0.0, "char": 0, "boolean": False}
+
+
+class Const:
+    """ A constant operand. """
+
+    def __init__(self, value):
+        self.value = value
+
+    def key(self):
+        """ Returns a key which is equal for the constants of equal values of the same Python type. """
+        return type(self.value), self.value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Instr:
+    """
+    An instruction of three-address code, which is also the SSA value of its result.
+
+    Operations and their operands:
+        add, sub, mul, neg, lt, le, gt, ge, eq, ne   the Python operation of int operands
+        arith           attr is the arithmetic function of the values of args
+        fcmp            attr is the function of the difference of the args, for operands that are floats
+        addr            attr is an offset in the frame, the result is its address
+        param           attr is the index of a parameter held by the instruction
+        rtn             the location where a struct or an array returned by the function is copied
+        phi             args are the values the variable has at the end of each predecessor of the block
+        load            attr is the value class, args are the address
+        store           attr is the value class, args are the address and the value
+        copy            attr is a length, args are the source and the destination address
+        check           attr is a length, args are a pointer whose access is checked
+        call            attr is a Function, args are the location of a returned struct and the args
+        native          attr is (NativeFunction, class of each arg or None for an address), args like 'call'
+        native_nodes    attr is (NativeFunction, arg nodes, (name, Type, class) of each variable), args are the
+                        location of a returned struct and the values, or addresses if the class is None, of variables
+        jump            attr is the target Block
+        branch          attr is (Block if true, Block if false), args are the condition
+        return          args are the returned value, or nothing
+        missing         raises the error of a function which ends without returning
+    """
+
+    def __init__(self, op: str, args: list, attr=None, cls=None):
+        self.op = op
+        self.args = args
+        self.attr = attr
+        self.cls = cls  # the value class of the result, where addresses are ints, or None if there is no result
+        self.block = None
+
+
+class Block:
+    """ A basic block, its last instruction is a terminator, which is 'jump', 'branch', 'return' or 'missing'. """
+
+    def __init__(self, number: int):
+        self.number = number
+        self.phis = []
+        self.instrs = []
+        self.preds = []  # the predecessors, in the order of the args of the phis
+
+    def successors(self) -> list:
+        if not self.instrs:
+            return []
+        terminator = self.instrs[-1]
+        if terminator.op == "jump":
+            return [terminator.attr]
+        if terminator.op == "branch":
+            return list(terminator.attr)
+        return []
+
+    def remove_pred(self, pred):
+        """ Removes the edge from <pred>, with the args of the phis of it. """
+        index = self.preds.index(pred)
+        del self.preds[index]
+        for phi in self.phis:
+            del phi.args[index]
+
+
+class IRFunction:
+    """ The SSA form of a function, in basic blocks. """
+
+    def __init__(self, func: itp.Function, name: str, function_names: dict):
+        self.func = func
+        self.name = name
+        self.function_names = function_names  # Function: name, of the called functions
+        self.blocks = []  # the entry block first
+        self.params = []  # the 'param' Instr of each parameter held by an instruction, or its offset in the frame
+        self.rtn = None  # the 'rtn' Instr if the function returns a struct or an array
+        self.frame_size = 0
+
+    def entry(self) -> Block:
+        return self.blocks[0]
+
+    def __str__(self):
+        names = {}
+        for block in self.blocks:
+            for instr in block.phis + block.instrs:
+                if instr.cls is not None:
+                    names[instr] = "v{}".format(len(names))
+        lines = ["fn {}({}) {}, frame {}".format(
+            self.name, ", ".join(en.type_to_readable(param.tal) for param in self.func.params),
+            en.type_to_readable(self.func.r_tal), self.frame_size)]
+        for block in self.blocks:
+            lines.append("  b{}:{}".format(block.number, "" if not block.preds else "  ; from " + ", ".join(
+                "b{}".format(pred.number) for pred in block.preds)))
+            for instr in block.phis + block.instrs:
+                lines.append("    " + instr_text(instr, names, self.function_names))
+        return "\n".join(lines)
+
+
+class Variable:
+    """ A variable of a function held by SSA values instead of memory, whose address is never taken. """
+
+    def __init__(self, name: str, cls: str):
+        self.name = name
+        self.cls = cls
+
+
+class Builder:
+    """
+    Lowers analyzed functions to SSA form.
+
+    A function is lowered by the same rules as spl_bytecode.Compiler compiles it, so it is lowered only if it runs
+    exactly like the tree walker. Variables of primitive types and pointers whose address is never taken are SSA
+    values, see tr.pinned_names, other variables are stored in a frame in memory, and are accessed by 'load' and
+    'store' instructions. The SSA form is built while lowering, by looking up the definitions of a variable in the
+    predecessors of a block, where a block whose predecessors are not all known gets a phi, which is completed when
+    the block is sealed. The phis that turn out to have a single value are left to the optimizer.
+    """
+
+    def __init__(self, global_env: en.GlobalEnvironment):
+        self.global_env = global_env
+        self.memory = global_env.memory
+        self.analyzer = ana.Analyzer(global_env)
+        # accesses to computed pointers are only checked by an unchecked memory, see Memory.check_access
+        self.checks = type(self.memory).check_access is not mem.Memory.check_access
+        self.names = {}  # Function: name
+        for name, func_group in global_env.functions.items():
+            for func in func_group.values():
+                if isinstance(func, itp.Function):
+                    self.names[func] = name
+        # the function being lowered
+        self.ir = None
+        self.block = None  # the current block, or None after a terminator
+        self.pinned = set()
+        self.definitions = {}  # Variable: {Block: value}
+        self.incomplete = {}  # Block: [(Variable, phi)] of the blocks which are not sealed
+        self.sealed = set()
+
+    def lower(self, func: itp.Function):
+        """ Returns the IRFunction of <func>, or None if it must be run by the tree walker. """
+        self.ir = IRFunction(func, self.names.get(func, "?"), self.names)
+        self.pinned = tr.pinned_names(func.body, self.global_env)
+        self.definitions = {}
+        self.incomplete = {}
+        self.sealed = set()
+        try:
+            self._lower(func)
+        except (bc.NotCompilable,) + ana.UNRESOLVED_ERRORS:
+            return None
+        finally:
+            ir = self.ir
+            self.ir = None
+            self.block = None
+        return ir
+
+    def _lower(self, func: itp.Function):
+        ir = self.ir
+        self.block = self.new_block()
+        self.seal(self.block)
+        scope = bc.Scope(None)
+        rtn_len = func.r_tal.total_len(self.memory)
+        if rtn_len > 0 and bc.value_class(func.r_tal) is None:
+            ir.rtn = self.emit("rtn", [], cls="int")
+        for i, param in enumerate(func.params):
+            place = self.declare(param.name, param.tal, scope)
+            if isinstance(place, Variable):
+                value = self.emit("param", [], i, place.cls)
+                self.write_variable(place, value)
+                ir.params.append(value)
+            else:
+                ir.params.append(place)
+        if rtn_len > 0 and not bc.ends_with_return(func.body):
+            raise bc.NotCompilable()  # the function returns the value of its last statement
+        self.statement(func.body, scope)
+        if self.block is not None:
+            self.terminate("return" if rtn_len == 0 else "missing", [])
+
+    def new_block(self) -> Block:
+        block = Block(len(self.ir.blocks))
+        self.ir.blocks.append(block)
+        return block
+
+    def emit(self, op: str, args: list, attr=None, cls=None) -> Instr:
+        instr = Instr(op, args, attr, cls)
+        instr.block = self.block
+        self.block.instrs.append(instr)
+        return instr
+
+    def terminate(self, op: str, args: list, attr=None):
+        """ Ends the current block by a terminator, code after it is not reached until the next block. """
+        self.emit(op, args, attr)
+        for successor in self.block.successors():
+            successor.preds.append(self.block)
+        self.block = None
+
+    def jump(self, target: Block):
+        if self.block is not None:
+            self.terminate("jump", [], target)
+
+    def reserve(self, length: int) -> int:
+        offset = self.ir.frame_size
+        self.ir.frame_size += length
+        return offset
+
+    def declare(self, name: str, tal: en.Type, scope: bc.Scope):
+        """ Declares a variable, and returns its Variable, or its frame offset if it is in memory. """
+        if scope.lookup(name) is not None or self.global_env.contains_ptr(name):
+            raise bc.NotCompilable()  # defining the name raises an error
+        cls = bc.value_class(tal)
+        if cls is not None and name not in self.pinned:
+            place = Variable(name, cls)
+            self.definitions[place] = {}
+        else:
+            place = self.reserve(tal.total_len(self.memory))
+        scope.slots[name] = place, tal
+        return place
+
+    # SSA construction
+
+    def write_variable(self, var: Variable, value, block: Block = None):
+        self.definitions[var][self.block if block is None else block] = value
+
+    def read_variable(self, var: Variable, block: Block = None):
+        if block is None:
+            block = self.block
+        definitions = self.definitions[var]
+        if block in definitions:
+            return definitions[block]
+        if block not in self.sealed:
+            value = self.new_phi(var, block)
+            self.incomplete.setdefault(block, []).append((var, value))
+        elif len(block.preds) == 1:
+            value = self.read_variable(var, block.preds[0])
+        elif not block.preds:
+            raise bc.NotCompilable()  # the variable is read before it is defined
+        else:
+            value = self.new_phi(var, block)
+            definitions[block] = value  # a loop through the block ends at the phi
+            value.args = [self.read_variable(var, pred) for pred in block.preds]
+        definitions[block] = value
+        return value
+
+    def new_phi(self, var: Variable, block: Block) -> Instr:
+        phi = Instr("phi", [], cls=var.cls)
+        phi.block = block
+        block.phis.append(phi)
+        return phi
+
+    def seal(self, block: Block):
+        """ Marks that all predecessors of <block> are known, and completes its phis. """
+        self.sealed.add(block)
+        for var, phi in self.incomplete.pop(block, ()):
+            phi.args = [self.read_variable(var, pred) for pred in block.preds]
+
+    # statements
+
+    def statement(self, node: ast.Node, scope: bc.Scope):
+        if self.block is None:
+            return  # after a 'return' statement
+        node_type = node.node_type
+        if node_type == ast.BLOCK_STMT:
+            for line in node.lines:
+                self.statement(line, scope)
+        elif node_type == ast.ASSIGNMENT_NODE:
+            self.assignment(node, scope)
+        elif node_type == ast.IF_STMT:
+            self.if_statement(node, scope)
+        elif node_type == ast.FOR_LOOP_STMT:
+            title_scope = bc.Scope(scope)
+            start, stop, step = node.condition.lines
+            step_first = step.node_type == ast.IN_DECREMENT_OPERATOR and not step.is_post
+            self.statement(start, title_scope)
+            self.loop(stop, title_scope, lambda: self.for_body(node.body, step, step_first, title_scope))
+        elif node_type == ast.WHILE_STMT:
+            title_scope = bc.Scope(scope)
+            self.loop(node.condition, title_scope, lambda: self.statement(node.body, bc.Scope(title_scope)))
+        elif node_type == ast.RETURN_STMT:
+            self.return_statement(node, scope)
+        elif node_type == ast.BINARY_OPERATOR and node.assignment:
+            self.arithmetic_assignment(node, scope)
+        else:
+            self.expression(node, scope)
+
+    def if_statement(self, node: ast.IfStmt, scope: bc.Scope):
+        condition = self.operand(node.condition, scope, "boolean")
+        then_block = self.new_block()
+        end_block = self.new_block()
+        else_block = end_block if node.else_block is None else self.new_block()
+        self.terminate("branch", [condition], (then_block, else_block))
+        self.seal(then_block)
+        self.block = then_block
+        self.statement(node.then_block, bc.Scope(scope))
+        self.jump(end_block)
+        if node.else_block is not None:
+            self.seal(else_block)
+            self.block = else_block
+            self.statement(node.else_block, bc.Scope(scope))
+            self.jump(end_block)
+        self.seal(end_block)
+        self.block = end_block if end_block.preds else None
+
+    def loop(self, condition: ast.Node, title_scope: bc.Scope, body):
+        """ Lowers a loop which runs <body> while <condition> is true. """
+        header = self.new_block()
+        self.jump(header)
+        self.block = header
+        value = self.operand(condition, title_scope, "boolean")
+        body_block = self.new_block()
+        end_block = self.new_block()
+        self.terminate("branch", [value], (body_block, end_block))
+        self.seal(body_block)
+        self.block = body_block
+        body()
+        self.jump(header)
+        self.seal(header)
+        self.seal(end_block)
+        self.block = end_block
+
+    def for_body(self, body: ast.Node, step: ast.Node, step_first: bool, title_scope: bc.Scope):
+        if step_first:
+            self.statement(step, title_scope)
+        self.statement(body, bc.Scope(title_scope))
+        if not step_first:
+            self.statement(step, title_scope)
+
+    def return_statement(self, node: ast.ReturnStmt, scope: bc.Scope):
+        if node.value is None:
+            raise bc.NotCompilable()
+        r_tal = self.ir.func.r_tal
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            self.expression(node.value, scope)
+            self.terminate("return", [])
+            return
+        cls = bc.value_class(r_tal)
+        value = self.operand(node.value, scope, cls)
+        if cls is None:
+            self.emit("copy", [value, self.ir.rtn], rtn_len)
+            value = self.ir.rtn
+        self.terminate("return", [value])
+
+    def assignment(self, node: ast.AssignmentNode, scope: bc.Scope):
+        left = node.left
+        left_type = left.node_type
+        if node.level == ast.FUNC_DEFINE:
+            raise bc.NotCompilable()
+        if left_type == ast.TYPE_NODE:
+            self.declaration(node, scope)
+        elif left_type == ast.NAME_NODE:
+            slot = scope.lookup(left.name)
+            if slot is None:
+                if left.name not in self.global_env.variables:
+                    raise bc.NotCompilable()
+                tal = self.global_env.var_types[left.name]
+                self.store(node.right, scope, tal, lambda: Const(self.global_env.variables[left.name]))
+            else:
+                self.store_local(self.operand(node.right, scope, bc.value_class(slot[1])), *slot)
+        elif left_type == ast.DOT:
+            struct = self.global_env.get_struct(left.left.tal.type_name)
+            attr_tal = struct.get_attr_tal(left.right.name)
+            self.store(node.right, scope, attr_tal, lambda: self.address(left, scope))
+        elif left_type == ast.INDEXING_NODE:
+            unit_length = self.indexing_unit(left)
+            if unit_length != left.tal.total_len(self.memory):
+                raise bc.NotCompilable()  # the element is copied as another type
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope))
+        elif left_type == ast.UNARY_OPERATOR and left.operation == "unpack":
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope))
+        else:
+            raise bc.NotCompilable()
+
+    def declaration(self, node: ast.AssignmentNode, scope: bc.Scope):
+        if node.level != ast.VAR and node.level != ast.CONST:
+            raise bc.NotCompilable()
+        type_node: ast.TypeNode = node.left
+        tal = self.analyzer.defining_type(type_node.right, self.global_env)
+        if tal is not None and tal.total_len(self.memory) == 0:  # array with undefined length
+            tal = node.right.tal
+        if tal is None:
+            raise bc.NotCompilable()
+        if node.right.node_type == ast.UNDEFINED_NODE:
+            place = self.declare(type_node.left.name, tal, scope)
+            if isinstance(place, Variable):
+                self.write_variable(place, Const(DEFAULT_VALUES[place.cls]))
+            return
+        value = self.operand(node.right, scope, bc.value_class(tal))
+        place = self.declare(type_node.left.name, tal, scope)
+        self.store_local(value, place, tal)
+
+    def store_local(self, value, place, tal: en.Type):
+        """ Writes <value> to the variable at <place>, see self.declare. """
+        if isinstance(place, Variable):
+            self.write_variable(place, value)
+        else:
+            self.write(value, self.emit("addr", [], place, "int"), tal)
+
+    def store(self, right: ast.Node, scope: bc.Scope, tal: en.Type, address):
+        """ Lowers writing <right> as <tal>, the address written is lowered by <address> after <right>. """
+        value = self.operand(right, scope, bc.value_class(tal))
+        self.write(value, address(), tal)
+
+    def write(self, value, address, tal: en.Type):
+        cls = bc.value_class(tal)
+        if cls is None:
+            self.emit("copy", [value, address], tal.total_len(self.memory))
+        else:
+            self.emit("store", [address, value], cls)
+
+    def arithmetic_assignment(self, node: ast.BinaryOperator, scope: bc.Scope):
+        op_set = itp.BINARY_OP_TABLE.get(node.operation[:-1])
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if op_set is None or l_tal is None or r_tal is None:
+            raise bc.NotCompilable()
+        func = clo.arithmetic_function(op_set, l_tal, r_tal)
+        if func is None:
+            raise bc.NotCompilable()
+        l_name = clo.arithmetic_name(l_tal)
+        r_name = clo.arithmetic_name(r_tal)
+        slot = scope.lookup(node.left.name) if node.left.node_type == ast.NAME_NODE else None
+        if slot is not None and isinstance(slot[0], Variable):
+            value = self.operand(node.right, scope, r_name)
+            self.write_variable(slot[0], self.operation(func, l_name, r_name, self.read_variable(slot[0]), value))
+            return
+        address = self.address(node.left, scope)
+        value = self.operand(node.right, scope, r_name)
+        result = self.operation(func, l_name, r_name, self.emit("load", [address], l_name, l_name), value)
+        self.emit("store", [address, result], result.cls)
+
+    # expressions
+
+    def operation(self, func, l_name: str, r_name: str, left, right) -> Instr:
+        """ Lowers the arithmetic function <func> of the values <left> and <right> of the classes. """
+        cls = "float" if l_name == "float" else "int"
+        if l_name == "int" and r_name == "int" and func in INT_OPS:
+            return self.emit(INT_OPS[func], [left, right], cls=cls)
+        return self.emit("arith", [left, right], func, cls)
+
+    def operand(self, node: ast.Node, scope: bc.Scope, cls):
+        """ Lowers the value of <node> as a value of class <cls>, or its address if <cls> is None. """
+        if cls is None:
+            return self.address(node, scope)
+        value, kind = self.expression(node, scope)
+        if kind == ADDRESS:
+            return self.emit("load", [value], cls, cls)
+        elif kind != cls:
+            raise bc.NotCompilable()  # the tree walker reads the bytes of the value as another type
+        return value
+
+    def address(self, node: ast.Node, scope: bc.Scope):
+        """ Lowers the address of the value of <node>, like evaluating it in the tree walker. """
+        if node.node_type == ast.NAME_NODE:
+            slot = scope.lookup(node.name)
+            if slot is not None:
+                if isinstance(slot[0], Variable):
+                    raise bc.NotCompilable()
+                return self.emit("addr", [], slot[0], "int")
+            elif node.name in self.global_env.variables:
+                return Const(self.global_env.variables[node.name])
+            raise bc.NotCompilable()
+        value, kind = self.expression(node, scope)
+        if kind != ADDRESS:
+            raise bc.NotCompilable()
+        return value
+
+    def expression(self, node: ast.Node, scope: bc.Scope):
+        """ Lowers <node>, and returns the value of its result and its kind. """
+        node_type = node.node_type
+        if node_type == ast.LITERAL:
+            return self.literal(node)
+        elif node_type == ast.STRING_LITERAL:
+            return Const(self.memory.get_literal_ptr(node.literal.lit_pos)), ADDRESS
+        elif node_type == ast.NULL_STMT:
+            return Const(0), "int"
+        elif node_type == ast.NAME_NODE:
+            return self.name(node, scope)
+        elif node_type == ast.BINARY_OPERATOR:
+            return self.binary_operation(node, scope)
+        elif node_type == ast.UNARY_OPERATOR:
+            return self.unary_operation(node, scope)
+        elif node_type == ast.DOT:
+            struct = self.global_env.get_struct(node.left.tal.type_name)
+            address = self.address(node.left, scope)
+            offset = struct.get_attr_pos(node.right.name)
+            if offset != 0:
+                address = self.emit("add", [address, Const(offset)], cls="int")
+            return address, ADDRESS
+        elif node_type == ast.INDEXING_NODE:
+            return self.indexing(node, scope), ADDRESS
+        elif node_type == ast.FUNCTION_CALL:
+            return self.call(node, scope)
+        elif node_type == ast.BLOCK_STMT and len(node.lines) == 1:  # a condition or an index
+            return self.expression(node.lines[0], scope)
+        raise bc.NotCompilable()
+
+    def literal(self, node: ast.Literal):
+        memory = self.memory
+        ptr = memory.get_literal_ptr(node.lit_pos)
+        if node.lit_type == 0:
+            return Const(memory.get_int(ptr)), "int"
+        elif node.lit_type == 1:
+            return Const(memory.get_float(ptr)), "float"
+        elif node.lit_type == 2:
+            return Const(memory.get_bool(ptr)), "boolean"
+        elif node.lit_type == 4:
+            return Const(memory.get_char(ptr)), "char"
+        return Const(ptr), ADDRESS
+
+    def name(self, node: ast.NameNode, scope: bc.Scope):
+        slot = scope.lookup(node.name)
+        if slot is None:
+            if node.name not in self.global_env.variables:
+                raise bc.NotCompilable()
+            address = Const(self.global_env.variables[node.name])
+            cls = bc.value_class(self.global_env.var_types[node.name])
+        else:
+            place, tal = slot
+            cls = bc.value_class(tal)
+            if isinstance(place, Variable):
+                return self.read_variable(place), cls
+            address = self.emit("addr", [], place, "int")
+        if cls is None:
+            return address, ADDRESS
+        return self.emit("load", [address], cls, cls), cls
+
+    def binary_operation(self, node: ast.BinaryOperator, scope: bc.Scope):
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if node.assignment or l_tal is None or r_tal is None:
+            raise bc.NotCompilable()
+        if node.operation in itp.BINARY_OP_TABLE:
+            func = clo.arithmetic_function(itp.BINARY_OP_TABLE[node.operation], l_tal, r_tal)
+            if func is None:
+                raise bc.NotCompilable()
+            l_name = clo.arithmetic_name(l_tal)
+            r_name = clo.arithmetic_name(r_tal)
+            left = self.operand(node.left, scope, l_name)
+            right = self.operand(node.right, scope, r_name)
+            result = self.operation(func, l_name, r_name, left, right)
+            return result, result.cls
+        elif node.operation in itp.COMPARE_TABLE:
+            if l_tal.type_name in itp.PRIMITIVE_TYPES and r_tal.type_name in itp.PRIMITIVE_TYPES and \
+                    not en.is_array(l_tal) and not en.is_array(r_tal):
+                l_name = l_tal.type_name
+                r_name = r_tal.type_name
+            elif l_tal.type_name[0] == "*" and r_tal.type_name[0] == "*":
+                l_name = r_name = "int"
+            else:
+                raise bc.NotCompilable()
+            left = self.operand(node.left, scope, l_name)
+            right = self.operand(node.right, scope, r_name)
+            if l_name != "float" and r_name != "float":
+                return self.emit(COMPARE_OPS[node.operation], [left, right], cls="boolean"), "boolean"
+            # the tree walker compares the difference of floats
+            return self.emit("fcmp", [left, right], itp.COMPARE_TABLE[node.operation], "boolean"), "boolean"
+        raise bc.NotCompilable()
+
+    def unary_operation(self, node: ast.UnaryOperator, scope: bc.Scope):
+        tal = node.value.tal
+        if tal is None:
+            raise bc.NotCompilable()
+        if node.operation == "unpack":
+            if tal.type_name[0] != "*":
+                raise bc.NotCompilable()
+            ptr = self.operand(node.value, scope, "int")
+            if self.checks:
+                self.emit("check", [ptr], self.memory.get_type_size(tal.type_name[1:]))
+            return ptr, ADDRESS
+        elif node.operation == "pack":
+            return self.address(node.value, scope), "int"
+        elif node.operation == "neg" and tal.type_name == "int":
+            return self.emit("neg", [self.operand(node.value, scope, "int")], cls="int"), "int"
+        raise bc.NotCompilable()
+
+    def indexing_unit(self, node: ast.IndexingNode) -> int:
+        base = node
+        depth = 0
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+            depth += 1
+        l_tal = base.tal
+        if base.node_type != ast.NAME_NODE or l_tal is None:
+            raise bc.NotCompilable()
+        if en.is_array(l_tal):
+            unit_length = l_tal.total_len(self.memory)
+            for i in range(depth):
+                unit_length //= l_tal.array_lengths[i]
+            return unit_length
+        elif l_tal.type_name[0] == "*":
+            return self.memory.get_type_size(l_tal.type_name[1:])
+        raise bc.NotCompilable()
+
+    def indexing(self, node: ast.IndexingNode, scope: bc.Scope):
+        unit_length = self.indexing_unit(node)
+        base = node
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+        if en.is_array(base.tal):
+            address = self.address(node.call_obj, scope)
+        else:  # the indexed pointer
+            address = self.operand(node.call_obj, scope, "int")
+        index = self.operand(node.arg, scope, "int")
+        offset = self.emit("mul", [index, Const(unit_length)], cls="int")
+        ptr = self.emit("add", [address, offset], cls="int")
+        if self.checks:
+            self.emit("check", [ptr], unit_length)
+        return ptr
+
+    def call(self, node: ast.FuncCall, scope: bc.Scope):
+        name_node = node.call_obj
+        if name_node.node_type != ast.NAME_NODE or scope.lookup(name_node.name) is not None or \
+                self.global_env.contains_ptr(name_node.name):
+            raise bc.NotCompilable()
+        func_group = self.global_env.functions.get(name_node.name)
+        if not func_group:
+            raise bc.NotCompilable()
+        some_func = next(iter(func_group.values()))
+        if isinstance(some_func, itp.NativeFunction):
+            return self.native_call(some_func, node, scope)
+        if node.overload is None:
+            raise bc.NotCompilable()
+        func: itp.Function = func_group[node.overload]
+        kind, rtn_loc = self.returned(func.r_tal)
+        args = [rtn_loc]
+        for param, arg in zip(func.params, node.args.lines):
+            args.append(self.operand(arg, scope, bc.value_class(param.tal)))
+        return self.emit("call", args, func, result_class(kind)), kind
+
+    def native_call(self, func: itp.NativeFunction, node: ast.FuncCall, scope: bc.Scope):
+        kind, rtn_loc = self.returned(func.r_tal)
+        args = [rtn_loc]
+        if func.eval_before:
+            classes = []
+            for arg in node.args.lines:
+                value, arg_kind = self.expression(arg, scope)
+                if arg_kind == VOID:
+                    raise bc.NotCompilable()
+                args.append(value)
+                classes.append(None if arg_kind == ADDRESS else arg_kind)
+            return self.emit("native", args, (func, tuple(classes)), result_class(kind)), kind
+        variables = []
+        for var_name in sorted(tr.names_in(node.args)):
+            slot = scope.lookup(var_name)
+            if slot is None:
+                continue
+            place, tal = slot
+            if isinstance(place, Variable):
+                args.append(self.read_variable(place))
+                variables.append((var_name, tal, place.cls))
+            else:
+                args.append(self.emit("addr", [], place, "int"))
+                variables.append((var_name, tal, None))
+        attr = func, tuple(node.args.lines), tuple(variables)
+        return self.emit("native_nodes", args, attr, result_class(kind)), kind
+
+    def returned(self, r_tal: en.Type):
+        """ Returns the kind of the value returned as <r_tal>, and the location where a struct is returned. """
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            return VOID, Const(0)
+        cls = bc.value_class(r_tal)
+        if cls is None:
+            return ADDRESS, self.emit("addr", [], self.reserve(rtn_len), "int")
+        return cls, Const(0)
+
+
+def result_class(kind: str):
+    """ Returns the class of the value of an expression of <kind>, where an address is an int. """
+    if kind == VOID:
+        return None
+    return "int" if kind == ADDRESS else kind
+
+
+def instr_text(instr: Instr, names: dict, function_names: dict) -> str:
+    """ Returns the text of <instr>, where <names> has the names of the instructions with results. """
+    text = instr.op
+    attr = attr_text(instr, function_names)
+    if attr:
+        text += " " + attr
+    if instr.args:
+        text += " " + ", ".join(names.get(arg, "?") if isinstance(arg, Instr) else str(arg) for arg in instr.args)
+    if instr.cls is not None:
+        text = "{} = {}".format(names[instr], text)
+    return text
+
+
+def attr_text(instr: Instr, function_names: dict) -> str:
+    op = instr.op
+    attr = instr.attr
+    if attr is None:
+        return ""
+    if op == "jump":
+        return "b{}".format(attr.number)
+    elif op == "branch":
+        return "b{} b{}".format(attr[0].number, attr[1].number)
+    elif op == "call":
+        return function_names.get(attr, "?")
+    elif op == "native":
+        return attr[0].func.__name__
+    elif op == "native_nodes":
+        return "{}({})".format(attr[0].func.__name__, ", ".join(name for name, tal, cls in attr[2]))
+    elif op == "fcmp":
+        return next(op for op, func in itp.COMPARE_TABLE.items() if func is attr)
+    elif op == "arith":
+        return attr.__name__
+    return str(attr)
@@ -1,108 +1,689 @@
+import bisect
+import mmap
+import os
+import struct
+import bin.spl_trace as trc
+
+
 class MemoryException(Exception):
     def __init__(self, msg=""):
         Exception.__init__(self, msg)
 
 
-class Heap:
-    """ Heap.
+ALIGNMENT = 8
+SMALL_CLASS_LIMIT = 512  # blocks up to this size have one exact size class per ALIGNMENT step
+SMALL_CLASS_COUNT = SMALL_CLASS_LIMIT // ALIGNMENT
+SIZE_CLASS_COUNT = SMALL_CLASS_COUNT + 48
+
+# flags stored in the lowest bits of a heap block header
+ALLOCATED = 1
+PREV_ALLOCATED = 2
+SLAB = 4  # the block is a slot of a slab pool, not a block of the allocator
+SIZE_MASK = ~(ALIGNMENT - 1)
+
+DEFAULT_VM_SIZE = 32768
+DEFAULT_STACK_SIZE = 1024
+DEFAULT_MAX_STACK_SIZE = 1 << 20
+DEFAULT_MAX_VM_SIZE = 1 << 28
+
+BACKING_BYTEARRAY = "bytearray"
+BACKING_MMAP = "mmap"
+
+# written after the address space in a memory file: magic, vm size, stack size, literal size, int size, allocator name
+MEMORY_FILE_TRAILER = struct.Struct(">8sqqqq16s")
+MEMORY_FILE_MAGIC = b"TPLMEM01"
+
+INT_STRUCTS = {  # int size: format of ints and pointers
+    8: struct.Struct(">q"),
+    4: struct.Struct(">i")
+}
+FLOAT_STRUCT = struct.Struct("d")
+
+# copies of this length or longer go through a memoryview, which moves the bytes without an intermediate copy
+ZERO_COPY_LENGTH = 1 << 14
+
+BUDDY_MIN_ORDER = 4  # the smallest buddy block is 16 bytes, a header and an int
+BUDDY_ORDER_BITS = 6
+BUDDY_ORDER_SHIFT = 3  # the order is stored above the flag bits of a header
+
+SLAB_SLOTS = 64  # number of slots carved from one slab chunk
+SLAB_SIZE_LIMIT = SMALL_CLASS_LIMIT  # struct types up to this size are allocated from slab pools
+
+
+def align_size(length: int) -> int:
+    """ Rounds <length> up to a positive multiple of ALIGNMENT. """
+    if length <= 0:
+        return ALIGNMENT
+    return (length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def size_class(size: int) -> int:
+    """
+    Returns the index of the free list that holds blocks of <size> bytes.
+
+    Sizes up to SMALL_CLASS_LIMIT are exact classes, larger sizes are grouped by powers of two.
+    """
+    if size <= SMALL_CLASS_LIMIT:
+        return (size - 1) // ALIGNMENT
+    return SMALL_CLASS_COUNT + size.bit_length() - SMALL_CLASS_LIMIT.bit_length()
+
+
+class Allocator:
+    """
+    The policy of managing the heap space of a Memory.
+
+    An allocator owns the heap range [heap_start, heap_end) of the memory it is attached to. It may store its own
+    block headers inside this range, but must leave the bytes between a returned pointer and the requested length
+    to the user.
+    """
+
+    name = ""
+
+    def __init__(self, memory):
+        self.memory: Memory = memory
+        self.heap_start = 0
+        self.heap_end = 0
+
+    def setup(self, heap_start: int, heap_end: int):
+        """ Takes the whole range [heap_start, heap_end) as free space. """
+        raise NotImplementedError
+
+    def extend(self, heap_end: int):
+        """ Takes the range [self.heap_end, heap_end), which has just been added to the heap, as free space. """
+        raise NotImplementedError
+
+    def restore(self, heap_start: int, heap_end: int):
+        """ Rebuilds the state of this allocator from the block headers already in the range [heap_start, heap_end). """
+        raise NotImplementedError
+
+    def malloc(self, length: int) -> int:
+        """
+        Returns the pointer to a block of at least <length> bytes.
+
+        Raises a MemoryException if no free block is large enough, the memory may then extend the heap and retry.
+        """
+        raise NotImplementedError
+
+    def free(self, ptr: int):
+        """ Gives back the block returned by a previous malloc. """
+        raise NotImplementedError
+
+    def resize(self, ptr: int, length: int) -> bool:
+        """
+        Changes the block returned by a previous malloc to hold <length> bytes without moving it.
+
+        :return: False if the block cannot be resized in place, it is then left unchanged
+        """
+        return False
+
+    def block_length(self, ptr: int) -> int:
+        """ Returns the number of bytes that the block returned by a previous malloc can hold. """
+        raise NotImplementedError
+
+    def block_footprint(self, ptr: int) -> int:
+        """ Returns the number of heap bytes taken by the block returned by a previous malloc, including its header. """
+        raise NotImplementedError
+
+    def available(self) -> int:
+        """ Returns the number of free heap bytes, including the space of block headers. """
+        raise NotImplementedError
+
+    def free_blocks(self) -> list:
+        """ Returns a sorted list of (address, size) of all free heap blocks. """
+        raise NotImplementedError
+
+    def largest_free_block(self) -> int:
+        """ Returns the largest length that can currently be allocated. """
+        raise NotImplementedError
+
+    def fragmentation(self) -> float:
+        """
+        Returns the external fragmentation of the heap, 0 if all free space is in one block, and close to 1 if the
+        free space is split into many small blocks.
+        """
+        ava = self.available()
+        if ava == 0:
+            return 0.0
+        return max(0.0, 1 - self.largest_free_block() / ava)
+
+    def _read_tag(self, ptr: int) -> int:
+        return self.memory.int_struct.unpack_from(self.memory.memory, ptr)[0]
+
+    def _write_tag(self, ptr: int, tag: int):
+        self.memory.int_struct.pack_into(self.memory.memory, ptr, tag)
+
+
+class SegregatedFitAllocator(Allocator):
+    """
+    Segregated free lists of boundary tagged blocks.
+
+    Every heap block starts with a header of ALIGNMENT bytes, whose last int stores the size of the block, not
+    including the header, together with the flags ALLOCATED and PREV_ALLOCATED. A free block also stores its size
+    in its last ALIGNMENT bytes as a footer, so that the block after it can find it in constant time.
+    Padding the header to ALIGNMENT bytes keeps all sizes multiples of ALIGNMENT when ints are shorter.
+    """
+
+    name = "segregated"
+
+    def __init__(self, memory):
+        Allocator.__init__(self, memory)
+
+        # free heap blocks, segregated by size class. Each dict is an insertion ordered set of block addresses
+        self.free_lists = [{} for _ in range(SIZE_CLASS_COUNT)]
+        self.free_map = 0  # bit i is set iff free_lists[i] is not empty
+        self.heap_available = 0
+        self.heap_top = 0  # end of the last heap block
+        self.top_prev_allocated = True  # whether the last heap block is allocated
+
+    def setup(self, heap_start: int, heap_end: int):
+        self.heap_start = heap_start
+        self.heap_end = heap_end
+        self.free_lists = [{} for _ in range(SIZE_CLASS_COUNT)]
+        self.free_map = 0
+        tag_len = ALIGNMENT
+        size = (heap_end - heap_start - tag_len) // ALIGNMENT * ALIGNMENT
+        self.heap_top = heap_start + tag_len + size
+        self._make_free_block(heap_start, size)
+        self.top_prev_allocated = False
+        self.heap_available = size + tag_len
+
+    def extend(self, heap_end: int):
+        tag_len = ALIGNMENT
+        length = (heap_end - self.heap_top) // ALIGNMENT * ALIGNMENT
+        self.heap_end = heap_end
+        if length < ALIGNMENT + tag_len:
+            return
+        if self.top_prev_allocated:
+            block = self.heap_top
+            size = length - tag_len
+        else:  # grows the last free block
+            last_size = self._read_tag(self.heap_top - tag_len)
+            block = self.heap_top - tag_len - last_size
+            self._remove_block(block, last_size)
+            size = last_size + length
+        self.heap_top += length
+        self.heap_available += length
+        self._make_free_block(block, size)
+        self.top_prev_allocated = False
+
+    def restore(self, heap_start: int, heap_end: int):
+        self.heap_start = heap_start
+        self.heap_end = heap_end
+        self.free_lists = [{} for _ in range(SIZE_CLASS_COUNT)]
+        self.free_map = 0
+        self.heap_available = 0
+        tag_len = ALIGNMENT
+        block = heap_start
+        allocated = True
+        while heap_end - block >= ALIGNMENT + tag_len:
+            tag = self._read_tag(block)
+            size = tag & SIZE_MASK
+            if size <= 0 or block + tag_len + size > heap_end:
+                raise MemoryException("Corrupted heap block at {}".format(block))
+            allocated = tag & ALLOCATED
+            if not allocated:
+                self._push_block(block, size)
+                self.heap_available += size + tag_len
+            block += tag_len + size
+        self.heap_top = block
+        self.top_prev_allocated = bool(allocated)
+
+    def malloc(self, length: int) -> int:
+        tag_len = ALIGNMENT
+        size = align_size(length)
+        block = self._find_block(size)
+        size = self._block_size(block)
+        self._write_tag(block, size | ALLOCATED | PREV_ALLOCATED)
+        self._set_prev_allocated(block + tag_len + size, True)
+        self.heap_available -= size + tag_len
+        return block + tag_len
+
+    def free(self, ptr: int):
+        """
+        Frees the heap block pointed by <ptr>, and merges it with the free blocks right before and after it.
+        """
+        tag_len = ALIGNMENT
+        block = ptr - tag_len
+        tag = self._read_tag(block)
+        if not tag & ALLOCATED:
+            raise MemoryException("Pointer to {} is not allocated or already freed".format(ptr))
+        size = tag & SIZE_MASK
+        self.heap_available += size + tag_len
+
+        if not tag & PREV_ALLOCATED:
+            prev_size = self._read_tag(block - tag_len)
+            prev_block = block - tag_len - prev_size
+            self._remove_block(prev_block, prev_size)
+            size += prev_size + tag_len
+            block = prev_block
+        next_block = block + tag_len + size
+        if next_block < self.heap_top:
+            next_tag = self._read_tag(next_block)
+            if not next_tag & ALLOCATED:
+                next_size = next_tag & SIZE_MASK
+                self._remove_block(next_block, next_size)
+                size += next_size + tag_len
+
+        self._make_free_block(block, size)
+        self._set_prev_allocated(block + tag_len + size, False)
+
+    def resize(self, ptr: int, length: int) -> bool:
+        """
+        Shrinks the block by splitting off its tail, or grows it over the free block right after it.
+        """
+        tag_len = ALIGNMENT
+        block = ptr - tag_len
+        tag = self._read_tag(block)
+        size = tag & SIZE_MASK
+        new_size = align_size(length)
+        if new_size > size:
+            next_block = block + tag_len + size
+            if next_block >= self.heap_top:
+                return False
+            next_tag = self._read_tag(next_block)
+            next_size = next_tag & SIZE_MASK
+            if next_tag & ALLOCATED or size + tag_len + next_size < new_size:
+                return False
+            self._remove_block(next_block, next_size)
+            self.heap_available -= next_size + tag_len
+            size += tag_len + next_size
+            self._set_prev_allocated(block + tag_len + size, True)
+
+        remain = size - new_size - tag_len
+        if remain >= ALIGNMENT:
+            # the tail is freed as an allocated block, so that it merges with a free block after it
+            tail = block + tag_len + new_size
+            self._write_tag(tail, remain | ALLOCATED | PREV_ALLOCATED)
+            size = new_size
+            self._write_tag(block, size | ALLOCATED | tag & PREV_ALLOCATED)
+            self.free(tail + tag_len)
+        else:
+            self._write_tag(block, size | ALLOCATED | tag & PREV_ALLOCATED)
+        return True
+
+    def block_length(self, ptr: int) -> int:
+        return self._block_size(ptr - ALIGNMENT)
+
+    def block_footprint(self, ptr: int) -> int:
+        return self._block_size(ptr - ALIGNMENT) + ALIGNMENT
+
+    def available(self) -> int:
+        return self.heap_available
+
+    def free_blocks(self) -> list:
+        blocks = []
+        for free_list in self.free_lists:
+            for block in free_list:
+                blocks.append((block, self._block_size(block)))
+        blocks.sort()
+        return blocks
+
+    def largest_free_block(self) -> int:
+        if self.free_map == 0:
+            return 0
+        cls = self.free_map.bit_length() - 1
+        return max(self._block_size(block) for block in self.free_lists[cls])
+
+    def _read_tag(self, ptr: int) -> int:
+        memory = self.memory
+        return memory.int_struct.unpack_from(memory.memory, ptr + ALIGNMENT - memory.int_struct.size)[0]
+
+    def _write_tag(self, ptr: int, tag: int):
+        memory = self.memory
+        memory.int_struct.pack_into(memory.memory, ptr + ALIGNMENT - memory.int_struct.size, tag)
+
+    def _block_size(self, block: int) -> int:
+        return self._read_tag(block) & SIZE_MASK
+
+    def _make_free_block(self, block: int, size: int):
+        """ Writes the header and footer of a free block and puts it into the free lists. """
+        self._write_tag(block, size | PREV_ALLOCATED)  # two free blocks are never adjacent
+        self._write_tag(block + size, size)
+        self._push_block(block, size)
+
+    def _set_prev_allocated(self, block: int, prev_allocated: bool):
+        if block < self.heap_top:
+            tag = self._read_tag(block)
+            self._write_tag(block, tag | PREV_ALLOCATED if prev_allocated else tag & ~PREV_ALLOCATED)
+        else:
+            self.top_prev_allocated = prev_allocated
+
+    def _push_block(self, block: int, size: int):
+        cls = size_class(size)
+        self.free_lists[cls][block] = None
+        self.free_map |= 1 << cls
+
+    def _remove_block(self, block: int, size: int):
+        cls = size_class(size)
+        free_list = self.free_lists[cls]
+        del free_list[block]
+        if not free_list:
+            self.free_map &= ~(1 << cls)
+
+    def _pop_block(self, cls: int) -> int:
+        free_list = self.free_lists[cls]
+        block = free_list.popitem()[0]
+        if not free_list:
+            self.free_map &= ~(1 << cls)
+        return block
+
+    def _find_block(self, size: int) -> int:
+        """
+        Takes a free block which can hold <size> bytes out of the free lists, splits off the unused tail, and
+        returns the address of the block.
+
+        Small sizes have exact size classes, so a non-empty class is popped directly. Otherwise the next
+        non-empty larger class is located from the bitmap of non-empty classes.
+        """
+        cls = size_class(size)
+        block = -1
+        if cls < SMALL_CLASS_COUNT:
+            if self.free_map & (1 << cls):
+                return self._pop_block(cls)
+        elif self.free_map & (1 << cls):
+            # large classes hold blocks of different sizes, find the first fit
+            for candidate in self.free_lists[cls]:
+                candidate_size = self._block_size(candidate)
+                if candidate_size >= size:
+                    block = candidate
+                    self._remove_block(block, candidate_size)
+                    break
+
+        if block < 0:
+            larger = self.free_map >> (cls + 1)
+            if larger == 0:
+                raise MemoryException("No space to malloc an object of length {}".format(size))
+            larger_cls = cls + (larger & -larger).bit_length()
+            block = self._pop_block(larger_cls)
+
+        block_size = self._block_size(block)
+        tag_len = ALIGNMENT
+        remain = block_size - size - tag_len
+        if remain >= ALIGNMENT:
+            # the split tail is followed by the same block as before, whose PREV_ALLOCATED flag stays cleared
+            self._make_free_block(block + tag_len + size, remain)
+            self._write_tag(block, size | PREV_ALLOCATED)
+        return block
 
-    This is a max heap
 
-    ===== Attributes =====
+class BuddyAllocator(Allocator):
     """
-    def __init__(self):
-        self.heap = []
-
-    def __len__(self):
-        return len(self.heap)
-
-    def __str__(self):
-        return str(self.heap)
-
-    def copy(self):
-        h = Heap()
-        h.heap = self.heap.copy()
-        return h
-
-    @staticmethod
-    def _compare_node(node, other):
-        return node < other
-
-    def _heapify(self, index):
-        left = (index + 1) * 2 - 1
-        right = (index + 1) * 2
-
-        extreme = self.heap[index]
-        is_left = True
-        if left < len(self.heap):
-            if self._compare_node(extreme, self.heap[left]):
-                extreme = self.heap[left]
-        if right < len(self.heap):
-            if self._compare_node(extreme, self.heap[right]):
-                extreme = self.heap[right]
-                is_left = False
-        if self._compare_node(self.heap[index], extreme):
-            if is_left:
-                self._swap(index, left)
-                self._heapify(left)
+    Binary buddy allocator.
+
+    Every block has a size of a power of two, and is aligned to its size relative to the heap start. A block of
+    order k is split into two buddies of order k - 1, and is merged back once both buddies are free.
+    The header of a block stores the requested length, the order of the block and the ALLOCATED flag.
+    The heap is covered by the largest aligned blocks that fit, so a heap which is not a power of two long is
+    split into several top level blocks.
+    """
+
+    name = "buddy"
+
+    def __init__(self, memory):
+        Allocator.__init__(self, memory)
+
+        self.free_lists = []  # order: {offset: None}
+        self.free_map = 0  # bit k is set iff free_lists[k] is not empty
+        self.heap_len = 0  # length of the heap range covered by blocks
+        self.heap_available = 0
+        self.requested = 0  # total length requested by the allocated blocks
+        self.used = 0  # total size of the allocated blocks
+
+    def setup(self, heap_start: int, heap_end: int):
+        self.heap_start = heap_start
+        self.heap_end = heap_end
+        self.free_lists = [{} for _ in range((heap_end - heap_start).bit_length() + 1)]
+        self.free_map = 0
+        self.heap_available = 0
+        self.requested = 0
+        self.used = 0
+        self.heap_len = 0
+        self.extend(heap_end)
+
+    def extend(self, heap_end: int):
+        """
+        Covers the new range with the largest aligned blocks that fit, and merges them with free buddies.
+        """
+        self.heap_end = heap_end
+        offset = self.heap_len
+        new_len = (heap_end - self.heap_start) >> BUDDY_MIN_ORDER << BUDDY_MIN_ORDER
+        while len(self.free_lists) <= new_len.bit_length():
+            self.free_lists.append({})
+        self.heap_len = new_len
+        while offset < new_len:
+            order = (new_len - offset).bit_length() - 1
+            if offset:
+                order = min(order, (offset & -offset).bit_length() - 1)
+            self.heap_available += 1 << order
+            self._insert_block(offset, order)
+            offset += 1 << order
+
+    def restore(self, heap_start: int, heap_end: int):
+        self.heap_start = heap_start
+        self.heap_end = heap_end
+        self.heap_len = (heap_end - heap_start) >> BUDDY_MIN_ORDER << BUDDY_MIN_ORDER
+        self.free_lists = [{} for _ in range(self.heap_len.bit_length() + 1)]
+        self.free_map = 0
+        self.heap_available = 0
+        self.requested = 0
+        self.used = 0
+        offset = 0
+        while offset < self.heap_len:
+            tag = self._read_tag(heap_start + offset)
+            order = tag >> BUDDY_ORDER_SHIFT & ((1 << BUDDY_ORDER_BITS) - 1)
+            if order < BUDDY_MIN_ORDER or offset & ((1 << order) - 1) or offset + (1 << order) > self.heap_len:
+                raise MemoryException("Corrupted heap block at {}".format(heap_start + offset))
+            if tag & ALLOCATED:
+                self.requested += tag >> (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT)
+                self.used += 1 << order
             else:
-                self._swap(index, right)
-                self._heapify(right)
-
-    def _rise_node(self, index):
-        parent_index = (index + 1) // 2 - 1
-        if parent_index >= 0:
-            parent_value = self.heap[parent_index]
-            if self._compare_node(parent_value, self.heap[index]):
-                self._swap(index, parent_index)
-                self._rise_node(parent_index)
-
-    def _swap(self, i, j):
-        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
-
-    def build_heap(self, lst: list):
-        self.heap = lst.copy()
-        mid = len(self.heap) // 2 - 1
-        for i in range(mid, -1, -1):
-            self._heapify(i)
-
-    def insert(self, value):
-        """ Insert a new value into this heap, while keeping the heap property. """
-        self.heap.append(value)
-        self._rise_node(len(self.heap) - 1)
-
-    def get(self):
-        """ Returns the minimum element in this heap. """
-        return self.heap[0]
-
-    def extract(self):
-        """ Extracts the minimum element in this heap. """
-        self._swap(0, -1)
-        minimum = self.heap.pop()
-        if len(self.heap) > 0:
-            self._heapify(0)
-        return minimum
-
-    def print_sorted(self):
-        h = self.copy()
-        lst = []
-        while len(h) > 0:
-            lst.append(h.extract())
-        lst.reverse()
-        print(lst)
+                self._push_block(offset, order)
+                self.heap_available += 1 << order
+            offset += 1 << order
+
+    def malloc(self, length: int) -> int:
+        tag_len = self.memory.get_type_size("int")
+        if length >> (tag_len * 8 - 1 - BUDDY_ORDER_BITS - BUDDY_ORDER_SHIFT):
+            raise MemoryException("Length {} does not fit in the header of a buddy block".format(length))
+        order = max(BUDDY_MIN_ORDER, (length + tag_len - 1).bit_length())
+        larger = self.free_map >> order
+        if larger == 0:
+            raise MemoryException("No space to malloc an object of length {}".format(length))
+        block_order = order + (larger & -larger).bit_length() - 1
+        offset = self._pop_block(block_order)
+        while block_order > order:
+            block_order -= 1
+            self._push_block(offset + (1 << block_order), block_order)
+
+        self._write_tag(self.heap_start + offset,
+                        length << (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT) | order << BUDDY_ORDER_SHIFT | ALLOCATED)
+        self.heap_available -= 1 << order
+        self.requested += length
+        self.used += 1 << order
+        return self.heap_start + offset + tag_len
+
+    def free(self, ptr: int):
+        tag_len = self.memory.get_type_size("int")
+        block = ptr - tag_len
+        tag = self._read_tag(block)
+        if not tag & ALLOCATED:
+            raise MemoryException("Pointer to {} is not allocated or already freed".format(ptr))
+        order = tag >> BUDDY_ORDER_SHIFT & ((1 << BUDDY_ORDER_BITS) - 1)
+        self.heap_available += 1 << order
+        self.requested -= tag >> (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT)
+        self.used -= 1 << order
+        self._insert_block(block - self.heap_start, order)
+
+    def resize(self, ptr: int, length: int) -> bool:
+        """
+        Keeps the block if <length> still fits in its order, and gives back the halves it does not need anymore.
+        """
+        tag_len = self.memory.get_type_size("int")
+        block = ptr - tag_len
+        tag = self._read_tag(block)
+        order = tag >> BUDDY_ORDER_SHIFT & ((1 << BUDDY_ORDER_BITS) - 1)
+        new_order = max(BUDDY_MIN_ORDER, (length + tag_len - 1).bit_length())
+        if new_order > order or length >> (tag_len * 8 - 1 - BUDDY_ORDER_BITS - BUDDY_ORDER_SHIFT):
+            return False
+        offset = block - self.heap_start
+        while order > new_order:  # the buddy of each upper half is the allocated lower half
+            order -= 1
+            self._push_block(offset + (1 << order), order)
+            self.heap_available += 1 << order
+            self.used -= 1 << order
+        self._write_tag(block,
+                        length << (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT) | order << BUDDY_ORDER_SHIFT | ALLOCATED)
+        self.requested += length - (tag >> (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT))
+        return True
+
+    def block_length(self, ptr: int) -> int:
+        return self._read_tag(ptr - self.memory.get_type_size("int")) >> (BUDDY_ORDER_BITS + BUDDY_ORDER_SHIFT)
+
+    def block_footprint(self, ptr: int) -> int:
+        tag = self._read_tag(ptr - self.memory.get_type_size("int"))
+        return 1 << (tag >> BUDDY_ORDER_SHIFT & ((1 << BUDDY_ORDER_BITS) - 1))
+
+    def _insert_block(self, offset: int, order: int):
+        """ Puts a free block into the free lists, after merging it with its free buddies. """
+        while True:
+            merged = offset & ~((2 << order) - 1)
+            if merged + (2 << order) > self.heap_len:  # the block is a top level block
+                break
+            buddy = offset ^ (1 << order)
+            if buddy not in self.free_lists[order]:
+                break
+            self._remove_block(buddy, order)
+            offset = merged
+            order += 1
+        self._push_block(offset, order)
+
+    def available(self) -> int:
+        return self.heap_available
+
+    def free_blocks(self) -> list:
+        tag_len = self.memory.get_type_size("int")
+        blocks = []
+        for order in range(len(self.free_lists)):
+            for offset in self.free_lists[order]:
+                blocks.append((self.heap_start + offset, (1 << order) - tag_len))
+        blocks.sort()
+        return blocks
+
+    def largest_free_block(self) -> int:
+        if self.free_map == 0:
+            return 0
+        return (1 << (self.free_map.bit_length() - 1)) - self.memory.get_type_size("int")
+
+    def internal_fragmentation(self) -> float:
+        """ Returns the fraction of allocated bytes that are lost to rounding up to powers of two. """
+        if self.used == 0:
+            return 0.0
+        return 1 - self.requested / self.used
+
+    def _push_block(self, offset: int, order: int):
+        self._write_tag(self.heap_start + offset, order << BUDDY_ORDER_SHIFT)
+        self.free_lists[order][offset] = None
+        self.free_map |= 1 << order
+
+    def _remove_block(self, offset: int, order: int):
+        free_list = self.free_lists[order]
+        del free_list[offset]
+        if not free_list:
+            self.free_map &= ~(1 << order)
+
+    def _pop_block(self, order: int) -> int:
+        free_list = self.free_lists[order]
+        offset = free_list.popitem()[0]
+        if not free_list:
+            self.free_map &= ~(1 << order)
+        return offset
+
+
+class Arena:
+    """
+    A region of heap chunks. Memory is allocated from a region by bumping a pointer, and is only released
+    together with the whole region.
+    """
+
+    def __init__(self, first_chunk: int, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.chunks = [first_chunk]  # the first chunk is kept by reset
+        self.ptr = first_chunk  # next free byte in the last chunk
+        self.end = first_chunk + chunk_size
+
+
+class SlabPool:
+    """
+    Slots of one fixed size, carved from heap chunks of SLAB_SLOTS slots each.
+
+    Every slot has a header of one int, like a heap block, storing the slot size with the SLAB flag, so that
+    'free' can tell a slot from a block of the allocator. Freed slots are kept by the pool and never merged, but a
+    chunk whose slots are all free is returned to the allocator by 'Memory.trim_pools' when the heap is full.
+    """
+
+    def __init__(self, slot_size: int):
+        self.slot_size = slot_size
+        self.free_slots = []  # stack of free slot pointers
+        self.chunks = []
+
+
+ALLOCATORS = {
+    SegregatedFitAllocator.name: SegregatedFitAllocator,
+    BuddyAllocator.name: BuddyAllocator
+}
 
 
 class Memory:
-    def __init__(self):
-        self.stack_size = 1024
+    def __init__(self, vm_size=DEFAULT_VM_SIZE, stack_size=DEFAULT_STACK_SIZE, max_vm_size=DEFAULT_MAX_VM_SIZE,
+                 max_stack_size=DEFAULT_MAX_STACK_SIZE):
+        """
+        :param vm_size: the initial size of the whole address space
+        :param stack_size: size of the first stack segment, which is the beginning of the address space
+        :param max_vm_size: the size the address space may grow to when the heap is full
+        :param max_stack_size: total size of all stack segments, beyond which the stack overflows
+        """
+        self.stack_size = stack_size
+        self.max_stack_size = max_stack_size
         self.literal_size = 0
-        self.vm_size = 32768
+        self.vm_size = vm_size
+        self.max_vm_size = max(vm_size, max_vm_size)
         self.memory = bytearray(self.vm_size)
-        # self.available = []
-        self.available2 = Heap()
+        self.backing = BACKING_BYTEARRAY
+        self.backing_file = None
+        self.memory_file = None
+        self.file_layout = None  # (literal size, int size, allocator name) of the heap in an opened memory file
+
+        self.allocator: Allocator = SegregatedFitAllocator(self)
+        self.arenas = {}  # first chunk: Arena
+        self.arena_chunks = []  # sorted (start, end) of the chunks of all regions, which must not be freed
+        self.pools = {}  # slot size: SlabPool
+        self.pool_sizes = set()  # struct sizes that 'malloc' takes from slab pools
+        # bytes of free slots, including their headers, and the allocator headers of the chunks they are carved from,
+        # which are all given back when the chunks are released
+        self.pooled_free = 0
+        self.use_pools = True
+        self.collector = None  # the garbage collector of blocks allocated by the program, if enabled
+        self.call_envs = []  # the innermost environment of each active call, where the collector finds variables
+
+        # counters of the heap blocks allocated by the program, see stats()
+        self.malloc_count = 0
+        self.free_count = 0
+        self.realloc_count = 0
+        self.allocated_bytes = 0  # total length requested by all mallocs
+        self.peak_heap_used = 0
+        self.peak_stack_used = 0
+        self.trace = None  # the access counts of a TracingMemory
+        self.traced_class = None  # the class of this memory before tracing was enabled
 
         self.call_stack_begins = []
 
+        # the stack continues in segments taken from the heap once the first segment [0, stack_size) is full
+        self.stack_segments = []  # (start, end) of each segment in the heap, the last one is in use
+        self.spare_segment = None  # the last left segment, kept to avoid reallocating at a segment boundary
+        self.stack_start = 0  # range of the current segment
+        self.stack_end = stack_size
+        self.stack_total = stack_size  # total size of the segments in use
+
         self.type_sizes = {
             "int": 8,
             "float": 8,
@@ -111,15 +692,127 @@ class Memory:
             "void": 0
         }
         self.pointer_length = self.type_sizes["int"]
+        # precompiled formats of the typed accessors, which read and write the memory in place
+        self.int_struct = INT_STRUCTS[self.pointer_length]
+        self.float_struct = FLOAT_STRUCT
 
         self.sp = 1 + self.pointer_length
 
+    def __getstate__(self):
+        """
+        Returns the state of this memory for a snapshot. The address space is saved as bytes, so a snapshot is
+        always restored to a bytearray backing.
+        """
+        state = self.__dict__.copy()
+        state["memory"] = bytes(self.memory[:self.vm_size])
+        state["backing"] = BACKING_BYTEARRAY
+        state["backing_file"] = None
+        state["memory_file"] = None
+        state["file_layout"] = None
+        state["collector"] = None  # it belongs to the interpreter which enabled it
+        state["call_envs"] = []
+        state["trace"] = None
+        state["traced_class"] = None
+        del state["int_struct"]
+        del state["float_struct"]
+        return state
+
+    def __setstate__(self, state: dict):
+        # attributes are set one by one, since a replaced __dict__ makes every attribute access slower
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.memory = bytearray(self.memory)
+        self.int_struct = INT_STRUCTS[self.pointer_length]
+        self.float_struct = FLOAT_STRUCT
+
+    def configure(self, vm_size=None, stack_size=None, max_vm_size=None, backing=None, backing_file=None,
+                  pools=None, int_size=None, max_stack_size=None, checked=None):
+        """
+        Changes the layout of this memory. This must be done before the literals are parsed and loaded.
+
+        :param vm_size: the initial size of the whole address space
+        :param stack_size: size of the first stack segment, which is the beginning of the address space
+        :param max_vm_size: the size the address space may grow to when the heap is full
+        :param backing: BACKING_BYTEARRAY or BACKING_MMAP
+        :param backing_file: path of a file to map the memory to, the heap in this file is kept after close, and is
+            reused if the file already exists
+        :param pools: whether 'malloc' of a struct size takes a slot of a slab pool
+        :param int_size: length of ints and pointers in bytes, 8 or 4
+        :param max_stack_size: total size of all stack segments, beyond which the stack overflows
+        :param checked: whether every access is checked, or only pointers computed by the program
+        """
+        if checked is not None:
+            self.set_checked(checked)
+        if pools is not None:
+            self.use_pools = pools
+        if int_size is not None:
+            self._set_int_size(int_size)
+        if vm_size is not None:
+            self.vm_size = vm_size
+        if stack_size is not None:
+            self.stack_size = stack_size
+            self.stack_end = stack_size
+            self.stack_total = stack_size
+        if max_stack_size is not None:
+            self.max_stack_size = max_stack_size
+        if max_vm_size is not None:
+            self.max_vm_size = max_vm_size
+        # every address must be representable by a pointer
+        self.max_vm_size = min(max(self.vm_size, self.max_vm_size), 1 << (self.pointer_length * 8 - 1))
+        if self.vm_size > self.max_vm_size:
+            raise MemoryException("Memory of size {} is not addressable by {} bit pointers"
+                                  .format(self.vm_size, self.pointer_length * 8))
+        if backing_file is not None:
+            backing = BACKING_MMAP
+            self.backing_file = backing_file
+        if backing is not None:
+            self.backing = backing
+        if self.stack_size >= self.vm_size:
+            raise MemoryException("Stack size {} does not fit in memory of size {}".format(self.stack_size,
+                                                                                           self.vm_size))
+        if vm_size is not None or backing is not None:
+            self._open_backing()
+
+    def close(self):
+        """
+        Releases the backing store of this memory. If the memory is mapped to a file, the layout is written after
+        the address space, and everything is flushed to the file.
+        """
+        if self.memory_file is not None:
+            if self.spare_segment is not None:
+                self._heap_free(self.spare_segment[0])
+                self.spare_segment = None
+            MEMORY_FILE_TRAILER.pack_into(self.memory, self.vm_size, MEMORY_FILE_MAGIC, self.vm_size,
+                                          self.stack_size, self.literal_size, self.pointer_length,
+                                          self.allocator.name.encode())
+            self.memory.flush()
+            self.memory.close()
+            self.memory_file.close()
+            self.memory_file = None
+
+    def set_allocator(self, name: str):
+        """
+        Changes the heap allocation policy. This must be done before the literals are loaded.
+
+        :param name: name of an allocator in ALLOCATORS
+        """
+        if name not in ALLOCATORS:
+            raise MemoryException("Unknown allocator '{}', available allocators are: {}"
+                                  .format(name, ", ".join(ALLOCATORS)))
+        self.allocator = ALLOCATORS[name](self)
+
     def load_literal(self, literal_bytes: bytes):
         length = len(literal_bytes)
         self.literal_size = length
         ls = self._literal_starts()
         self.memory[ls: ls + length] = literal_bytes
-        self._generate_available()
+        if self.file_layout is None:
+            self._generate_available()
+        else:
+            if self.file_layout != (length, self.pointer_length, self.allocator.name):
+                raise MemoryException("Heap in memory file '{}' was created by another program, int size or "
+                                      "allocator".format(self.backing_file))
+            self.allocator.restore(self._heap_starts(), self._heap_ends())
 
     def get_type_size(self, name: str):
         if name[0] == "*":  # is a pointer
@@ -128,6 +821,8 @@ class Memory:
 
     def add_type(self, name: str, length: int):
         self.type_sizes[name] = length
+        if self.use_pools and 0 < length <= SLAB_SIZE_LIMIT:
+            self.pool_sizes.add(length)
 
     def allocate(self, byt: bytearray) -> int:
         length = len(byt)
@@ -138,15 +833,25 @@ class Memory:
     def allocate_empty(self, length: int) -> int:
         ptr = self.sp
         self.sp += length
-        if self.sp >= self.stack_size:
-            raise MemoryException("Stack overflow")
+        if self.sp > self.stack_end:
+            ptr = self._push_stack_segment(length)
         return ptr
 
     def push_stack(self):
         self.call_stack_begins.append(self.sp)
 
+    def keep_stack(self):
+        """ Ends the last push_stack without releasing the stack, which the enclosing restore_stack releases. """
+        self.call_stack_begins.pop()
+
     def restore_stack(self):
-        self.sp = self.call_stack_begins.pop()
+        stack_used = self.stack_total - self.stack_end + self.sp  # inlined stack_used(), called on every return
+        if stack_used > self.peak_stack_used:
+            self.peak_stack_used = stack_used
+        sp = self.call_stack_begins.pop()
+        if not self.stack_start < sp <= self.stack_end:
+            self._pop_stack_segments(sp)
+        self.sp = sp
 
     def set(self, ptr: int, b: bytes):
         self._check_range(ptr)
@@ -156,115 +861,494 @@ class Memory:
         self._check_range(ptr)
         return self.memory[ptr: ptr + length]
 
+    def get_int(self, ptr: int) -> int:
+        self._check_range(ptr)
+        return self.int_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_int(self, ptr: int, v: int):
+        self._check_range(ptr)
+        self.int_struct.pack_into(self.memory, ptr, v)
+
+    def get_float(self, ptr: int) -> float:
+        self._check_range(ptr)
+        return self.float_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_float(self, ptr: int, v: float):
+        self._check_range(ptr)
+        self.float_struct.pack_into(self.memory, ptr, v)
+
+    def get_char(self, ptr: int) -> int:
+        """ Returns the code of the char at <ptr>. """
+        self._check_range(ptr)
+        return self.memory[ptr]
+
+    def set_char(self, ptr: int, v: int):
+        self._check_range(ptr)
+        self.memory[ptr] = v
+
+    def get_bool(self, ptr: int) -> bool:
+        self._check_range(ptr)
+        return self.memory[ptr] != 0
+
+    def set_bool(self, ptr: int, v: bool):
+        self._check_range(ptr)
+        self.memory[ptr] = 1 if v else 0
+
+    def get_ptr(self, ptr: int) -> int:
+        """ Returns the pointer stored at <ptr>. """
+        self._check_range(ptr)
+        return self.int_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_ptr(self, ptr: int, v: int):
+        self._check_range(ptr)
+        self.int_struct.pack_into(self.memory, ptr, v)
+
+    def allocate_int(self, v: int) -> int:
+        """ Pushes the int <v> to the stack and returns its pointer. """
+        ptr = self.allocate_empty(self.int_struct.size)
+        self.int_struct.pack_into(self.memory, ptr, v)
+        return ptr
+
+    def allocate_float(self, v: float) -> int:
+        """ Pushes the float <v> to the stack and returns its pointer. """
+        ptr = self.allocate_empty(self.float_struct.size)
+        self.float_struct.pack_into(self.memory, ptr, v)
+        return ptr
+
     def mem_copy(self, from_ptr, to_ptr, length):
-        b = self.get(from_ptr, length)
-        self.set(to_ptr, b)
+        """ Copies <length> bytes from <from_ptr> to <to_ptr> in place, the two ranges may overlap. """
+        if length <= 0:
+            return
+        self._check_range(from_ptr)
+        self._check_range(to_ptr)
+        # a slice assignment past the end would resize the memory
+        self._check_range(from_ptr + length - 1)
+        self._check_range(to_ptr + length - 1)
+        self._move(from_ptr, to_ptr, length)
 
     def get_literal_ptr(self, lit_loc) -> int:
         return self._literal_starts() + lit_loc
 
     def get_char_array(self, ptr) -> bytes:
-        end = ptr
-        while self.memory[end] != 0:
-            end += 1
-        return self.get(ptr, end - ptr)
+        return self.get(ptr, self.string_length(ptr))
+
+    def string_length(self, ptr: int, max_length: int = None) -> int:
+        """
+        Returns the length of the null terminated string at <ptr>, not including the terminator. A string in an
+        array of <max_length> chars may fill the array without a terminator, like a string literal.
+        """
+        self._check_range(ptr)
+        end = self.memory.find(b"\0", ptr, self.vm_size if max_length is None else ptr + max_length)
+        if end < 0:
+            if max_length is None:
+                raise MemoryException("String at {} is not terminated".format(ptr))
+            return max_length
+        return end - ptr
+
+    def find(self, ptr: int, length: int, sub: bytes) -> int:
+        """ Returns the pointer to the first occurrence of <sub> in the <length> bytes at <ptr>, or 0 if none. """
+        self._check_range(ptr)
+        pos = self.memory.find(sub, ptr, ptr + length)
+        return 0 if pos < 0 else pos
+
+    def mem_set(self, ptr: int, value: int, length: int):
+        self._check_range(ptr)
+        if length > 1:
+            self._check_range(ptr + length - 1)  # a slice assignment past the end would resize the memory
+        self.memory[ptr: ptr + length] = bytes((value & 0xff,)) * length
+
+    def mem_compare(self, ptr1: int, ptr2: int, length: int) -> int:
+        """ Compares the <length> bytes at <ptr1> and <ptr2>, returns -1, 0, or 1 like the sign of 'memcmp'. """
+        b1 = self.get(ptr1, length)
+        b2 = self.get(ptr2, length)
+        return (b1 > b2) - (b1 < b2)
+
+    def check_access(self, ptr: int, length: int):
+        """
+        Checks that the <length> bytes at a pointer computed by the program are accessible. The accessors of this
+        memory check every access, so this does nothing, see UncheckedMemory.
+        """
+        pass
+
+    def set_checked(self, checked: bool):
+        """ Switches between checking every access (the default) and checking once per computed pointer. """
+        cls = Memory if checked else UncheckedMemory
+        if self.trace is None:
+            self.__class__ = cls
+        else:
+            self.traced_class = cls
+
+    def enable_trace(self, range_bits=trc.DEFAULT_RANGE_BITS):
+        """ Starts counting all accesses, by switching to TracingMemory. See spl_trace.MemoryTrace. """
+        if self.trace is None:
+            self.traced_class = self.__class__
+            self.__class__ = TracingMemory
+        self.trace = trc.MemoryTrace(self, range_bits)
 
     def malloc(self, length) -> int:
         """
         Allocate memory of length <length> in the heap space and returns the pointer this memory to the user.
 
-        This method will store extra information in the heap.
+        The allocator may store extra information in the heap, before the returned pointer.
+        If no free block is large enough, the heap is extended at its end, so existing pointers stay valid.
+        A length which is the size of a struct type is taken from the slab pool of this size.
 
         :param length:
         :return:
         """
-        reserved_len = self.get_type_size("int")
-        total_len = length + reserved_len
-        # ind = self._find_available(total_len)
-        # loc = self.available[ind]
-        # self.available[ind - total_len + 1: ind + 1] = []
-        loc = self._find_available2(total_len)
-        b_len = int_to_bytes(length)
-        self.set(loc, b_len)  # stores the allocated length before the returned position
-        return loc + reserved_len
+        if length in self.pool_sizes:
+            return self.pool_alloc(length)
+        ptr = self._heap_malloc(length)
+        if self.collector is not None:
+            self.collector.track(ptr, length)
+        self._count_malloc(ptr, length)
+        return ptr
 
     def free(self, ptr):
-        reserved_len = self.get_type_size("int")
-        begin = ptr - reserved_len
-        b_len = self.get(begin, reserved_len)
-        allocated_len = bytes_to_int(b_len)
-        length = allocated_len + reserved_len
-        for i in range(length):
-            ava = begin
-            self._check_in_heap(ava)
-            self.available2.insert(ava)
-            # self.available.append(ava)
+        tag_len = self.get_type_size("int")
+        self._check_in_heap(ptr - tag_len)
+        self._check_not_in_arena(ptr)
+        tag = self.int_struct.unpack_from(self.memory, ptr - tag_len)[0]
+        if self.collector is not None:
+            self.collector.untrack(ptr)
+        self.free_count += 1
+        if tag & SLAB:
+            self._pool_free(ptr, tag)
+        else:
+            self.allocator.free(ptr)
+
+    def calloc(self, count: int, size: int) -> int:
+        """ Allocates <count> values of <size> bytes like 'malloc', and zero fills them with one slice write. """
+        if count < 0 or size < 0:
+            raise MemoryException("Cannot calloc {} values of {} bytes".format(count, size))
+        length = count * size
+        ptr = self.malloc(length)
+        self.memory[ptr: ptr + length] = bytes(length)
+        return ptr
+
+    def realloc(self, ptr: int, length: int) -> int:
+        """
+        Changes the block <ptr> returned by 'malloc' to hold <length> bytes, and returns its new pointer.
+
+        The block is resized in place if the allocator can, for example when the block after it is free. Otherwise
+        its content is moved to a new block, and the old block is freed. A null <ptr> allocates a new block.
+        """
+        if ptr == 0:
+            return self.malloc(length)
+        self.realloc_count += 1
+        tag_len = self.get_type_size("int")
+        self._check_in_heap(ptr - tag_len)
+        self._check_not_in_arena(ptr)
+        tag = self.int_struct.unpack_from(self.memory, ptr - tag_len)[0]
+        if not tag & ALLOCATED:
+            raise MemoryException("Pointer to {} is not allocated or already freed".format(ptr))
+        if tag & SLAB:
+            old_length = tag & SIZE_MASK
+            resized = length <= old_length
+        else:
+            old_length = self.allocator.block_length(ptr)
+            resized = self.allocator.resize(ptr, length)
+        if resized:
+            if self.collector is not None:
+                self.collector.track(ptr, length)
+            self._count_allocated(length)  # like the malloc of a moved block
+            return ptr
+        new_ptr = self.malloc(length)
+        self._move(ptr, new_ptr, min(old_length, length))
+        self.free(ptr)
+        return new_ptr
+
+    def pool_alloc(self, length: int) -> int:
+        """
+        Takes a slot of at least <length> bytes from the slab pool of this size. The slot is released by 'free'.
+        """
+        slot_size = align_size(length)
+        pool = self._get_pool(slot_size)
+        if not pool.free_slots:
+            self._fill_pool(pool)
+        ptr = pool.free_slots.pop()
+        tag_len = self.get_type_size("int")
+        self.int_struct.pack_into(self.memory, ptr - tag_len, slot_size | SLAB | ALLOCATED)
+        self.pooled_free -= slot_size + tag_len
+        if self.collector is not None:
+            self.collector.track(ptr, length)
+        self._count_malloc(ptr, length)
+        return ptr
+
+    def trim_pools(self) -> int:
+        """
+        Returns the pool chunks whose slots are all free to the allocator.
+
+        :return: the number of released chunks
+        """
+        tag_len = self.get_type_size("int")
+        released = 0
+        for pool in self.pools.values():
+            slot_len = tag_len + pool.slot_size
+            chunk_len = slot_len * SLAB_SLOTS
+            free = set(pool.free_slots)
+            kept = []
+            for chunk in pool.chunks:
+                slots = range(chunk + tag_len, chunk + chunk_len, slot_len)
+                if all(slot in free for slot in slots):
+                    free.difference_update(slots)
+                    self.pooled_free -= self.allocator.block_footprint(chunk)
+                    self.allocator.free(chunk)
+                    released += 1
+                else:
+                    kept.append(chunk)
+            if len(kept) < len(pool.chunks):
+                pool.chunks = kept
+                pool.free_slots = [slot for slot in pool.free_slots if slot in free]
+        return released
+
+    def arena_new(self, chunk_size: int) -> int:
+        """
+        Creates a new region, whose memory is taken from the heap in chunks of <chunk_size> bytes.
+
+        :return: the handle of the region
+        """
+        chunk_size = align_size(chunk_size)
+        chunk = self._heap_malloc(chunk_size)
+        self.arenas[chunk] = Arena(chunk, chunk_size)
+        bisect.insort(self.arena_chunks, (chunk, chunk + chunk_size))
+        return chunk
+
+    def arena_alloc(self, handle: int, length: int) -> int:
+        """
+        Allocates <length> bytes in the region <handle>. The returned pointer must not be passed to 'free'.
+        """
+        arena = self._get_arena(handle)
+        length = align_size(length)
+        if arena.ptr + length > arena.end:
+            chunk_size = max(arena.chunk_size, length)
+            chunk = self._heap_malloc(chunk_size)
+            arena.chunks.append(chunk)
+            bisect.insort(self.arena_chunks, (chunk, chunk + chunk_size))
+            arena.ptr = chunk
+            arena.end = chunk + chunk_size
+        ptr = arena.ptr
+        arena.ptr += length
+        return ptr
+
+    def arena_reset(self, handle: int):
+        """ Releases everything allocated in the region <handle>, while keeping the region usable. """
+        arena = self._get_arena(handle)
+        for chunk in arena.chunks[1:]:
+            self._free_arena_chunk(chunk)
+        first = arena.chunks[0]
+        arena.chunks = [first]
+        arena.ptr = first
+        arena.end = first + arena.chunk_size
+
+    def arena_free(self, handle: int):
+        """ Releases the region <handle> together with everything allocated in it. """
+        arena = self._get_arena(handle)
+        for chunk in arena.chunks:
+            self._free_arena_chunk(chunk)
+        del self.arenas[handle]
+
+    def heap_available(self) -> int:
+        return self.allocator.available() + self.pooled_free
+
+    def free_blocks(self) -> list:
+        return self.allocator.free_blocks()
+
+    def heap_used(self) -> int:
+        """ Returns the number of heap bytes taken by blocks, slab chunks, regions and stack segments. """
+        return self._heap_size() - self.heap_available()
+
+    def stack_used(self) -> int:
+        return self.stack_total - self.stack_end + self.sp
+
+    def stats(self) -> dict:
+        """
+        Returns the counters and the current state of the heap and the stack, as a dict of json serializable
+        values. Peaks are measured when blocks are allocated and when calls return.
+        """
+        stats = {
+            "allocator": self.allocator.name,
+            "malloc_count": self.malloc_count,
+            "free_count": self.free_count,
+            "realloc_count": self.realloc_count,
+            "allocated_bytes": self.allocated_bytes,
+            "vm_size": self.vm_size,
+            "heap_size": self._heap_size(),
+            "heap_used": self.heap_used(),
+            "peak_heap_used": max(self.peak_heap_used, self.heap_used()),
+            "heap_available": self.heap_available(),
+            "largest_free_block": self.allocator.largest_free_block(),
+            "fragmentation": self.allocator.fragmentation(),
+            "stack_used": self.stack_used(),
+            "peak_stack_used": max(self.peak_stack_used, self.stack_used())
+        }
+        if self.collector is not None:
+            stats["gc_collections"] = self.collector.collections
+            stats["gc_freed_bytes"] = self.collector.freed_bytes
+        return stats
 
     def print_memory(self):
-        print("stack pointer: {}, heap available: {}".format(self.sp, len(self.available2)))
+        print("stack pointer: {}, heap available: {}".format(self.sp, self.heap_available()))
         print(self.memory[:self.stack_size])
         print(self.memory[self.stack_size:self.stack_size + self.literal_size])
-        print(self.memory[self.stack_size + self.literal_size:])
+        print(self.memory[self.stack_size + self.literal_size:self.vm_size])
+
+    def _set_int_size(self, int_size: int):
+        if int_size not in INT_STRUCTS:
+            raise MemoryException("Unsupported int size {}, available sizes are: {}"
+                                  .format(int_size, ", ".join(str(size) for size in INT_STRUCTS)))
+        if self.literal_size or self.call_stack_begins:
+            raise MemoryException("Int size cannot be changed after the memory is used")
+        self.type_sizes["int"] = int_size
+        self.pointer_length = int_size
+        self.int_struct = INT_STRUCTS[int_size]
+        self.sp = 1 + self.pointer_length  # the null pointer points to a zero of pointer length
 
     def _check_range(self, ptr: int):
         if ptr == 0:
             raise MemoryException("Trying to access null pointer")
-        if self.sp <= ptr < self.stack_size:
+        if self.sp <= ptr < self.stack_end:
             raise MemoryException("Unreachable stack location {}. Current tp: {}".format(ptr, self.sp))
-        if ptr < 0 or ptr >= self._total_length():
+        if ptr < 0 or ptr >= self.vm_size:
             raise MemoryException("Unreachable memory location {}.".format(ptr, self.sp))
 
-    def _total_length(self):
-        return self.vm_size
-
     def _check_in_heap(self, ptr: int):
         if ptr < self._heap_starts() or ptr >= self._heap_ends():
             raise MemoryException("Pointer to {} is not in heap".format(ptr))
 
-    def _find_available2(self, length):
-        pool = []
-        found = False
-        while not found:
-            if len(self.available2) < length:
-                break
-            i = 0
-            while i < length:
-                x = self.available2.extract()
-                pool.append(x)
-                y = self.available2.get()
-                if x != y + 1:
-                    break
-                i += 1
-            if i == length:
-                found = True
-
-        if found:
-            for j in range(len(pool) - length):
-                self.available2.insert(pool[j])
-            return pool[-1]
+    def _get_arena(self, handle: int) -> Arena:
+        if handle not in self.arenas:
+            raise MemoryException("{} is not a region".format(handle))
+        return self.arenas[handle]
+
+    def _check_not_in_arena(self, ptr: int):
+        """ Raises if <ptr> is in a chunk of a region, which is only released by 'arena_reset' or 'arena_free'. """
+        if self.arena_chunks:
+            i = bisect.bisect_right(self.arena_chunks, (ptr, self.vm_size)) - 1
+            if i >= 0 and ptr < self.arena_chunks[i][1]:
+                raise MemoryException("Pointer to {} is in a region, which is released by 'arena_free'".format(ptr))
+
+    def _free_arena_chunk(self, chunk: int):
+        del self.arena_chunks[bisect.bisect_left(self.arena_chunks, (chunk,))]
+        self._heap_free(chunk)
+
+    def _heap_malloc(self, length: int) -> int:
+        """
+        Allocates a block of the allocator. If the heap is full, unreachable blocks are collected first if the garbage
+        collector is enabled, then the pool chunks whose slots are all free are released, and then the heap is
+        extended.
+        """
+        collected = self.collector is None
+        trimmed = False
+        while True:
+            try:
+                return self.allocator.malloc(length)
+            except MemoryException:
+                if not collected:
+                    collected = True
+                    self.collector.collect()
+                elif not trimmed:
+                    trimmed = True
+                    self.trim_pools()
+                elif not self._grow(length):
+                    raise
+
+    def _heap_free(self, ptr: int):
+        """ Frees a block of the allocator which was not allocated by the program. """
+        self.allocator.free(ptr)
+
+    def _count_malloc(self, ptr: int, length: int):
+        self.malloc_count += 1
+        self._count_allocated(length)
+
+    def _count_allocated(self, length: int):
+        self.allocated_bytes += length
+        heap_used = self._heap_size() - self.heap_available()
+        if heap_used > self.peak_heap_used:
+            self.peak_heap_used = heap_used
+
+    def _push_stack_segment(self, length: int) -> int:
+        """
+        Continues the stack in a new segment, where <length> bytes are allocated.
+
+        :return: pointer to the allocated bytes
+        """
+        size = max(self.stack_size, align_size(length))
+        if self.stack_total + size > self.max_stack_size:
+            self.sp -= length
+            raise MemoryException("Stack overflow")
+        if self.spare_segment is not None and self.spare_segment[1] - self.spare_segment[0] >= size:
+            segment = self.spare_segment
+            self.spare_segment = None
+        else:
+            start = self._heap_malloc(size)
+            segment = start, start + size
+        self.stack_segments.append(segment)
+        self.stack_start, self.stack_end = segment
+        self.stack_total += segment[1] - segment[0]
+        self.sp = self.stack_start + length
+        return self.stack_start
+
+    def _pop_stack_segments(self, sp: int):
+        """ Leaves the stack segments after the one containing <sp>. """
+        while not self.stack_start < sp <= self.stack_end:
+            segment = self.stack_segments.pop()
+            self.stack_total -= segment[1] - segment[0]
+            if self.spare_segment is not None:
+                self._heap_free(self.spare_segment[0])
+            self.spare_segment = segment
+            if self.stack_segments:
+                self.stack_start, self.stack_end = self.stack_segments[-1]
+            else:
+                self.stack_start, self.stack_end = 0, self.stack_size
+
+    def _get_pool(self, slot_size: int) -> SlabPool:
+        pool = self.pools.get(slot_size)
+        if pool is None:
+            pool = SlabPool(slot_size)
+            self.pools[slot_size] = pool
+        return pool
+
+    def _fill_pool(self, pool: SlabPool):
+        """ Carves a new heap chunk into free slots of <pool>. """
+        tag_len = self.get_type_size("int")
+        slot_len = tag_len + pool.slot_size
+        try:
+            chunk = self._heap_malloc(slot_len * SLAB_SLOTS)
+        except MemoryException:
+            if pool.free_slots:  # the garbage collector has freed some slots instead
+                return
+            raise
+        pool.chunks.append(chunk)
+        self.pooled_free += self.allocator.block_footprint(chunk)
+        tag = pool.slot_size | SLAB
+        for i in range(SLAB_SLOTS - 1, -1, -1):  # slots are handed out in address order
+            slot = chunk + i * slot_len
+            self.int_struct.pack_into(self.memory, slot, tag)
+            pool.free_slots.append(slot + tag_len)
+
+    def _pool_free(self, ptr: int, tag: int):
+        if not tag & ALLOCATED:
+            raise MemoryException("Pointer to {} is not allocated or already freed".format(ptr))
+        slot_size = tag & SIZE_MASK
+        tag_len = self.get_type_size("int")
+        # pools are rebuilt lazily from the slots of a reused memory file
+        pool = self._get_pool(slot_size)
+        self.int_struct.pack_into(self.memory, ptr - tag_len, slot_size | SLAB)
+        pool.free_slots.append(ptr)
+        self.pooled_free += slot_size + tag_len
+
+    def _move(self, from_ptr: int, to_ptr: int, length: int):
+        memory = self.memory
+        if self.backing == BACKING_MMAP:
+            memory.move(to_ptr, from_ptr, length)
+        elif length < ZERO_COPY_LENGTH:
+            # the slice on the right is copied before it is assigned, so overlapping ranges are safe
+            memory[to_ptr: to_ptr + length] = memory[from_ptr: from_ptr + length]
         else:
-            raise MemoryException("No space to malloc an object of length {}"
-                                  .format(length - self.get_type_size("int")))
-
-    # def _find_available(self, length) -> int:
-    #     """
-    #     Finds a consecutive heap address of length <length> and returns the first address.
-    #
-    #     :param length:
-    #     :return:
-    #     """
-    #     i = len(self.available) - 1
-    #     while i >= 0:
-    #         j = 0
-    #         while j < length - 1 and i - j > 0:
-    #             if self.available[i - j - 1] != self.available[i - j] + 1:
-    #                 break
-    #             j += 1
-    #         if j == length - 1:
-    #             return i
-    #         else:
-    #             i -= j + 1
-    #     raise MemoryException("No space to malloc an object of length {}".format(length - self.get_type_size("int")))
+            # a view is not kept, since the bytearray cannot grow while it is exported
+            with memoryview(memory) as view:
+                view[to_ptr: to_ptr + length] = view[from_ptr: from_ptr + length]
 
     def _heap_starts(self):
         return self.stack_size + self.literal_size
@@ -279,16 +1363,218 @@ class Memory:
         return self.vm_size - self.stack_size - self.literal_size
 
     def _generate_available(self):
-        # self.available = [i for i in range(self._heap_ends() - 1, self._heap_starts() - 1, -1)]
-        self.available2.build_heap([i + self._heap_starts() for i in range(self._heap_size())])
+        if self._heap_size() <= 0:
+            raise MemoryException("No space for heap in memory of size {}".format(self.vm_size))
+        self.allocator.setup(self._heap_starts(), self._heap_ends())
+
+    def _grow(self, length: int) -> bool:
+        """
+        Extends the address space, at least doubling it, so that a block of <length> bytes can be allocated.
+
+        :return: False if the memory cannot grow anymore
+        """
+        if self.vm_size >= self.max_vm_size:
+            return False
+        # the buddy allocator may need a block twice as large as the length, together with its header
+        new_size = min(self.max_vm_size, max(self.vm_size * 2, self.vm_size + length * 2 + ALIGNMENT * 2))
+        if self.backing == BACKING_BYTEARRAY:
+            self.memory.extend(bytes(new_size - self.vm_size))
+        elif self.memory_file is not None:
+            self.memory.resize(new_size + MEMORY_FILE_TRAILER.size)
+        # an anonymous map already covers max_vm_size
+        self.vm_size = new_size
+        self.allocator.extend(new_size)
+        return True
+
+    def _open_backing(self):
+        self.close()
+        self.file_layout = None
+        if self.backing == BACKING_BYTEARRAY:
+            self.memory = bytearray(self.vm_size)
+        elif self.backing == BACKING_MMAP:
+            if self.backing_file is None:
+                # pages of an anonymous map only take memory once touched, so the maximum size is mapped at once
+                self.memory = mmap.mmap(-1, self.max_vm_size)
+            else:
+                self._open_memory_file()
+        else:
+            raise MemoryException("Unknown memory backing '{}'".format(self.backing))
+
+    def _open_memory_file(self):
+        trailer_len = MEMORY_FILE_TRAILER.size
+        if os.path.exists(self.backing_file) and os.path.getsize(self.backing_file) > trailer_len:
+            self.memory_file = open(self.backing_file, "r+b")
+            file_len = os.path.getsize(self.backing_file)
+            self.memory = mmap.mmap(self.memory_file.fileno(), file_len)
+            magic, vm_size, stack_size, literal_size, int_size, allocator_name = \
+                MEMORY_FILE_TRAILER.unpack_from(self.memory, file_len - trailer_len)
+            if magic != MEMORY_FILE_MAGIC or vm_size != file_len - trailer_len:
+                self.close()
+                raise MemoryException("'{}' is not a memory file".format(self.backing_file))
+            if stack_size != self.stack_size:
+                self.close()
+                raise MemoryException("Memory file '{}' has stack size {}".format(self.backing_file, stack_size))
+            self.vm_size = vm_size
+            self.max_vm_size = max(self.vm_size, self.max_vm_size)
+            self.file_layout = literal_size, int_size, allocator_name.rstrip(b"\0").decode()
+        else:
+            self.memory_file = open(self.backing_file, "w+b")
+            self.memory_file.truncate(self.vm_size + trailer_len)
+            self.memory = mmap.mmap(self.memory_file.fileno(), self.vm_size + trailer_len)
+
+
+class UncheckedMemory(Memory):
+    """
+    A memory whose accessors do not check pointers.
+
+    Pointers to variables, literals and temporary values are produced by the interpreter and are always valid. Only
+    pointers computed by the program, by dereferencing or indexing, may be invalid. The interpreter checks them
+    once by 'check_access', instead of checking every byte range read or written through them.
+    """
+
+    def set(self, ptr: int, b: bytes):
+        self.memory[ptr: ptr + len(b)] = b
+
+    def get(self, ptr, length) -> bytes:
+        return self.memory[ptr: ptr + length]
+
+    def mem_copy(self, from_ptr, to_ptr, length):
+        if length > 0:
+            self._move(from_ptr, to_ptr, length)
+
+    def get_int(self, ptr: int) -> int:
+        return self.int_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_int(self, ptr: int, v: int):
+        self.int_struct.pack_into(self.memory, ptr, v)
+
+    def get_float(self, ptr: int) -> float:
+        return self.float_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_float(self, ptr: int, v: float):
+        self.float_struct.pack_into(self.memory, ptr, v)
+
+    def get_char(self, ptr: int) -> int:
+        return self.memory[ptr]
+
+    def set_char(self, ptr: int, v: int):
+        self.memory[ptr] = v
+
+    def get_bool(self, ptr: int) -> bool:
+        return self.memory[ptr] != 0
+
+    def set_bool(self, ptr: int, v: bool):
+        self.memory[ptr] = 1 if v else 0
+
+    def get_ptr(self, ptr: int) -> int:
+        return self.int_struct.unpack_from(self.memory, ptr)[0]
+
+    def set_ptr(self, ptr: int, v: int):
+        self.int_struct.pack_into(self.memory, ptr, v)
+
+    def check_access(self, ptr: int, length: int):
+        self._check_range(ptr)
+        if length > 1:
+            self._check_range(ptr + length - 1)
+
+
+class TracingMemory(Memory):
+    """
+    A memory which counts every access in its MemoryTrace before doing it as the class it was before tracing.
+
+    A memory only becomes a TracingMemory by 'enable_trace', so the accessors cost nothing extra otherwise.
+    """
+
+    def set(self, ptr: int, b: bytes):
+        self.trace.record(ptr, len(b), True)
+        self.traced_class.set(self, ptr, b)
+
+    def get(self, ptr, length) -> bytes:
+        self.trace.record(ptr, length, False)
+        return self.traced_class.get(self, ptr, length)
+
+    def mem_copy(self, from_ptr, to_ptr, length):
+        if length > 0:
+            self.trace.record(from_ptr, length, False)
+            self.trace.record(to_ptr, length, True)
+        self.traced_class.mem_copy(self, from_ptr, to_ptr, length)
+
+    def mem_set(self, ptr: int, value: int, length: int):
+        self.trace.record(ptr, length, True)
+        self.traced_class.mem_set(self, ptr, value, length)
+
+    def get_char_array(self, ptr) -> bytes:
+        return self.traced_class.get(self, ptr, self.string_length(ptr))
+
+    def string_length(self, ptr: int, max_length: int = None) -> int:
+        length = self.traced_class.string_length(self, ptr, max_length)
+        self.trace.record(ptr, length + 1, False)
+        return length
+
+    def find(self, ptr: int, length: int, sub: bytes) -> int:
+        self.trace.record(ptr, length, False)
+        return self.traced_class.find(self, ptr, length, sub)
+
+    def get_int(self, ptr: int) -> int:
+        self.trace.record(ptr, self.pointer_length, False)
+        return self.traced_class.get_int(self, ptr)
+
+    def set_int(self, ptr: int, v: int):
+        self.trace.record(ptr, self.pointer_length, True)
+        self.traced_class.set_int(self, ptr, v)
+
+    def get_float(self, ptr: int) -> float:
+        self.trace.record(ptr, FLOAT_STRUCT.size, False)
+        return self.traced_class.get_float(self, ptr)
+
+    def set_float(self, ptr: int, v: float):
+        self.trace.record(ptr, FLOAT_STRUCT.size, True)
+        self.traced_class.set_float(self, ptr, v)
+
+    def get_char(self, ptr: int) -> int:
+        self.trace.record(ptr, 1, False)
+        return self.traced_class.get_char(self, ptr)
+
+    def set_char(self, ptr: int, v: int):
+        self.trace.record(ptr, 1, True)
+        self.traced_class.set_char(self, ptr, v)
+
+    def get_bool(self, ptr: int) -> bool:
+        self.trace.record(ptr, 1, False)
+        return self.traced_class.get_bool(self, ptr)
+
+    def set_bool(self, ptr: int, v: bool):
+        self.trace.record(ptr, 1, True)
+        self.traced_class.set_bool(self, ptr, v)
+
+    def get_ptr(self, ptr: int) -> int:
+        self.trace.record(ptr, self.pointer_length, False)
+        return self.traced_class.get_ptr(self, ptr)
+
+    def set_ptr(self, ptr: int, v: int):
+        self.trace.record(ptr, self.pointer_length, True)
+        self.traced_class.set_ptr(self, ptr, v)
+
+    def check_access(self, ptr: int, length: int):
+        self.traced_class.check_access(self, ptr, length)
+
+    def free(self, ptr):
+        self.trace.on_free(ptr)
+        self.traced_class.free(self, ptr)
 
+    def realloc(self, ptr: int, length: int) -> int:
+        new_ptr = self.traced_class.realloc(self, ptr, length)
+        if new_ptr == ptr:
+            self.trace.on_resize(ptr, length)
+        return new_ptr
 
-MEMORY = Memory()
+    def _count_malloc(self, ptr: int, length: int):
+        self.trace.on_malloc(ptr, length)
+        self.traced_class._count_malloc(self, ptr, length)
 
 
-def int_to_bytes(i: int) -> bytes:
-    int_len = MEMORY.get_type_size("int")
-    return i.to_bytes(int_len, "big", signed=True)
+def int_to_bytes(i: int, int_size: int = 8) -> bytes:
+    return INT_STRUCTS[int_size].pack(i)
 
 
 def bytes_to_int(b: bytes) -> int:
@@ -296,10 +1582,16 @@ def bytes_to_int(b: bytes) -> int:
 
 
 if __name__ == "__main__":
-    m = Memory()
-    m.load_literal(bytes(0))
-    m.available2.heap = [32767, 32766, 32765, 32764, 32763, 32762, 32761, 32760, 32759]
-    m.available2.print_sorted()
-    ava2 = m._find_available2(4)
-    print(ava2)
-    m.available2.print_sorted()
+    for alloc_name in ALLOCATORS:
+        m = Memory()
+        m.set_allocator(alloc_name)
+        m.load_literal(bytes(0))
+        p1 = m.malloc(16)
+        p2 = m.malloc(4)
+        print(alloc_name, p1, p2, m.free_blocks())
+        m.free(p1)
+        p3 = m.malloc(10)
+        print(p3, m.free_blocks())
+        m.free(p2)
+        m.free(p3)
+        print(m.free_blocks(), m.heap_available(), m.allocator.fragmentation())
@@ -0,0 +1,344 @@
+import bin.spl_ir as ir
+
+OVERDEFINED = "overdefined"  # the lattice value of a value which is not constant, see propagate_constants
+
+
+def optimize(func: ir.IRFunction):
+    """ Runs the passes of PIPELINE over the SSA form <func>. """
+    for optimization in PIPELINE:
+        optimization(func)
+
+
+def propagate_copies(func: ir.IRFunction):
+    """
+    Copy propagation: replaces every phi whose args are a single value, besides the phi itself, by the value.
+
+    Assigning a variable to another one does not copy in SSA form, so these phis are the copies of the function.
+    """
+    replacements = {}
+    changed = True
+    while changed:
+        changed = False
+        for block in func.blocks:
+            for phi in block.phis:
+                if phi not in replacements:
+                    value = single_value(phi, replacements)
+                    if value is not None:
+                        replacements[phi] = value
+                        changed = True
+    for block in func.blocks:
+        block.phis = [phi for phi in block.phis if phi not in replacements]
+    replace_values(func, replacements)
+
+
+def propagate_constants(func: ir.IRFunction):
+    """
+    Sparse conditional constant propagation: finds the values which are constant on every way through the function
+    that can be taken, where a branch on a constant is only taken one way, and replaces them by the constants.
+    Branches on constants become jumps, and the blocks which are never reached are removed.
+
+    Every value starts unknown, and is lowered to a constant or to OVERDEFINED, only from the edges known to be taken.
+    """
+    users = users_of(func)
+    values = {}  # Instr: Const or OVERDEFINED, unknown if it is not in it
+    taken = set()  # (predecessor, Block) of the edges that can be taken
+    reached = set()
+    edges = [(None, func.entry())]
+    changed = []
+
+    def visit(instr: ir.Instr):
+        if instr.op == "branch":
+            condition = value_of(instr.args[0], values)
+            for target, when in zip(instr.attr, (True, False)):
+                if condition is OVERDEFINED or condition is not None and bool(condition.value) is when:
+                    edges.append((instr.block, target))
+        elif instr.op == "jump":
+            edges.append((instr.block, instr.attr))
+        elif instr.cls is not None:
+            value = evaluate(instr, values, taken)
+            old = values.get(instr)
+            if value is not None and (old is None or old is not OVERDEFINED and not same_value(old, value)):
+                values[instr] = value
+                changed.extend(users.get(instr, ()))
+
+    while edges or changed:
+        if edges:
+            edge = edges.pop()
+            if edge in taken:
+                continue
+            taken.add(edge)
+            block = edge[1]
+            for phi in block.phis:
+                visit(phi)
+            if block not in reached:
+                reached.add(block)
+                for instr in block.instrs:
+                    visit(instr)
+        else:
+            instr = changed.pop()
+            if instr.block in reached:
+                visit(instr)
+
+    replacements = {}
+    for block in func.blocks:
+        if block not in reached:
+            continue
+        for instr in block.phis + block.instrs:
+            value = values.get(instr)
+            if isinstance(value, ir.Const) and (instr.op == "phi" or instr.op in ir.FOLDABLE):
+                replacements[instr] = value
+        block.phis = [phi for phi in block.phis if phi not in replacements]
+        block.instrs = [instr for instr in block.instrs if instr not in replacements]
+        terminator = block.instrs[-1]
+        if terminator.op == "branch":
+            condition = value_of(terminator.args[0], values)
+            if isinstance(condition, ir.Const):
+                target, other = terminator.attr if condition.value else reversed(terminator.attr)
+                block.instrs[-1] = jump = ir.Instr("jump", [], target)
+                jump.block = block
+                if other is not target:
+                    other.remove_pred(block)
+    for block in func.blocks:
+        if block not in reached:
+            for successor in block.successors():
+                if successor in reached and block in successor.preds:
+                    successor.remove_pred(block)
+    func.blocks = [block for block in func.blocks if block in reached]
+    replace_values(func, replacements)
+
+
+def number_values(func: ir.IRFunction):
+    """
+    Global value numbering: replaces every instruction without effect, and every phi, by an equal one that
+    dominates it, where equal instructions have the same operation and attribute on equal operands.
+    """
+    remove_unreachable(func)
+    idom = dominators(func)
+    children = {block: [] for block in func.blocks}
+    for block, dominator in idom.items():
+        if block is not dominator:
+            children[dominator].append(block)
+    replacements = {}
+    table = {}
+    stack = [(func.entry(), True)]
+    scopes = []  # the keys added to the table by each block on the way from the entry
+    while stack:
+        block, entering = stack.pop()
+        if not entering:
+            for key in scopes.pop():
+                del table[key]
+            continue
+        added = []
+        for instr in block.phis + block.instrs:
+            instr.args = [resolve(arg, replacements) for arg in instr.args]
+            if instr.op != "phi" and instr.op not in ir.PURE:
+                continue
+            key = value_key(instr)
+            if key in table:
+                replacements[instr] = table[key]
+            else:
+                table[key] = instr
+                added.append(key)
+        scopes.append(added)
+        stack.append((block, False))
+        stack.extend((child, True) for child in reversed(children[block]))
+    for block in func.blocks:
+        block.phis = [phi for phi in block.phis if phi not in replacements]
+        block.instrs = [instr for instr in block.instrs if instr not in replacements]
+    replace_values(func, replacements)
+
+
+def eliminate_dead_code(func: ir.IRFunction):
+    """ Removes the unreachable blocks, and the instructions without effect whose results are not used. """
+    remove_unreachable(func)
+    live = set()
+    work = []
+    for block in func.blocks:
+        for instr in block.instrs:
+            if instr.op not in ir.PURE:
+                live.add(instr)
+                work.append(instr)
+    while work:
+        for arg in work.pop().args:
+            if isinstance(arg, ir.Instr) and arg not in live:
+                live.add(arg)
+                work.append(arg)
+    for block in func.blocks:
+        block.phis = [phi for phi in block.phis if phi in live]
+        block.instrs = [instr for instr in block.instrs if instr in live]
+
+
+def merge_blocks(func: ir.IRFunction):
+    """ Appends every block to the block that jumps to it, if that block is its only predecessor. """
+    replacements = {}
+    removed = set()
+    entry = func.entry()
+    for block in func.blocks:
+        if block in removed:
+            continue
+        while block.instrs[-1].op == "jump":
+            target = block.instrs[-1].attr
+            if target.preds != [block] or target is entry:
+                break
+            for phi in target.phis:
+                replacements[phi] = phi.args[0]
+            block.instrs.pop()
+            for instr in target.instrs:
+                instr.block = block
+            block.instrs.extend(target.instrs)
+            for successor in target.successors():
+                successor.preds = [block if pred is target else pred for pred in successor.preds]
+            removed.add(target)
+    func.blocks = [block for block in func.blocks if block not in removed]
+    replace_values(func, replacements)
+
+
+PIPELINE = (propagate_copies, propagate_constants, propagate_copies, number_values, eliminate_dead_code, merge_blocks)
+
+
+def reverse_postorder(func: ir.IRFunction) -> list:
+    """ Returns the blocks reached from the entry, each one before its successors except along loops. """
+    order = []
+    visited = {func.entry()}
+    stack = [(func.entry(), reversed(func.entry().successors()))]
+    while stack:
+        block, successors = stack[-1]
+        successor = next(successors, None)
+        if successor is None:
+            stack.pop()
+            order.append(block)
+        elif successor not in visited:
+            visited.add(successor)
+            stack.append((successor, reversed(successor.successors())))
+    order.reverse()
+    return order
+
+
+def remove_unreachable(func: ir.IRFunction):
+    """ Removes the blocks which are not reached from the entry, and orders the others in reverse postorder. """
+    order = reverse_postorder(func)
+    reachable = set(order)
+    for block in func.blocks:
+        if block not in reachable:
+            for successor in block.successors():
+                if successor in reachable and block in successor.preds:
+                    successor.remove_pred(block)
+    func.blocks = order
+
+
+def dominators(func: ir.IRFunction) -> dict:
+    """ Returns the immediate dominator of every block, where the entry is its own, see remove_unreachable. """
+    order = func.blocks
+    index = {block: i for i, block in enumerate(order)}
+    idom = {order[0]: order[0]}
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            new_idom = None
+            for pred in block.preds:
+                if pred in idom:
+                    new_idom = pred if new_idom is None else common_dominator(pred, new_idom, idom, index)
+            if idom.get(block) is not new_idom:
+                idom[block] = new_idom
+                changed = True
+    return idom
+
+
+def common_dominator(a: ir.Block, b: ir.Block, idom: dict, index: dict) -> ir.Block:
+    while a is not b:
+        while index[a] > index[b]:
+            a = idom[a]
+        while index[b] > index[a]:
+            b = idom[b]
+    return a
+
+
+def users_of(func: ir.IRFunction) -> dict:
+    """ Returns the instructions using every instruction as an operand. """
+    users = {}
+    for block in func.blocks:
+        for instr in block.phis + block.instrs:
+            for arg in instr.args:
+                if isinstance(arg, ir.Instr):
+                    users.setdefault(arg, []).append(instr)
+    return users
+
+
+def evaluate(instr: ir.Instr, values: dict, taken: set):
+    """ Returns the lattice value of <instr> from the values of its operands, or None if it is still unknown. """
+    if instr.op == "phi":
+        result = None
+        for pred, arg in zip(instr.block.preds, instr.args):
+            if (pred, instr.block) in taken:
+                value = value_of(arg, values)
+                if value is OVERDEFINED or result is not None and value is not None and not same_value(result, value):
+                    return OVERDEFINED
+                if value is not None:
+                    result = value
+        return result
+    if instr.op not in ir.FOLDABLE:
+        return OVERDEFINED
+    operands = [value_of(arg, values) for arg in instr.args]
+    if OVERDEFINED in operands:
+        return OVERDEFINED
+    if None in operands:
+        return None
+    operands = [operand.value for operand in operands]
+    try:
+        if instr.op == "arith":
+            return ir.Const(instr.attr(*operands))
+        elif instr.op == "fcmp":
+            return ir.Const(instr.attr(operands[0] - operands[1]))
+        return ir.Const(ir.FOLDABLE[instr.op](*operands))
+    except ArithmeticError:
+        return OVERDEFINED  # the error is raised when the instruction runs
+
+
+def value_of(arg, values: dict):
+    if isinstance(arg, ir.Const):
+        return arg
+    return values.get(arg)
+
+
+def same_value(a, b) -> bool:
+    """ Returns whether the operands <a> and <b> are the same value. """
+    return a is b or isinstance(a, ir.Const) and isinstance(b, ir.Const) and a.key() == b.key()
+
+
+def single_value(phi: ir.Instr, replacements: dict):
+    """ Returns the value of every arg of <phi> which is not the phi itself, or None if they are not the same. """
+    value = None
+    for arg in phi.args:
+        arg = resolve(arg, replacements)
+        if arg is phi:
+            continue
+        if value is None:
+            value = arg
+        elif not same_value(arg, value):
+            return None
+    return value
+
+
+def value_key(instr: ir.Instr) -> tuple:
+    """ Returns a key which is equal for the instructions computing the same value, see number_values. """
+    args = [arg.key() if isinstance(arg, ir.Const) else id(arg) for arg in instr.args]
+    if instr.op in ir.COMMUTATIVE:
+        args.sort(key=repr)
+    attr = instr.block if instr.op == "phi" else instr.attr
+    return instr.op, attr, tuple(args)
+
+
+def resolve(value, replacements: dict):
+    while value in replacements:
+        value = replacements[value]
+    return value
+
+
+def replace_values(func: ir.IRFunction, replacements: dict):
+    """ Replaces the operands of all instructions which are keys of <replacements> by their replacements. """
+    if not replacements:
+        return
+    for block in func.blocks:
+        for instr in block.phis + block.instrs:
+            instr.args = [resolve(arg, replacements) for arg in instr.args]
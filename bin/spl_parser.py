@@ -1,3 +1,4 @@
+import struct
 from bin import spl_ast as ast, spl_token_lib as stl
 import bin.spl_types as typ
 
@@ -5,12 +6,17 @@ ABSTRACT_IDENTIFIER = {"fn", "class"}
 
 
 class Parser:
-    def __init__(self, tokens):
+    def __init__(self, tokens, int_size=8):
+        """
+        :param tokens: the tokens to parse
+        :param int_size: length of int literals in bytes, which is the int size of the memory running the program
+        """
         self.tokens = tokens
+        self.int_size = int_size
 
         self.literal_bytes = bytearray((0, 1))
         self.string_lengths = {}  # ptr: length
-        self.literals = {}  # lit: position
+        self.literals = {}  # (lit type, bytes): position
         self.bool_literals = {}
 
     def parse(self):
@@ -384,7 +390,11 @@ class Parser:
             b = typ.boolean_to_bytes(lit)
             lit_type = 2
         elif isinstance(lit, int):
-            b = typ.int_to_bytes(lit)
+            try:
+                b = typ.int_to_bytes(lit, self.int_size)
+            except struct.error:
+                raise stl.ParseException("Int literal {} is out of range, in file '{}', at line {}"
+                                         .format(lit, lf[1], lf[0]))
             lit_type = 0
         elif isinstance(lit, float):
             b = typ.float_to_bytes(lit)
@@ -405,13 +415,15 @@ class Parser:
                 return ast.Literal(lf, 1, 2)
             else:
                 return ast.Literal(lf, 0, 2)
-        elif lit in self.literals:
-            pos = self.literals[lit]
+        # keyed by the bytes, since 3 == 3.0 and 0.0 == -0.0 in python
+        key = lit_type, bytes(b)
+        if key in self.literals:
+            pos = self.literals[key]
             node = ast.Literal(lf, pos, lit_type)
             return node
         else:
             ptr = len(self.literal_bytes)
-            self.literals[lit] = ptr
+            self.literals[key] = ptr
             self.literal_bytes.extend(b)
             node = ast.Literal(lf, ptr, lit_type)
             if lit_type == 3:
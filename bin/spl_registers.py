@@ -0,0 +1,375 @@
+import bin.spl_bytecode as bc
+import bin.spl_interpreter as itp
+import bin.spl_ir as ir
+import bin.spl_memory as mem
+import bin.spl_optimizer as opt
+import bin.spl_vm as vm
+
+# opcodes, every instruction is a tuple of the opcode and four fields, which are described after its name, where
+# the unused fields are None and register fields are indexes of the registers of the call
+MOVE = 0  # (dest, source): copies a register
+BRANCH = 1  # (condition, target if true, target if false)
+JUMP = 2  # (target)
+ADD = 3  # (dest, left, right): the Python operation of the registers, same for SUB ... NE
+SUB = 4
+MUL = 5
+LT = 6
+LE = 7
+GT = 8
+GE = 9
+EQ = 10
+NE = 11
+NEG = 12  # (dest, source)
+FCMP = 13  # (dest, left, right, function of the difference)
+ARITH = 14  # (dest, left, right, arithmetic function)
+ADDR = 15  # (dest, offset): the address of the frame at offset
+LOAD_FRAME = 16  # (dest, offset, getter): reads the value of the frame at offset
+STORE_FRAME = 17  # (offset, value, setter): writes the value to the frame at offset
+LOAD = 18  # (dest, address, getter)
+STORE = 19  # (address, value, setter)
+COPY = 20  # (source, destination, length): copies the bytes between the addresses
+CHECK = 21  # (address, length): checks the access to the bytes at the address
+CALL = 22  # (dest or None, registers of the returned location and the args, Function, address flags of the args)
+NATIVE = 23  # (dest or None, registers of the returned location and the args, function, see vm.native_function)
+NATIVE_NODES = 24  # (dest or None, registers of the returned location and the variables, function,
+#                    (name, Type, class) of the variables), see vm.nodes_function
+RETURN = 25  # (source or None)
+MISSING = 26  # (): raises the error of a function which ends without returning
+
+OPCODES = {"add": ADD, "sub": SUB, "mul": MUL, "lt": LT, "le": LE, "gt": GT, "ge": GE, "eq": EQ, "ne": NE}
+
+
+class Code:
+    """ The instructions of a function for the register machine. """
+
+    def __init__(self, func: itp.Function):
+        self.func = func
+        self.instructions = []
+        self.registers = []  # the registers at the beginning of a call, the constants are in their registers
+        self.frame_size = 0
+        self.params = []  # (register or None, frame offset, setter, length) of each parameter
+        self.rtn = None  # the register of the location of a returned struct
+
+
+class RegisterMachine:
+    """
+    Runs a program by lowering its functions to SSA form, optimizing it, and running it on a register machine.
+
+    The SSA form of a function, see spl_ir.Builder, is optimized once by the passes of spl_optimizer, and is then
+    translated to instructions whose operands are registers, see Assembler. Every call has its own list of
+    registers, a call of a compiled function continues the dispatch loop in the callee like in
+    spl_vm.VirtualMachine. Functions that are not lowered are run by the tree walker.
+
+    Values held by registers are not found by the garbage collector, so with a collector the program is run by the
+    tree walker. An int held by a register is only checked against the int size when it is stored.
+    """
+
+    name = "ir"
+
+    def __init__(self, interpreter: itp.Interpreter):
+        self.interpreter = interpreter
+        self.memory = interpreter.memory
+        self.global_env = interpreter.global_env
+        self.builder = ir.Builder(interpreter.global_env)
+        self.assembler = Assembler(interpreter.memory)
+        self.codes = {}  # Function: Code, or None if the function is run by the tree walker
+
+    def run_main(self) -> int:
+        """ Calls the function 'main' of an initialized program and returns its exit value. """
+        if "main" not in self.global_env.functions or self.memory.collector is not None:
+            return self.interpreter.run_main()
+        main_func = self.global_env.get_function("main", itp.LINE_FILE)[""]
+        code = self.code_of(main_func)
+        if code is None or bc.value_class(main_func.r_tal) != "int":
+            return self.interpreter.run_main()
+        return self.execute(code)
+
+    def optimized(self, func: itp.Function):
+        """ Returns the optimized SSA form of <func>, or None if it is run by the tree walker. """
+        ir_func = self.builder.lower(func)
+        if ir_func is not None:
+            opt.optimize(ir_func)
+        return ir_func
+
+    def code_of(self, func: itp.Function):
+        if func in self.codes:
+            return self.codes[func]
+        ir_func = self.optimized(func)
+        code = None if ir_func is None else self.assembler.assemble(ir_func)
+        self.codes[func] = code
+        return code
+
+    def ir_text(self) -> str:
+        """ Returns the text of the optimized SSA form of all functions of the program. """
+        texts = []
+        for name, func_group in self.global_env.functions.items():
+            for func in func_group.values():
+                if isinstance(func, itp.Function):
+                    ir_func = self.optimized(func)
+                    texts.append("fn {}: run by the tree walker".format(name) if ir_func is None else str(ir_func))
+        return "\n".join(texts)
+
+    def execute(self, code: Code):
+        """ Runs <code> of a function without parameters, and returns its returned value. """
+        memory = self.memory
+        returns = []  # (Code, pc, registers, frame address, dest register) of the callers
+        mem_copy = memory.mem_copy
+        check_access = memory.check_access
+        allocate_empty = memory.allocate_empty
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        code_of = self.code_of
+
+        push_stack()
+        base = allocate_empty(code.frame_size)
+        regs = code.registers[:]
+        instructions = code.instructions
+        pc = 0
+
+        while True:
+            op, a, b, c, d = instructions[pc]
+            pc += 1
+            if op == MOVE:
+                regs[a] = regs[b]
+            elif op == BRANCH:
+                pc = b if regs[a] else c
+            elif op == LT:
+                regs[a] = regs[b] < regs[c]
+            elif op == ADD:
+                regs[a] = regs[b] + regs[c]
+            elif op == JUMP:
+                pc = a
+            elif op == LOAD_FRAME:
+                regs[a] = c(base + b)
+            elif op == STORE_FRAME:
+                c(base + a, regs[b])
+            elif op == SUB:
+                regs[a] = regs[b] - regs[c]
+            elif op == MUL:
+                regs[a] = regs[b] * regs[c]
+            elif op == LOAD:
+                regs[a] = c(regs[b])
+            elif op == STORE:
+                c(regs[a], regs[b])
+            elif op == CALL:
+                args = [regs[r] for r in b]
+                callee = code_of(c)
+                if callee is None:
+                    result = vm.call_tree(memory, c, args[1:], d, args[0])
+                    if a is not None:
+                        regs[a] = result
+                    continue
+                push_stack()
+                callee_base = allocate_empty(callee.frame_size)
+                callee_regs = callee.registers[:]
+                if callee.rtn is not None:
+                    callee_regs[callee.rtn] = args[0]
+                for (reg, offset, setter, length), arg in zip(callee.params, args[1:]):
+                    if reg is not None:
+                        callee_regs[reg] = arg
+                    elif setter is not None:
+                        setter(callee_base + offset, arg)
+                    else:
+                        mem_copy(arg, callee_base + offset, length)
+                returns.append((code, pc, regs, base, a))
+                code = callee
+                instructions = callee.instructions
+                pc = 0
+                regs = callee_regs
+                base = callee_base
+            elif op == RETURN:
+                result = None if a is None else regs[a]
+                restore_stack()
+                if not returns:
+                    return result
+                code, pc, regs, base, dest = returns.pop()
+                instructions = code.instructions
+                if dest is not None:
+                    regs[dest] = result
+            elif op == LE:
+                regs[a] = regs[b] <= regs[c]
+            elif op == GT:
+                regs[a] = regs[b] > regs[c]
+            elif op == GE:
+                regs[a] = regs[b] >= regs[c]
+            elif op == EQ:
+                regs[a] = regs[b] == regs[c]
+            elif op == NE:
+                regs[a] = regs[b] != regs[c]
+            elif op == NEG:
+                regs[a] = -regs[b]
+            elif op == FCMP:
+                regs[a] = d(regs[b] - regs[c])
+            elif op == ARITH:
+                regs[a] = d(regs[b], regs[c])
+            elif op == ADDR:
+                regs[a] = base + b
+            elif op == COPY:
+                mem_copy(regs[a], regs[b], c)
+            elif op == CHECK:
+                check_access(regs[a], b)
+            elif op == NATIVE:
+                result = c(*[regs[r] for r in b])
+                if a is not None:
+                    regs[a] = result
+            elif op == NATIVE_NODES:
+                variables = [(name, tal, regs[r], cls) for r, (name, tal, cls) in zip(b[1:], d)]
+                result = c(regs[b[0]], variables)
+                if a is not None:
+                    regs[a] = result
+            elif op == MISSING:
+                raise bc.missing_return(code.func)
+
+
+class Assembler:
+    """
+    Translates the optimized SSA form of functions to instructions of the register machine.
+
+    Every constant and every instruction with a result gets its own register. A phi is translated out of SSA form to
+    moves at the end of the predecessors of its block, where the value of each predecessor is moved to the register
+    of the phi. If a predecessor also branches to another block, or the phis of the block read each other, the values
+    are moved to a temporary register of every phi instead, which is moved to the phi at the beginning of the block.
+    """
+
+    def __init__(self, memory: mem.Memory):
+        self.memory = memory
+        self.getters = {cls: getattr(memory, name) for cls, name in bc.GETTERS.items()}
+        self.setters = {cls: getattr(memory, name) for cls, name in bc.SETTERS.items()}
+        # the function being assembled
+        self.code = None
+        self.registers = {}  # Instr: register
+        self.constants = {}  # key of a constant: register
+        self.fused = set()  # the 'addr' Instr which are only used by loads and stores of the frame
+
+    def assemble(self, func: ir.IRFunction) -> Code:
+        code = self.code = Code(func.func)
+        self.registers = {}
+        self.constants = {}
+        self.fused = fused_addresses(func)
+        code.frame_size = func.frame_size
+        for param in func.params:
+            if isinstance(param, ir.Instr):
+                code.params.append((self.register(param), None, None, None))
+            else:
+                tal = func.func.params[len(code.params)].tal
+                cls = bc.value_class(tal)
+                setter = None if cls is None else self.setters[cls]
+                code.params.append((None, param, setter, tal.total_len(self.memory)))
+        if func.rtn is not None:
+            code.rtn = self.register(func.rtn)
+
+        order = opt.reverse_postorder(func)
+        temps = {}  # phi: temporary register
+        for block in order:
+            if any(len(pred.successors()) > 1 for pred in block.preds) or \
+                    any(arg in block.phis for phi in block.phis for arg in phi.args):
+                for phi in block.phis:
+                    temps[phi] = self.new_register(None)
+        starts = {}
+        instructions = code.instructions
+        for i, block in enumerate(order):
+            starts[block] = len(instructions)
+            for phi in block.phis:
+                if phi in temps:
+                    self.emit(MOVE, self.register(phi), temps[phi])
+            for instr in block.instrs[:-1]:
+                self.instruction(instr)
+            for successor in block.successors():
+                index = successor.preds.index(block)
+                for phi in successor.phis:
+                    dest = temps[phi] if phi in temps else self.register(phi)
+                    source = self.register(phi.args[index])
+                    if dest != source:
+                        self.emit(MOVE, dest, source)
+            terminator = block.instrs[-1]
+            if terminator.op == "jump":
+                if i + 1 == len(order) or order[i + 1] is not terminator.attr:
+                    self.emit(JUMP, terminator.attr)
+            elif terminator.op == "branch":
+                self.emit(BRANCH, self.register(terminator.args[0]), *terminator.attr)
+            elif terminator.op == "return":
+                self.emit(RETURN, self.register(terminator.args[0]) if terminator.args else None)
+            else:
+                self.emit(MISSING)
+        for i, instruction in enumerate(instructions):
+            if instruction[0] == JUMP:
+                instructions[i] = JUMP, starts[instruction[1]], None, None, None
+            elif instruction[0] == BRANCH:
+                instructions[i] = BRANCH, instruction[1], starts[instruction[2]], starts[instruction[3]], None
+        self.code = None
+        return code
+
+    def emit(self, op: int, a=None, b=None, c=None, d=None):
+        self.code.instructions.append((op, a, b, c, d))
+
+    def new_register(self, value) -> int:
+        self.code.registers.append(value)
+        return len(self.code.registers) - 1
+
+    def register(self, value) -> int:
+        """ Returns the register of the value of a Const or an Instr. """
+        if isinstance(value, ir.Const):
+            key = value.key()
+            if key not in self.constants:
+                self.constants[key] = self.new_register(value.value)
+            return self.constants[key]
+        if value not in self.registers:
+            self.registers[value] = self.new_register(None)
+        return self.registers[value]
+
+    def instruction(self, instr: ir.Instr):
+        op = instr.op
+        args = instr.args
+        dest = None if instr.cls is None else self.register(instr)
+        if op in OPCODES:
+            self.emit(OPCODES[op], dest, self.register(args[0]), self.register(args[1]))
+        elif op == "neg":
+            self.emit(NEG, dest, self.register(args[0]))
+        elif op == "fcmp":
+            self.emit(FCMP, dest, self.register(args[0]), self.register(args[1]), instr.attr)
+        elif op == "arith":
+            self.emit(ARITH, dest, self.register(args[0]), self.register(args[1]), instr.attr)
+        elif op == "addr":
+            if instr not in self.fused:
+                self.emit(ADDR, dest, instr.attr)
+        elif op == "load":
+            if args[0] in self.fused:
+                self.emit(LOAD_FRAME, dest, args[0].attr, self.getters[instr.attr])
+            else:
+                self.emit(LOAD, dest, self.register(args[0]), self.getters[instr.attr])
+        elif op == "store":
+            if args[0] in self.fused:
+                self.emit(STORE_FRAME, args[0].attr, self.register(args[1]), self.setters[instr.attr])
+            else:
+                self.emit(STORE, self.register(args[0]), self.register(args[1]), self.setters[instr.attr])
+        elif op == "copy":
+            self.emit(COPY, self.register(args[0]), self.register(args[1]), instr.attr)
+        elif op == "check":
+            self.emit(CHECK, self.register(args[0]), instr.attr)
+        elif op == "call":
+            flags = tuple(bc.value_class(param.tal) is None for param in instr.attr.params)
+            self.emit(CALL, dest, tuple(self.register(arg) for arg in args), instr.attr, flags)
+        elif op == "native":
+            native, classes = instr.attr
+            self.emit(NATIVE, dest, tuple(self.register(arg) for arg in args),
+                      vm.native_function(self.memory, native, classes))
+        elif op == "native_nodes":
+            native, nodes, variables = instr.attr
+            self.emit(NATIVE_NODES, dest, tuple(self.register(arg) for arg in args),
+                      vm.nodes_function(self.memory, native, nodes, self.code.func), variables)
+        # 'param' and 'rtn' are set by the call
+
+
+def fused_addresses(func: ir.IRFunction) -> set:
+    """ Returns the 'addr' instructions which are only the addresses of loads and stores, see LOAD_FRAME. """
+    addresses = set()
+    used = set()
+    for block in func.blocks:
+        for instr in block.phis + block.instrs:
+            if instr.op == "addr":
+                addresses.add(instr)
+            for i, arg in enumerate(instr.args):
+                if isinstance(arg, ir.Instr) and arg.op == "addr" and \
+                        not (i == 0 and (instr.op == "load" or instr.op == "store")):
+                    used.add(arg)
+    return addresses - used
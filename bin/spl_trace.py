@@ -0,0 +1,123 @@
+import bisect
+
+STACK = "stack"
+LITERAL = "literal"
+HEAP = "heap"
+REGIONS = STACK, LITERAL, HEAP
+
+DEFAULT_RANGE_BITS = 6  # accesses are counted per range of 64 bytes
+REPORT_ROWS = 20
+
+
+class TracedBlock:
+    """ Access counts of a heap block allocated by the program. """
+
+    def __init__(self, seq: int, ptr: int, length: int):
+        self.seq = seq  # the block is the seq-th allocation of the program
+        self.ptr = ptr
+        self.length = length
+        self.live = True
+        self.counts = [0, 0, 0, 0]  # reads, writes, read bytes, written bytes
+
+
+class MemoryTrace:
+    """
+    Counts the reads and writes of a TracingMemory by address range, by region (stack, literal and heap) and by the
+    heap block allocated by the program.
+
+    An access is attributed to the range and the block of its first byte.
+    """
+
+    def __init__(self, memory, range_bits=DEFAULT_RANGE_BITS):
+        """
+        :param memory: the traced memory
+        :param range_bits: accesses are counted per range of 2 ** range_bits bytes
+        """
+        self.memory = memory
+        self.range_bits = range_bits
+        self.ranges = {}  # range index: [reads, writes]
+        self.regions = {region: [0, 0, 0, 0] for region in REGIONS}  # same counts as TracedBlock.counts
+        self.starts = []  # sorted pointers of the live blocks
+        self.blocks = {}  # pointer: TracedBlock of the live blocks
+        self.freed = []
+        self.allocations = 0
+
+    def record(self, ptr: int, length: int, write: bool):
+        i = 1 if write else 0
+        counts = self.ranges.get(ptr >> self.range_bits)
+        if counts is None:
+            counts = [0, 0]
+            self.ranges[ptr >> self.range_bits] = counts
+        counts[i] += 1
+
+        region = self.regions[self.region_of(ptr)]
+        region[i] += 1
+        region[i + 2] += length
+
+        k = bisect.bisect_right(self.starts, ptr) - 1
+        if k >= 0:
+            block = self.blocks[self.starts[k]]
+            if ptr < block.ptr + block.length:
+                block.counts[i] += 1
+                block.counts[i + 2] += length
+
+    def region_of(self, ptr: int) -> str:
+        memory = self.memory
+        if ptr < memory.stack_size:
+            return STACK
+        if ptr < memory.stack_size + memory.literal_size:
+            return LITERAL
+        for start, end in memory.stack_segments:
+            if start <= ptr < end:
+                return STACK
+        return HEAP
+
+    def on_malloc(self, ptr: int, length: int):
+        self.allocations += 1
+        bisect.insort(self.starts, ptr)
+        self.blocks[ptr] = TracedBlock(self.allocations, ptr, length)
+
+    def on_resize(self, ptr: int, length: int):
+        block = self.blocks.get(ptr)
+        if block is not None:
+            block.length = length
+
+    def on_free(self, ptr: int):
+        block = self.blocks.pop(ptr, None)
+        if block is not None:
+            del self.starts[bisect.bisect_left(self.starts, ptr)]
+            block.live = False
+            self.freed.append(block)
+
+    def report(self, rows=REPORT_ROWS) -> str:
+        """ Returns a table of the traffic of each region, and of the hottest blocks and address ranges. """
+        lines = []
+        total = [sum(counts[i] for counts in self.regions.values()) for i in range(4)]
+        lines.append("Memory trace: {} reads ({} bytes), {} writes ({} bytes)".format(
+            total[0], total[2], total[1], total[3]))
+
+        lines.append("")
+        lines.append("{:<10}{:>12}{:>12}{:>14}{:>14}".format("region", "reads", "writes", "read bytes", "written"))
+        for region in REGIONS:
+            lines.append("{:<10}{:>12}{:>12}{:>14}{:>14}".format(region, *self.regions[region]))
+
+        blocks = sorted(list(self.blocks.values()) + self.freed,
+                        key=lambda b: b.counts[0] + b.counts[1], reverse=True)[:rows]
+        lines.append("")
+        lines.append("Hottest heap blocks, of {} allocated by the program:".format(self.allocations))
+        lines.append("{:>8}{:>12}{:>10}{:>12}{:>12}{:>14}{:>14}  {}".format(
+            "malloc", "address", "length", "reads", "writes", "read bytes", "written", "state"))
+        for b in blocks:
+            lines.append("{:>8}{:>12}{:>10}{:>12}{:>12}{:>14}{:>14}  {}".format(
+                b.seq, b.ptr, b.length, *b.counts, "live" if b.live else "freed"))
+
+        range_len = 1 << self.range_bits
+        hottest = sorted(self.ranges.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)[:rows]
+        lines.append("")
+        lines.append("Hottest address ranges of {} bytes:".format(range_len))
+        lines.append("{:>24}{:>10}{:>12}{:>12}".format("range", "region", "reads", "writes"))
+        for index, counts in hottest:
+            start = index * range_len
+            lines.append("{:>24}{:>10}{:>12}{:>12}".format(
+                "{}-{}".format(start, start + range_len - 1), self.region_of(start), *counts))
+        return "\n".join(lines) + "\n"
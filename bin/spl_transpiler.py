@@ -0,0 +1,901 @@
+import hashlib
+import json
+import operator
+import bin.spl_analyzer as ana
+import bin.spl_ast as ast
+import bin.spl_bytecode as bc
+import bin.spl_closures as clo
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_memory as mem
+import bin.spl_vm as vm
+
+CACHE_FORMAT = 2  # changed whenever the source generated for the same program changes
+CACHE_EXTENSION = ".tpy"
+
+# kinds of the result of a generated expression, besides the name of the class of a value, see bc.ADDRESS
+ADDRESS = bc.ADDRESS  # the address of the value, which is always accessible
+COMPUTED = "computed"  # the address of the value, computed by the program by dereferencing or indexing
+VOID = bc.VOID
+
+PYTHON_OPERATORS = {operator.add: "+", operator.sub: "-", operator.mul: "*"}
+
+# the other arithmetic functions of the interpreter, by the name under which they are kept in the cache file
+ARITHMETIC_FUNCTIONS = {func.__name__: func for op_set in itp.BINARY_OP_TABLE.values() for op_funcs in op_set.values()
+                        for func in op_funcs.values() if func not in PYTHON_OPERATORS}
+
+# source reading and writing a value of each class in place, by the struct functions bound in the generated source
+INLINE_GETTERS = {
+    "int": "unpack_int(buf, {})[0]",
+    "float": "unpack_float(buf, {})[0]",
+    "char": "buf[{}]",
+    "boolean": "(buf[{}] != 0)"
+}
+INLINE_SETTERS = {
+    "int": "pack_int(buf, {}, {})",
+    "float": "pack_float(buf, {}, {})",
+    "char": "buf[{}] = {}",
+    "boolean": "buf[{}] = 1 if {} else 0"
+}
+
+DEFAULT_VALUES = {"int": "0", "float": "0.0", "char": "0", "boolean": "False"}
+
+# the names bound at the beginning of the generated function 'link', which the generated functions use
+LINK_PROLOGUE = """def link(rt):
+    memory = rt.memory
+    buf = memory.memory
+    unpack_int = memory.int_struct.unpack_from
+    pack_int = memory.int_struct.pack_into
+    unpack_float = memory.float_struct.unpack_from
+    pack_float = memory.float_struct.pack_into
+    get_int = memory.get_int
+    set_int = memory.set_int
+    get_float = memory.get_float
+    set_float = memory.set_float
+    get_char = memory.get_char
+    set_char = memory.set_char
+    get_bool = memory.get_bool
+    set_bool = memory.set_bool
+    mem_copy = memory.mem_copy
+    check_access = memory.check_access
+    push_stack = memory.push_stack
+    restore_stack = memory.restore_stack
+    allocate_empty = memory.allocate_empty
+    tree_function = rt.tree_function
+    native_function = rt.native_function
+    nodes_function = rt.nodes_function
+    K = rt.constants
+
+    def at(ptr, length):
+        check_access(ptr, length)
+        return ptr
+
+"""
+
+
+class FunctionRef:
+    """ A function of the program in the constants of the generated source, which is looked up when it is linked. """
+
+    def __init__(self, name: str, overload: str):
+        self.name = name
+        self.overload = overload
+
+
+class ArgsRef:
+    """
+    The arg nodes of a call in a function of the program, in the constants of the generated source, which are looked
+    up when it is linked. The call is the one at <index> in calls_in of the function body.
+    """
+
+    def __init__(self, name: str, overload: str, index: int):
+        self.name = name
+        self.overload = overload
+        self.index = index
+
+
+class Transpiler:
+    """
+    Runs a program by generating Python source for its functions, which CPython compiles and runs itself.
+
+    Every function of the program becomes a Python function. Variables of primitive types and pointers whose
+    address is never taken are Python variables, other variables are stored in a frame on the stack of the memory,
+    like in spl_vm.VirtualMachine, and are read and written in place by the struct functions. Calls are Python calls.
+    Functions that cannot be generated exactly are run by the tree walker.
+
+    The source is generated by a Generator, and with a cache file it is kept in the file together with its constants,
+    so that the next run of the same program with the same memory layout only compiles it. The cache file is a json
+    text, where the constants are kept as descriptions, see encode_constant, and it is only run if its key and the
+    digest of its content match.
+
+    Values held by Python variables are not found by the garbage collector, so with a collector the program is run by
+    the tree walker. An int held by a Python variable is only checked against the int size when it is stored.
+    """
+
+    name = "py"
+
+    def __init__(self, interpreter: itp.Interpreter):
+        self.interpreter = interpreter
+        self.memory = interpreter.memory
+        self.global_env = interpreter.global_env
+        self.constants = []
+        self.cache_file = None
+        self.program_key = None
+
+    def use_cache(self, cache_file: str, program_key: str):
+        """
+        Keeps the generated source in <cache_file>, which is reused while the program has <program_key>.
+
+        :param program_key: a hash of everything the program is initialized from
+        """
+        self.cache_file = cache_file
+        self.program_key = program_key
+
+    def run_main(self) -> int:
+        """ Calls the function 'main' of an initialized program and returns its exit value. """
+        if "main" not in self.global_env.functions or self.memory.collector is not None:
+            return self.interpreter.run_main()
+        key = self.cache_key()
+        cached = self.load_cache(key)
+        if cached is None:
+            generator = Generator(self.global_env)
+            source = generator.generate()
+            constants = generator.constants
+            self.save_cache(key, source, constants)
+        else:
+            source, constants = cached
+        main = self.link(source, constants)
+        if main is None:
+            return self.interpreter.run_main()
+        return main()
+
+    def link(self, source: str, constants: list):
+        """ Runs the generated <source>, and returns the Python function of 'main', or None if it is not generated. """
+        self.constants = [self.resolve(c) for c in constants]
+        namespace = {}
+        exec(compile(source, "<transpiled {}>".format(self.cache_file or "program"), "exec"), namespace)
+        return namespace["link"](self)
+
+    def cache_key(self) -> str:
+        """ Returns a hash of the program and of the memory layout, which the generated source depends on. """
+        memory = self.memory
+        traced_class = memory.traced_class.__name__ if memory.trace is not None else None
+        layout = (CACHE_FORMAT, self.program_key, type(memory).__name__, traced_class, memory.pointer_length,
+                  memory.get_literal_ptr(0), sorted(self.global_env.variables.items()))
+        return hashlib.sha256(repr(layout).encode("utf-8")).hexdigest()
+
+    def resolve(self, constant):
+        """ Returns the value of <constant> bound in the generated source, looking up the references to the program. """
+        if isinstance(constant, FunctionRef):
+            return self.global_env.functions[constant.name][constant.overload]
+        elif isinstance(constant, ArgsRef):
+            func = self.global_env.functions[constant.name][constant.overload]
+            return tuple(calls_in(func.body)[constant.index].args.lines)
+        return constant
+
+    def load_cache(self, key: str):
+        """ Returns the (source, constants) kept in the cache file with <key>, or None. """
+        if self.cache_file is None:
+            return None
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(content, dict) or content.get("key") != key or \
+                content.get("digest") != cache_digest(key, content.get("source"), content.get("constants")):
+            return None
+        try:
+            return content["source"], [decode_constant(c) for c in content["constants"]]
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def save_cache(self, key: str, source: str, constants: list):
+        if self.cache_file is None:
+            return
+        encoded = [encode_constant(c) for c in constants]
+        content = {"key": key, "digest": cache_digest(key, source, encoded), "source": source, "constants": encoded}
+        try:
+            with open(self.cache_file, "w", encoding="utf-8") as f:
+                json.dump(content, f)
+        except OSError:
+            pass  # the program runs without the cache
+
+    def tree_function(self, func: itp.Function):
+        """ Returns a Python function which calls <func> in the tree walker, like a generated function. """
+        memory = self.memory
+        flags = tuple(bc.value_class(param.tal) is None for param in func.params)
+        if bc.value_class(func.r_tal) is None and func.r_tal.total_len(memory) > 0:
+            return lambda rtn_loc, *args: vm.call_tree(memory, func, args, flags, rtn_loc)
+        return lambda *args: vm.call_tree(memory, func, args, flags, 0)
+
+    def native_function(self, native: itp.NativeFunction, classes: tuple):
+        return vm.native_function(self.memory, native, classes)
+
+    def nodes_function(self, native: itp.NativeFunction, nodes: tuple, caller: itp.Function):
+        return vm.nodes_function(self.memory, native, nodes, caller)
+
+
+class Generator:
+    """
+    Generates the Python source of the functions of an analyzed program, see Transpiler.
+
+    The source defines a function 'link', which is called with the Transpiler, binds the memory and the constants,
+    defines a Python function for every function of the program, and returns the one of 'main'. Everything that
+    is not source, such as the types and the arg nodes of built-in functions, is a constant, so that the source can
+    be cached with its constants.
+
+    A function is generated by the same rules as spl_bytecode.Compiler compiles it, so it is generated only if it
+    runs exactly like the tree walker.
+    """
+
+    def __init__(self, global_env: en.GlobalEnvironment):
+        self.global_env = global_env
+        self.memory = global_env.memory
+        self.analyzer = ana.Analyzer(global_env)
+        memory = self.memory
+        # the accessors of a tracing memory count the accesses, so values are only read in place without tracing
+        self.inline = memory.trace is None
+        # accesses to computed pointers are only checked by an unchecked memory, see Memory.check_access
+        self.checks = type(memory).check_access is not mem.Memory.check_access
+        self.constants = []
+        self.constant_ids = {}  # id of the constant or key of a function: index in constants
+        self.names = {}  # Function: name of its Python function
+        self.keys = {}  # Function: (name, overload)
+        self.sites = []  # lines of 'link' binding the functions of the built-in function calls
+        # the function being generated
+        self.func = None
+        self.calls = None  # calls_in the function, once a call needs its arg nodes
+        self.lines = []  # (indent, line)
+        self.frame_size = 0
+        self.uses_frame = False
+        self.pinned = set()
+        self.locals = 0
+
+    def generate(self) -> str:
+        for name, func_group in self.global_env.functions.items():
+            for overload, func in func_group.items():
+                if isinstance(func, itp.Function):
+                    self.names[func] = "f{}_{}".format(len(self.names), name)
+                    self.keys[func] = name, overload
+        definitions = []
+        stubs = []
+        generated = set()
+        for func, (name, overload) in self.keys.items():
+            constants_len = len(self.constants)
+            sites_len = len(self.sites)
+            try:
+                definitions.append(self.generate_function(func))
+                generated.add(func)
+            except (bc.NotCompilable,) + ana.UNRESOLVED_ERRORS:
+                del self.constants[constants_len:]
+                del self.sites[sites_len:]
+                self.constant_ids = {k: i for k, i in self.constant_ids.items() if i < constants_len}
+                stubs.append("{} = tree_function({})".format(self.names[func], self.function_ref(name, overload)))
+
+        main_func = self.global_env.functions["main"].get("")
+        main = "None"
+        if main_func in generated and bc.value_class(main_func.r_tal) == "int":
+            main = self.names[main_func]
+
+        parts = [LINK_PROLOGUE]
+        binding = ["k{} = K[{}]".format(i, i) for i in range(len(self.constants))] + stubs + self.sites
+        if binding:
+            parts.append("".join("    " + line + "\n" for line in binding))
+        for definition in definitions:
+            parts.append("\n" + definition)
+        parts.append("\n    return {}\n".format(main))
+        return "".join(parts)
+
+    def constant(self, value) -> str:
+        """ Returns the name bound to the constant <value> in the generated source. """
+        key = id(value)
+        if key not in self.constant_ids:
+            self.constant_ids[key] = len(self.constants)
+            self.constants.append(value)
+        return "k{}".format(self.constant_ids[key])
+
+    def function_ref(self, name: str, overload: str) -> str:
+        key = name, overload
+        if key not in self.constant_ids:
+            self.constant_ids[key] = len(self.constants)
+            self.constants.append(FunctionRef(name, overload))
+        return "k{}".format(self.constant_ids[key])
+
+    def args_ref(self, node: ast.FuncCall) -> str:
+        """ Returns the name bound to the arg nodes of the call <node> in the generated function. """
+        if self.calls is None:
+            self.calls = calls_in(self.func.body)
+        key = self.keys[self.func] + (self.calls.index(node),)
+        if key not in self.constant_ids:
+            self.constant_ids[key] = len(self.constants)
+            self.constants.append(ArgsRef(*key))
+        return "k{}".format(self.constant_ids[key])
+
+    def generate_function(self, func: itp.Function) -> str:
+        """ Returns the source defining the Python function of <func>, indented in 'link'. """
+        self.func = func
+        self.calls = None
+        self.lines = []
+        self.frame_size = 0
+        self.uses_frame = False
+        self.pinned = pinned_names(func.body, self.global_env)
+        self.locals = 0
+        memory = self.memory
+
+        scope = bc.Scope(None)
+        rtn_len = func.r_tal.total_len(memory)
+        params = []
+        if rtn_len > 0 and bc.value_class(func.r_tal) is None:
+            params.append("rtn")
+        for i, param in enumerate(func.params):
+            place = self.declare(param.name, param.tal, scope)
+            if isinstance(place, str):
+                params.append(place)
+            else:
+                arg_name = "a{}".format(i)
+                params.append(arg_name)
+                self.store_frame(place, param.tal, arg_name)
+        if rtn_len > 0 and not bc.ends_with_return(func.body):
+            raise bc.NotCompilable()  # the function returns the value of its last statement
+        self.block(func.body, scope, 0)
+
+        lines = ["    def {}({}):".format(self.names[func], ", ".join(params))]
+        if self.uses_frame:
+            lines.append("        push_stack()")
+            lines.append("        base = allocate_empty({})".format(self.frame_size))
+            lines.append("        try:")
+            body_indent = 3
+        else:
+            body_indent = 2
+        for indent, line in self.lines:
+            lines.append("    " * (body_indent + indent) + line)
+        if self.uses_frame:
+            lines.append("        finally:")
+            lines.append("            restore_stack()")
+        return "\n".join(lines) + "\n"
+
+    def emit(self, indent: int, line: str):
+        self.lines.append((indent, line))
+
+    def reserve(self, length: int) -> int:
+        offset = self.frame_size
+        self.frame_size += length
+        self.uses_frame = True
+        return offset
+
+    def declare(self, name: str, tal: en.Type, scope: bc.Scope):
+        """ Declares a variable, and returns its Python variable name, or its frame offset if it is in memory. """
+        if scope.lookup(name) is not None or self.global_env.contains_ptr(name):
+            raise bc.NotCompilable()  # defining the name raises an error
+        if bc.value_class(tal) is not None and name not in self.pinned:
+            place = "v{}_{}".format(self.locals, name)
+            self.locals += 1
+        else:
+            place = self.reserve(tal.total_len(self.memory))
+        scope.slots[name] = place, tal
+        return place
+
+    def block(self, node: ast.Node, scope: bc.Scope, indent: int):
+        """ Generates the statement <node> as a block of Python statements, which is never empty. """
+        lines_len = len(self.lines)
+        self.statement(node, scope, indent)
+        if len(self.lines) == lines_len:
+            self.emit(indent, "pass")
+
+    def statement(self, node: ast.Node, scope: bc.Scope, indent: int):
+        node_type = node.node_type
+        if node_type == ast.BLOCK_STMT:
+            for line in node.lines:
+                self.statement(line, scope, indent)
+        elif node_type == ast.ASSIGNMENT_NODE:
+            self.assignment(node, scope, indent)
+        elif node_type == ast.IF_STMT:
+            self.emit(indent, "if {}:".format(self.operand(node.condition, scope, "boolean")))
+            self.block(node.then_block, bc.Scope(scope), indent + 1)
+            if node.else_block is not None:
+                self.emit(indent, "else:")
+                self.block(node.else_block, bc.Scope(scope), indent + 1)
+        elif node_type == ast.FOR_LOOP_STMT:
+            title_scope = bc.Scope(scope)
+            start, stop, step = node.condition.lines
+            step_first = step.node_type == ast.IN_DECREMENT_OPERATOR and not step.is_post
+            self.statement(start, title_scope, indent)
+            self.emit(indent, "while {}:".format(self.operand(stop, title_scope, "boolean")))
+            if step_first:
+                self.statement(step, title_scope, indent + 1)
+            self.block(node.body, bc.Scope(title_scope), indent + 1)
+            if not step_first:
+                self.statement(step, title_scope, indent + 1)
+        elif node_type == ast.WHILE_STMT:
+            title_scope = bc.Scope(scope)
+            self.emit(indent, "while {}:".format(self.operand(node.condition, title_scope, "boolean")))
+            self.block(node.body, bc.Scope(title_scope), indent + 1)
+        elif node_type == ast.RETURN_STMT:
+            self.return_statement(node, scope, indent)
+        elif node_type == ast.BINARY_OPERATOR and node.assignment:
+            self.arithmetic_assignment(node, scope, indent)
+        else:
+            self.emit(indent, self.expression(node, scope)[0])
+
+    def return_statement(self, node: ast.ReturnStmt, scope: bc.Scope, indent: int):
+        if node.value is None:
+            raise bc.NotCompilable()
+        r_tal = self.func.r_tal
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            self.emit(indent, self.expression(node.value, scope)[0])
+            self.emit(indent, "return")
+            return
+        cls = bc.value_class(r_tal)
+        value = self.operand(node.value, scope, cls)
+        if cls is None:
+            self.emit(indent, "mem_copy({}, rtn, {})".format(value, rtn_len))
+            self.emit(indent, "return rtn")
+        else:
+            self.emit(indent, "return {}".format(value))
+
+    def assignment(self, node: ast.AssignmentNode, scope: bc.Scope, indent: int):
+        left = node.left
+        left_type = left.node_type
+        if node.level == ast.FUNC_DEFINE:
+            raise bc.NotCompilable()
+        if left_type == ast.TYPE_NODE:
+            self.declaration(node, scope, indent)
+        elif left_type == ast.NAME_NODE:
+            slot = scope.lookup(left.name)
+            if slot is None:
+                if left.name not in self.global_env.variables:
+                    raise bc.NotCompilable()
+                tal = self.global_env.var_types[left.name]
+                self.store(node.right, scope, tal, lambda: (str(self.global_env.variables[left.name]), ADDRESS),
+                           indent)
+            else:
+                self.store_local(node.right, scope, *slot, indent)
+        elif left_type == ast.DOT:
+            struct = self.global_env.get_struct(left.left.tal.type_name)
+            attr_tal = struct.get_attr_tal(left.right.name)
+            self.store(node.right, scope, attr_tal, lambda: self.address(left, scope), indent)
+        elif left_type == ast.INDEXING_NODE:
+            unit_length = self.indexing_unit(left)
+            if unit_length != left.tal.total_len(self.memory):
+                raise bc.NotCompilable()  # the element is copied as another type
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope), indent)
+        elif left_type == ast.UNARY_OPERATOR and left.operation == "unpack":
+            self.store(node.right, scope, left.tal, lambda: self.address(left, scope), indent)
+        else:
+            raise bc.NotCompilable()
+
+    def declaration(self, node: ast.AssignmentNode, scope: bc.Scope, indent: int):
+        if node.level != ast.VAR and node.level != ast.CONST:
+            raise bc.NotCompilable()
+        type_node: ast.TypeNode = node.left
+        tal = self.analyzer.defining_type(type_node.right, self.global_env)
+        if tal is not None and tal.total_len(self.memory) == 0:  # array with undefined length
+            tal = node.right.tal
+        if tal is None:
+            raise bc.NotCompilable()
+        if node.right.node_type == ast.UNDEFINED_NODE:
+            place = self.declare(type_node.left.name, tal, scope)
+            if isinstance(place, str):
+                self.emit(indent, "{} = {}".format(place, DEFAULT_VALUES[bc.value_class(tal)]))
+            return
+        value = self.operand(node.right, scope, bc.value_class(tal))
+        place = self.declare(type_node.left.name, tal, scope)
+        self.store_place(place, tal, value, indent)
+
+    def store_local(self, right: ast.Node, scope: bc.Scope, place, tal: en.Type, indent: int):
+        self.store_place(place, tal, self.operand(right, scope, bc.value_class(tal)), indent)
+
+    def store_place(self, place, tal: en.Type, value: str, indent: int):
+        """ Generates writing the source <value> to the variable at <place>, see self.declare. """
+        if isinstance(place, str):
+            self.emit(indent, "{} = {}".format(place, value))
+        else:
+            self.store_frame(place, tal, value, indent)
+
+    def store_frame(self, offset: int, tal: en.Type, value: str, indent: int = 0):
+        cls = bc.value_class(tal)
+        if cls is None:
+            self.emit(indent, "mem_copy({}, {}, {})".format(value, frame_address(offset), tal.total_len(self.memory)))
+        else:
+            self.emit(indent, self.write(cls, frame_address(offset), ADDRESS, value))
+
+    def store(self, right: ast.Node, scope: bc.Scope, tal: en.Type, address, indent: int):
+        """ Generates writing <right> as <tal>, the address written is generated by <address> after <right>. """
+        cls = bc.value_class(tal)
+        value = self.operand(right, scope, cls)
+        target, kind = address()
+        if cls is None:
+            self.emit(indent, "mem_copy({}, {}, {})".format(value, target, tal.total_len(self.memory)))
+            return
+        if kind == COMPUTED and not is_simple(right):  # the value is computed before the address
+            self.emit(indent, "_v = {}".format(value))
+            value = "_v"
+        self.emit(indent, self.write(cls, target, kind, value))
+
+    def arithmetic_assignment(self, node: ast.BinaryOperator, scope: bc.Scope, indent: int):
+        op_set = itp.BINARY_OP_TABLE.get(node.operation[:-1])
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if op_set is None or l_tal is None or r_tal is None:
+            raise bc.NotCompilable()
+        func = clo.arithmetic_function(op_set, l_tal, r_tal)
+        if func is None:
+            raise bc.NotCompilable()
+        l_name = clo.arithmetic_name(l_tal)
+        r_name = clo.arithmetic_name(r_tal)
+        slot = scope.lookup(node.left.name) if node.left.node_type == ast.NAME_NODE else None
+        if slot is not None and isinstance(slot[0], str):
+            value = self.operand(node.right, scope, r_name)
+            self.emit(indent, "{} = {}".format(slot[0], self.operation(func, slot[0], value)))
+            return
+        target, kind = self.address(node.left, scope)
+        if kind == COMPUTED:
+            self.emit(indent, "_a = {}".format(target))
+            target = "_a"
+        value = self.operand(node.right, scope, r_name)
+        if not is_simple(node.right):
+            self.emit(indent, "_v = {}".format(value))  # the value is computed before the target is read
+            value = "_v"
+        result = self.operation(func, self.read(l_name, target, kind), value)
+        self.emit(indent, self.write("float" if l_name == "float" else "int", target, kind, result))
+
+    def operation(self, func, left: str, right: str) -> str:
+        """ Returns the source of the arithmetic function <func> of the sources <left> and <right>. """
+        if func in PYTHON_OPERATORS:
+            return "({} {} {})".format(left, PYTHON_OPERATORS[func], right)
+        return "{}({}, {})".format(self.constant(func), left, right)
+
+    def read(self, cls: str, address: str, kind: str) -> str:
+        """ Returns the source reading a value of <cls> at the source <address> of <kind>. """
+        if self.inline and (kind == ADDRESS or self.checks):
+            return INLINE_GETTERS[cls].format(address)
+        return "{}({})".format(bc.GETTERS[cls], address)
+
+    def write(self, cls: str, address: str, kind: str, value: str) -> str:
+        """ Returns the statement writing the source <value> of <cls> at the source <address> of <kind>. """
+        if self.inline and (kind == ADDRESS or self.checks):
+            return INLINE_SETTERS[cls].format(address, value)
+        return "{}({}, {})".format(bc.SETTERS[cls], address, value)
+
+    def operand(self, node: ast.Node, scope: bc.Scope, cls) -> str:
+        """ Returns the source of the value of <node> as a value of class <cls>, or its address if <cls> is None. """
+        if cls is None:
+            return self.address(node, scope)[0]
+        code, kind = self.expression(node, scope)
+        if kind == ADDRESS or kind == COMPUTED:
+            return self.read(cls, code, kind)
+        elif kind != cls:
+            raise bc.NotCompilable()  # the tree walker reads the bytes of the value as another type
+        return code
+
+    def address(self, node: ast.Node, scope: bc.Scope):
+        """ Returns the source of the address of the value of <node>, and its kind. """
+        if node.node_type == ast.NAME_NODE:
+            slot = scope.lookup(node.name)
+            if slot is not None:
+                if isinstance(slot[0], str):
+                    raise bc.NotCompilable()
+                return frame_address(slot[0]), ADDRESS
+            elif node.name in self.global_env.variables:
+                return str(self.global_env.variables[node.name]), ADDRESS
+            raise bc.NotCompilable()
+        code, kind = self.expression(node, scope)
+        if kind != ADDRESS and kind != COMPUTED:
+            raise bc.NotCompilable()
+        return code, kind
+
+    def expression(self, node: ast.Node, scope: bc.Scope):
+        """ Returns the source of the result of <node>, and its kind. """
+        node_type = node.node_type
+        if node_type == ast.LITERAL:
+            return self.literal(node)
+        elif node_type == ast.STRING_LITERAL:
+            return str(self.memory.get_literal_ptr(node.literal.lit_pos)), ADDRESS
+        elif node_type == ast.NULL_STMT:
+            return "0", "int"
+        elif node_type == ast.NAME_NODE:
+            return self.name(node, scope)
+        elif node_type == ast.BINARY_OPERATOR:
+            return self.binary_operation(node, scope)
+        elif node_type == ast.UNARY_OPERATOR:
+            return self.unary_operation(node, scope)
+        elif node_type == ast.DOT:
+            struct = self.global_env.get_struct(node.left.tal.type_name)
+            code, kind = self.address(node.left, scope)
+            return offset_address(code, struct.get_attr_pos(node.right.name)), kind
+        elif node_type == ast.INDEXING_NODE:
+            return self.indexing(node, scope), COMPUTED
+        elif node_type == ast.FUNCTION_CALL:
+            return self.call(node, scope)
+        elif node_type == ast.BLOCK_STMT and len(node.lines) == 1:  # a condition or an index
+            return self.expression(node.lines[0], scope)
+        raise bc.NotCompilable()
+
+    def literal(self, node: ast.Literal):
+        memory = self.memory
+        ptr = memory.get_literal_ptr(node.lit_pos)
+        if node.lit_type == 0:
+            return repr(memory.get_int(ptr)), "int"
+        elif node.lit_type == 1:
+            return repr(memory.get_float(ptr)), "float"
+        elif node.lit_type == 2:
+            return repr(memory.get_bool(ptr)), "boolean"
+        elif node.lit_type == 4:
+            return repr(memory.get_char(ptr)), "char"
+        return str(ptr), ADDRESS
+
+    def name(self, node: ast.NameNode, scope: bc.Scope):
+        slot = scope.lookup(node.name)
+        if slot is None:
+            if node.name not in self.global_env.variables:
+                raise bc.NotCompilable()
+            address = str(self.global_env.variables[node.name])
+            cls = bc.value_class(self.global_env.var_types[node.name])
+        else:
+            place, tal = slot
+            cls = bc.value_class(tal)
+            if isinstance(place, str):
+                return place, cls
+            address = frame_address(place)
+        if cls is None:
+            return address, ADDRESS
+        return self.read(cls, address, ADDRESS), cls
+
+    def binary_operation(self, node: ast.BinaryOperator, scope: bc.Scope):
+        l_tal = node.left.tal
+        r_tal = node.right.tal
+        if node.assignment or l_tal is None or r_tal is None:
+            raise bc.NotCompilable()
+        if node.operation in itp.BINARY_OP_TABLE:
+            func = clo.arithmetic_function(itp.BINARY_OP_TABLE[node.operation], l_tal, r_tal)
+            if func is None:
+                raise bc.NotCompilable()
+            l_name = clo.arithmetic_name(l_tal)
+            r_name = clo.arithmetic_name(r_tal)
+            left = self.operand(node.left, scope, l_name)
+            right = self.operand(node.right, scope, r_name)
+            return self.operation(func, left, right), "float" if l_name == "float" else "int"
+        elif node.operation in itp.COMPARE_TABLE:
+            if l_tal.type_name in itp.PRIMITIVE_TYPES and r_tal.type_name in itp.PRIMITIVE_TYPES and \
+                    not en.is_array(l_tal) and not en.is_array(r_tal):
+                l_name = l_tal.type_name
+                r_name = r_tal.type_name
+            elif l_tal.type_name[0] == "*" and r_tal.type_name[0] == "*":
+                l_name = r_name = "int"
+            else:
+                raise bc.NotCompilable()
+            left = self.operand(node.left, scope, l_name)
+            right = self.operand(node.right, scope, r_name)
+            if l_name != "float" and r_name != "float":
+                return "({} {} {})".format(left, node.operation, right), "boolean"
+            # the tree walker compares the difference of floats
+            return "(({} - {}) {} 0)".format(left, right, node.operation), "boolean"
+        raise bc.NotCompilable()
+
+    def unary_operation(self, node: ast.UnaryOperator, scope: bc.Scope):
+        tal = node.value.tal
+        if tal is None:
+            raise bc.NotCompilable()
+        if node.operation == "unpack":
+            if tal.type_name[0] != "*":
+                raise bc.NotCompilable()
+            ptr = self.operand(node.value, scope, "int")
+            if self.checks:
+                ptr = "at({}, {})".format(ptr, self.memory.get_type_size(tal.type_name[1:]))
+            return ptr, COMPUTED
+        elif node.operation == "pack":
+            return self.address(node.value, scope)[0], "int"
+        elif node.operation == "neg" and tal.type_name == "int":
+            return "(-{})".format(self.operand(node.value, scope, "int")), "int"
+        raise bc.NotCompilable()
+
+    def indexing_unit(self, node: ast.IndexingNode) -> int:
+        base = node
+        depth = 0
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+            depth += 1
+        l_tal = base.tal
+        if base.node_type != ast.NAME_NODE or l_tal is None:
+            raise bc.NotCompilable()
+        if en.is_array(l_tal):
+            unit_length = l_tal.total_len(self.memory)
+            for i in range(depth):
+                unit_length //= l_tal.array_lengths[i]
+            return unit_length
+        elif l_tal.type_name[0] == "*":
+            return self.memory.get_type_size(l_tal.type_name[1:])
+        raise bc.NotCompilable()
+
+    def indexing(self, node: ast.IndexingNode, scope: bc.Scope) -> str:
+        unit_length = self.indexing_unit(node)
+        base = node
+        while base.node_type == ast.INDEXING_NODE:
+            base = base.call_obj
+        if en.is_array(base.tal):
+            code = self.address(node.call_obj, scope)[0]
+        else:  # the indexed pointer
+            code = self.operand(node.call_obj, scope, "int")
+        ptr = "({} + {} * {})".format(code, self.operand(node.arg, scope, "int"), unit_length)
+        if self.checks:
+            ptr = "at({}, {})".format(ptr, unit_length)
+        return ptr
+
+    def call(self, node: ast.FuncCall, scope: bc.Scope):
+        name_node = node.call_obj
+        if name_node.node_type != ast.NAME_NODE or scope.lookup(name_node.name) is not None or \
+                self.global_env.contains_ptr(name_node.name):
+            raise bc.NotCompilable()
+        func_group = self.global_env.functions.get(name_node.name)
+        if not func_group:
+            raise bc.NotCompilable()
+        some_func = next(iter(func_group.values()))
+        if isinstance(some_func, itp.NativeFunction):
+            return self.native_call(name_node.name, some_func, node, scope)
+        if node.overload is None:
+            raise bc.NotCompilable()
+        func: itp.Function = func_group[node.overload]
+        kind, rtn_loc = self.returned(func.r_tal)
+        args = [] if rtn_loc == "0" else [rtn_loc]
+        for param, arg in zip(func.params, node.args.lines):
+            cls = bc.value_class(param.tal)
+            args.append(self.operand(arg, scope, cls))
+        return "{}({})".format(self.names[func], ", ".join(args)), kind
+
+    def native_call(self, name: str, func: itp.NativeFunction, node: ast.FuncCall, scope: bc.Scope):
+        kind, rtn_loc = self.returned(func.r_tal)
+        native = self.function_ref(name, next(iter(self.global_env.functions[name])))
+        if func.eval_before:
+            args = []
+            classes = []
+            for arg in node.args.lines:
+                code, arg_kind = self.expression(arg, scope)
+                if arg_kind == VOID:
+                    raise bc.NotCompilable()
+                args.append(code)
+                classes.append(None if arg_kind == ADDRESS or arg_kind == COMPUTED else arg_kind)
+            site = "n{}".format(len(self.sites))
+            self.sites.append("{} = native_function({}, {!r})".format(site, native, tuple(classes)))
+            return "{}({})".format(site, ", ".join([rtn_loc] + args)), kind
+        variables = []
+        for var_name in sorted(names_in(node.args)):
+            slot = scope.lookup(var_name)
+            if slot is None:
+                continue
+            place, tal = slot
+            if isinstance(place, str):
+                variables.append("({!r}, {}, {}, {!r})".format(var_name, self.constant(tal), place,
+                                                               bc.value_class(tal)))
+            else:
+                variables.append("({!r}, {}, {}, None)".format(var_name, self.constant(tal), frame_address(place)))
+        caller = self.function_ref(*self.keys[self.func])
+        site = "n{}".format(len(self.sites))
+        self.sites.append("{} = nodes_function({}, {}, {})".format(site, native, self.args_ref(node), caller))
+        return "{}({}, ({}))".format(site, rtn_loc, "".join(v + ", " for v in variables)), kind
+
+    def returned(self, r_tal: en.Type):
+        """ Returns the kind of the value returned as <r_tal>, and the source of the location of a returned struct. """
+        rtn_len = r_tal.total_len(self.memory)
+        if rtn_len == 0:
+            return VOID, "0"
+        cls = bc.value_class(r_tal)
+        if cls is None:
+            return ADDRESS, frame_address(self.reserve(rtn_len))
+        return cls, "0"
+
+
+def frame_address(offset: int) -> str:
+    return offset_address("base", offset)
+
+
+def offset_address(address: str, offset: int) -> str:
+    return address if offset == 0 else "({} + {})".format(address, offset)
+
+
+def is_simple(node: ast.Node) -> bool:
+    """ Returns whether evaluating <node> has no effect, so that it may be evaluated later than by the tree walker. """
+    return node.node_type == ast.LITERAL or node.node_type == ast.NAME_NODE
+
+
+def children(node: ast.Node):
+    """ Yields the nodes directly under <node>. """
+    for value in vars(node).values():
+        if isinstance(value, ast.Node):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, ast.Node):
+                    yield item
+
+
+def calls_in(node: ast.Node) -> list:
+    """ Returns the function calls under <node>, in an order which is the same for every parse of the program. """
+    calls = []
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if n.node_type == ast.FUNCTION_CALL:
+            calls.append(n)
+        stack.extend(children(n))
+    return calls
+
+
+def encode_constant(constant) -> list:
+    """ Returns the json serializable description of a constant of the generated source, see decode_constant. """
+    if isinstance(constant, FunctionRef):
+        return ["function", constant.name, constant.overload]
+    elif isinstance(constant, ArgsRef):
+        return ["args", constant.name, constant.overload, constant.index]
+    elif isinstance(constant, en.Type):
+        return ["type", constant.type_name, list(constant.array_lengths)]
+    return ["arithmetic", constant.__name__]
+
+
+def decode_constant(description: list):
+    kind = description[0]
+    if kind == "function":
+        return FunctionRef(description[1], description[2])
+    elif kind == "args":
+        return ArgsRef(description[1], description[2], int(description[3]))
+    elif kind == "type":
+        return en.Type(description[1], *(int(length) for length in description[2]))
+    elif kind == "arithmetic":
+        return ARITHMETIC_FUNCTIONS[description[1]]
+    raise ValueError("Unknown constant kind {!r}".format(kind))
+
+
+def cache_digest(key: str, source, constants) -> str:
+    """ Returns the digest of the content of a cache file, which is checked before the source is run. """
+    content = json.dumps([key, source, constants])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def names_in(node: ast.Node) -> set:
+    """ Returns the names of all name nodes under <node>. """
+    names = set()
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if n.node_type == ast.NAME_NODE:
+            names.add(n.name)
+        stack.extend(children(n))
+    return names
+
+
+def pinned_names(body: ast.Node, global_env: en.GlobalEnvironment) -> set:
+    """
+    Returns the names of the variables of a function which must be in memory, because their address is taken, or
+    because they are assigned by the args of a built-in function that evaluates its arg nodes itself.
+    """
+    pinned = set()
+    stack = [body]
+    while stack:
+        node = stack.pop()
+        node_type = node.node_type
+        if node_type == ast.UNARY_OPERATOR and node.operation == "pack" and node.value.node_type == ast.NAME_NODE:
+            pinned.add(node.value.name)
+        elif node_type == ast.FUNCTION_CALL and node.call_obj.node_type == ast.NAME_NODE:
+            func_group = global_env.functions.get(node.call_obj.name)
+            some_func = next(iter(func_group.values())) if func_group else None
+            if isinstance(some_func, itp.NativeFunction) and not some_func.eval_before:
+                pinned.update(assigned_names(node.args))
+        stack.extend(children(node))
+    return pinned
+
+
+def assigned_names(node: ast.Node) -> set:
+    """ Returns the names of the variables assigned under <node>. """
+    names = set()
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        target = None
+        if n.node_type == ast.ASSIGNMENT_NODE or n.node_type == ast.BINARY_OPERATOR and n.assignment:
+            target = n.left
+        elif n.node_type == ast.IN_DECREMENT_OPERATOR:
+            target = n.value
+        if target is not None and target.node_type == ast.NAME_NODE:
+            names.add(target.name)
+        stack.extend(children(n))
+    return names
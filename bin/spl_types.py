@@ -14,8 +14,8 @@ class Type:
         return hash(self.name)
 
 
-def int_to_bytes(i: int) -> bytes:
-    return mem.int_to_bytes(i)
+def int_to_bytes(i: int, int_size: int = 8) -> bytes:
+    return mem.int_to_bytes(i, int_size)
 
 
 def bytes_to_int(b: bytes) -> int:
@@ -123,6 +123,17 @@ def float_add_int(v1: bytes, v2: bytes) -> bytes:
     return float_to_bytes(f + i)
 
 
+# operations on values read by the typed accessors of the memory, the result has the type of the left operand
+
+
+def int_add_float_value(i: int, f: float) -> int:
+    return i + int(f)
+
+
+def int_sub_float_value(i: int, f: float) -> int:
+    return i - int(f)
+
+
 if __name__ == "__main__":
     f1 = float_to_bytes(7.5)
     b11 = bytes_to_float(f1)
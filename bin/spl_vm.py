@@ -0,0 +1,359 @@
+import bin.spl_bytecode as bc
+import bin.spl_environment as en
+import bin.spl_interpreter as itp
+import bin.spl_memory as mem
+from bin.spl_bytecode import CONST, LOAD_INT, LOAD, STORE_INT, STORE, ADDR, LOADI, STOREI, COPY, POP, ADD, SUB, \
+    MUL, BINOP, NEG, LT, LE, GT, GE, EQ, NE, CMP, INPLACE_LOCAL, INPLACE, OFFSET, INDEX, CHECK, JUMP, JUMP_IF_FALSE, \
+    CALL, CALL_NATIVE, CALL_NATIVE_NODES, RETURN, RETURN_COPY, RETURN_VOID, MISSING_RETURN, \
+    CLEAR
+
+
+class VirtualMachine:
+    """
+    Runs a program by compiling its functions to bytecode, and running the instructions in one dispatch loop.
+
+    A call of a compiled function pushes a frame and continues the loop in the callee, so neither the nesting of
+    expressions nor recursion recurses in Python, and no environment is created. Functions that are not compiled
+    are run by the tree walker, see spl_bytecode.Compiler.
+
+    The accessors of the memory are bound at compile time, so the memory must not be switched between checked,
+    unchecked and tracing while the machine runs.
+    """
+
+    name = "vm"
+
+    def __init__(self, interpreter: itp.Interpreter):
+        self.interpreter = interpreter
+        self.memory = interpreter.memory
+        self.global_env = interpreter.global_env
+        self.compiler = bc.Compiler(interpreter.global_env)
+        self.codes = {}  # Function: Code, or None if the function is run by the tree walker
+        self.stack = []  # the operand stack
+        self.frames = []  # (Code, frame address) of the active calls
+
+    def run_main(self) -> int:
+        """ Calls the function 'main' of an initialized program and returns its exit value. """
+        if "main" not in self.global_env.functions:
+            return 0
+        main_func = self.global_env.get_function("main", itp.LINE_FILE)[""]
+        code = self.code_of(main_func)
+        if code is None or bc.value_class(main_func.r_tal) != "int":
+            return self.interpreter.run_main()
+        collector = self.memory.collector
+        if collector is not None:
+            collector.machines.append(self)
+        try:
+            return self.execute(code)
+        finally:
+            if collector is not None:
+                collector.machines.remove(self)
+            self.stack.clear()
+            self.frames.clear()
+
+    def code_of(self, func: itp.Function):
+        if func in self.codes:
+            return self.codes[func]
+        code = self.compiler.compile_function(func)
+        self.codes[func] = code
+        return code
+
+    def typed_roots(self):
+        """ Yields the (address, Type) of the variables of all frames, which are roots of the collector. """
+        for code, base in self.frames:
+            for offset, tal in code.variables:
+                yield base + offset, tal
+
+    def execute(self, code: bc.Code):
+        """ Runs <code> of a function without parameters, and returns its returned value. """
+        memory = self.memory
+        stack = self.stack
+        frames = self.frames
+        returns = []  # (instructions, pc, frame address, returned location) of the callers
+        push = stack.append
+        pop = stack.pop
+        get_int = memory.get_int
+        set_int = memory.set_int
+        mem_copy = memory.mem_copy
+        check_access = memory.check_access
+        allocate_empty = memory.allocate_empty
+        push_stack = memory.push_stack
+        restore_stack = memory.restore_stack
+        code_of = self.code_of
+        clear_frames = self.compiler.collecting
+
+        push_stack()
+        base = allocate_empty(code.frame_size)
+        if clear_frames and code.frame_size:
+            memory.mem_set(base, 0, code.frame_size)
+        frames.append((code, base))
+        instructions = code.instructions
+        pc = 0
+        rtn_loc = 0
+
+        while True:
+            op, arg = instructions[pc]
+            pc += 1
+            if op == LOAD_INT:
+                push(get_int(base + arg))
+            elif op == CONST:
+                push(arg)
+            elif op == JUMP_IF_FALSE:
+                if not pop():
+                    pc = arg
+            elif op == LT:
+                r = pop()
+                stack[-1] = stack[-1] < r
+            elif op == STORE_INT:
+                set_int(base + arg, pop())
+            elif op == INPLACE_LOCAL:
+                offset, getter, setter, func = arg
+                setter(base + offset, func(getter(base + offset), pop()))
+            elif op == JUMP:
+                pc = arg
+            elif op == ADD:
+                r = pop()
+                stack[-1] += r
+            elif op == SUB:
+                r = pop()
+                stack[-1] -= r
+            elif op == CALL:
+                func, count, flags, slot = arg
+                if count:
+                    args = stack[-count:]
+                    del stack[-count:]
+                else:
+                    args = ()
+                callee = code_of(func)
+                caller_rtn_loc = 0 if slot is None else base + slot
+                if callee is None:
+                    result = call_tree(memory, func, args, flags, caller_rtn_loc)
+                    if result is not None:
+                        push(result)
+                    continue
+                push_stack()
+                callee_base = allocate_empty(callee.frame_size)
+                if clear_frames and callee.frame_size:  # see Compiler.collecting
+                    memory.mem_set(callee_base, 0, callee.frame_size)
+                for (offset, length, setter), a, is_address in zip(callee.params, args, flags):
+                    if is_address:
+                        mem_copy(a, callee_base + offset, length)
+                    else:
+                        setter(callee_base + offset, a)
+                returns.append((instructions, pc, base, rtn_loc))
+                frames.append((callee, callee_base))
+                instructions = callee.instructions
+                pc = 0
+                base = callee_base
+                rtn_loc = caller_rtn_loc
+            elif op == RETURN or op == RETURN_COPY or op == RETURN_VOID:
+                if op == RETURN:
+                    result = pop()
+                elif op == RETURN_COPY:
+                    mem_copy(pop(), rtn_loc, arg)
+                    result = rtn_loc
+                else:
+                    result = None
+                restore_stack()
+                frames.pop()
+                if not returns:
+                    return result
+                instructions, pc, base, rtn_loc = returns.pop()
+                if result is not None:
+                    push(result)
+            elif op == LOAD:
+                push(arg[1](base + arg[0]))
+            elif op == STORE:
+                arg[1](base + arg[0], pop())
+            elif op == ADDR:
+                push(base + arg)
+            elif op == LOADI:
+                stack[-1] = arg(stack[-1])
+            elif op == STOREI:
+                address = pop()
+                arg(address, pop())
+            elif op == COPY:
+                dest = pop()
+                mem_copy(pop(), dest, arg)
+            elif op == POP:
+                pop()
+            elif op == OFFSET:
+                stack[-1] += arg
+            elif op == INDEX:
+                i = pop()
+                stack[-1] += i * arg
+            elif op == CHECK:
+                check_access(stack[-1], arg)
+            elif op == MUL:
+                r = pop()
+                stack[-1] *= r
+            elif op == BINOP:
+                r = pop()
+                stack[-1] = arg(stack[-1], r)
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+            elif op == LE:
+                r = pop()
+                stack[-1] = stack[-1] <= r
+            elif op == GT:
+                r = pop()
+                stack[-1] = stack[-1] > r
+            elif op == GE:
+                r = pop()
+                stack[-1] = stack[-1] >= r
+            elif op == EQ:
+                r = pop()
+                stack[-1] = stack[-1] == r
+            elif op == NE:
+                r = pop()
+                stack[-1] = stack[-1] != r
+            elif op == CMP:
+                r = pop()
+                stack[-1] = arg(stack[-1] - r)
+            elif op == INPLACE:
+                getter, setter, func = arg
+                r = pop()
+                address = pop()
+                setter(address, func(getter(address), r))
+            elif op == CALL_NATIVE:
+                func, allocators, rtn = arg
+                count = len(allocators)
+                if count:
+                    args = stack[-count:]
+                    del stack[-count:]
+                else:
+                    args = ()
+                push_stack()
+                ptrs = [a if allocator is None else allocator(a) for a, allocator in zip(args, allocators)]
+                self.native_returned(func(memory, *ptrs), rtn, base)
+            elif op == CALL_NATIVE_NODES:
+                func, nodes, visible, rtn = arg
+                env = en.FunctionEnvironment(frames[-1][0].func.outer_scope)
+                for name, tal, offset in visible:
+                    env.define_var(name, tal, base + offset)
+                push_stack()
+                memory.call_envs.append(env)
+                try:
+                    rtn_ptr = func(env, *nodes)
+                finally:
+                    memory.call_envs.pop()
+                self.native_returned(rtn_ptr, rtn, base)
+            elif op == CLEAR:
+                memory.mem_set(base + arg[0], 0, arg[1])
+            elif op == MISSING_RETURN:
+                raise bc.missing_return(frames[-1][0].func)
+
+    def native_returned(self, rtn_ptr, rtn: tuple, base: int):
+        """ Pushes the value returned by a built-in function at <rtn_ptr>, and ends the call. """
+        getter, length, slot = rtn
+        if getter is not None:
+            self.stack.append(getter(rtn_ptr))
+        elif slot is not None:
+            self.memory.mem_copy(rtn_ptr, base + slot, length)
+            self.stack.append(base + slot)
+        self.memory.restore_stack()
+
+
+def call_tree(memory, func: itp.Function, args, flags, rtn_loc: int):
+    """
+    Calls <func> in the tree walker with the computed <args>, like call_function, and returns its value.
+
+    :param flags: whether each arg is the address of the value instead of the value
+    :param rtn_loc: where a struct or an array returned by <func> is copied
+    """
+    scope = en.FunctionEnvironment(func.outer_scope)
+    memory.push_stack()
+    for param, a, is_address in zip(func.params, args, flags):
+        tal = param.tal
+        total_len = tal.total_len(memory)
+        arg_ptr = memory.allocate_empty(total_len)
+        scope.define_var(param.name, tal, arg_ptr)
+        if is_address:
+            memory.mem_copy(a, arg_ptr, total_len)
+        else:
+            getattr(memory, bc.SETTERS[bc.value_class(tal)])(arg_ptr, a)
+
+    r = itp.evaluate(func.body, scope)
+
+    rtn_len = func.r_tal.total_len(memory)
+    if rtn_len > 0 and r is None:
+        raise bc.missing_return(func)
+    result = None
+    if rtn_len > 0:
+        cls = bc.value_class(func.r_tal)
+        if cls is None:
+            memory.mem_copy(r, rtn_loc, rtn_len)
+            result = rtn_loc
+        else:
+            result = getattr(memory, bc.GETTERS[cls])(r)
+    memory.restore_stack()
+    return result
+
+
+def native_function(memory: mem.Memory, native: itp.NativeFunction, classes: tuple):
+    """
+    Returns a Python function which calls the built-in function <native> with the values of its args, called with
+    the location of the returned struct and the args.
+
+    :param classes: the value class of each arg, or None if the arg is an address
+    """
+    func = native.func
+    allocators = bc.value_allocators(memory)
+    allocators = tuple(None if cls is None else allocators[cls] for cls in classes)
+    returned = native_returned(memory, native)
+
+    def call(rtn_loc, *args):
+        memory.push_stack()
+        ptrs = [a if allocator is None else allocator(a) for a, allocator in zip(args, allocators)]
+        return returned(func(memory, *ptrs), rtn_loc)
+
+    return call
+
+
+def nodes_function(memory: mem.Memory, native: itp.NativeFunction, nodes: tuple, caller: itp.Function):
+    """
+    Returns a Python function which calls the built-in function <native> with the arg <nodes>, called with the
+    location of the returned struct and the (name, Type, value, class) of the variables of <caller> named in the
+    nodes. A variable whose class is None is passed by its address.
+    """
+    func = native.func
+    setters = {cls: getattr(memory, name) for cls, name in bc.SETTERS.items()}
+    returned = native_returned(memory, native)
+
+    def call(rtn_loc, variables):
+        memory.push_stack()
+        env = en.FunctionEnvironment(caller.outer_scope)
+        for name, tal, value, cls in variables:
+            if cls is None:
+                env.define_var(name, tal, value)
+            else:
+                ptr = memory.allocate_empty(tal.total_len(memory))
+                setters[cls](ptr, value)
+                env.define_var(name, tal, ptr)
+        memory.call_envs.append(env)
+        try:
+            rtn_ptr = func(env, *nodes)
+        finally:
+            memory.call_envs.pop()
+        return returned(rtn_ptr, rtn_loc)
+
+    return call
+
+
+def native_returned(memory: mem.Memory, native: itp.NativeFunction):
+    """ Returns a function which reads the value returned by <native>, and ends the call. """
+    length = native.r_tal.total_len(memory)
+    cls = bc.value_class(native.r_tal) if length > 0 else None
+    getter = None if cls is None else getattr(memory, bc.GETTERS[cls])
+
+    def returned(rtn_ptr, rtn_loc):
+        if getter is not None:
+            result = getter(rtn_ptr)
+        elif length > 0:
+            memory.mem_copy(rtn_ptr, rtn_loc, length)
+            result = rtn_loc
+        else:
+            result = None
+        memory.restore_stack()
+        return result
+
+    return returned
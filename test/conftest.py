@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the interpreter modules as the package 'bin', like tpl.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,8 @@
+import pytest
+
+from tplrun import PROGRAMS, output, program_path
+
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_buddy_like_segregated(name):
+    assert output(program_path(name), "-Dalloc", "buddy") == output(program_path(name))
@@ -0,0 +1,35 @@
+import pytest
+
+from tplrun import error, output
+
+ARENA_PROGRAM = """
+fn main() int {{
+    var region: int = arena_new(64);
+    var a: *int = arena_alloc(region, 8);
+    var b: *int = arena_alloc(region, 200);
+    {}
+    var p: *int = malloc(16);
+    *a = 1;
+    printf("%d", *a);
+    arena_free(region);
+    free(p);
+    return 0;
+}}
+"""
+
+
+def write_program(tmp_path, line: str) -> str:
+    path = tmp_path / "arena.tp"
+    path.write_text(ARENA_PROGRAM.format(line))
+    return str(path)
+
+
+def test_arena(tmp_path):
+    stdout, stderr = output(write_program(tmp_path, ""))
+    assert stdout.splitlines()[0] == "1"
+
+
+@pytest.mark.parametrize("line", ["free(region);", "free(a);", "free(b);", "free(b + 8);",
+                                  "realloc(b, 400);"])
+def test_free_in_arena(tmp_path, line):
+    assert "is in a region" in error(write_program(tmp_path, line))
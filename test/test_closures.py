@@ -0,0 +1,9 @@
+import pytest
+
+from tplrun import OPTIONS, PROGRAMS, assert_engine_matches
+
+
+@pytest.mark.parametrize("options", OPTIONS, ids=lambda options: " ".join(options) or "default")
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_like_tree_walker(name, options):
+    assert_engine_matches("closure", name, options)
@@ -0,0 +1,10 @@
+import pytest
+
+from tplrun import PROGRAMS, output, program_path
+
+
+@pytest.mark.parametrize("engine", ["tree", "closure", "vm", "py", "ir"])
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_folded_like_unfolded(name, engine):
+    options = ["-nc", "-Dengine", engine]
+    assert output(program_path(name), *options) == output(program_path(name), "-nf", *options)
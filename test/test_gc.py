@@ -0,0 +1,8 @@
+import pytest
+
+from tplrun import PROGRAMS, output, program_path
+
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_gc_like_no_gc(name):
+    assert output(program_path(name), "-gc") == output(program_path(name))
@@ -0,0 +1,8 @@
+import pytest
+
+from tplrun import SIZE_FREE_PROGRAMS, output, program_path
+
+
+@pytest.mark.parametrize("name", SIZE_FREE_PROGRAMS)
+def test_int32_like_int64(name):
+    assert output(program_path(name), "-Dint", "32") == output(program_path(name))
@@ -0,0 +1,33 @@
+import pytest
+
+from tplrun import error, output
+
+MEMMOVE_PROGRAM = """
+fn main() int {{
+    var p: *char = malloc(16);
+    strcpy(p, "abcdefgh");
+    memmove(p + 2, p, {});
+    printf("%s", p);
+    free(p);
+    return 0;
+}}
+"""
+
+
+def write_program(tmp_path, length: int) -> str:
+    path = tmp_path / "memmove.tp"
+    path.write_text(MEMMOVE_PROGRAM.format(length))
+    return str(path)
+
+
+@pytest.mark.parametrize("options", [[], ["-u"]], ids=["checked", "unchecked"])
+def test_memmove_overlapping(tmp_path, options):
+    stdout, stderr = output(write_program(tmp_path, 6), *options)
+    assert stdout.splitlines()[0] == "ababcdef"
+
+
+@pytest.mark.parametrize("engine", ["tree", "closure", "vm", "py", "ir"])
+@pytest.mark.parametrize("options", [[], ["-u"]], ids=["checked", "unchecked"])
+def test_memmove_past_memory_end(tmp_path, options, engine):
+    stderr = error(write_program(tmp_path, 1 << 20), *options, "-nc", "-Dengine", engine)
+    assert "Unreachable memory location" in stderr
@@ -0,0 +1,8 @@
+import pytest
+
+from tplrun import PROGRAMS, output, program_path
+
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_pools_like_no_pools(name):
+    assert output(program_path(name)) == output(program_path(name), "-np")
@@ -0,0 +1,51 @@
+import os
+import pickle
+
+import pytest
+
+from tplrun import PROGRAMS, error, output, program_path, run
+
+
+def write_snapshot(tmp_path, name: str, *options: str) -> str:
+    path = str(tmp_path / (name[:-3] + ".tpi"))
+    output(program_path(name), *options, "-Dsnapshot", path)
+    return path
+
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_snapshot_like_program(tmp_path, name):
+    assert output(write_snapshot(tmp_path, name)) == output(program_path(name))
+
+
+def test_snapshot_keeps_memory_flags(tmp_path):
+    path = write_snapshot(tmp_path, "heap.tp", "-Dalloc", "buddy", "-np")
+    assert output(path) == output(program_path("heap.tp"), "-Dalloc", "buddy", "-np")
+
+
+@pytest.mark.parametrize("options", [["-Dalloc", "buddy"], ["-Dint", "32"], ["-Dmem", "64K"], ["-Dmaxmem", "1M"],
+                                     ["-np"], ["-Dbacking", "mmap"]])
+def test_snapshot_refuses_memory_flags(tmp_path, options):
+    path = write_snapshot(tmp_path, "heap.tp")
+    assert "cannot be used when running a snapshot" in error(path, *options)
+
+
+class RunsCommand:
+    def __reduce__(self):
+        return os.system, ("echo unpickled",)
+
+
+def test_snapshot_refuses_other_pickles(tmp_path):
+    path = tmp_path / "other.tpi"
+    path.write_bytes(pickle.dumps(RunsCommand()))
+    assert "is not a snapshot" in error(str(path))
+
+
+def test_snapshot_refuses_other_globals(tmp_path):
+    path = tmp_path / "other.tpi"
+    with open(write_snapshot(tmp_path, "heap.tp"), "rb") as snapshot:
+        header = snapshot.readline()
+    path.write_bytes(header + pickle.dumps(RunsCommand()))
+    result = run(str(path))
+    assert result.returncode != 0
+    assert "A snapshot cannot load" in result.stderr
+    assert "unpickled" not in result.stdout
@@ -0,0 +1,23 @@
+import os
+import shutil
+
+import pytest
+
+from bin.spl_transpiler import CACHE_EXTENSION
+from tplrun import OPTIONS, PROGRAMS, assert_engine_matches, output, program_path
+
+
+@pytest.mark.parametrize("options", OPTIONS, ids=lambda options: " ".join(options) or "default")
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_like_tree_walker(name, options):
+    assert_engine_matches("py", name, options)
+
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_cache(name, tmp_path):
+    path = str(tmp_path / name)
+    shutil.copy(program_path(name), path)
+    expected = output(path)
+    assert output(path, "-Dengine", "py") == expected
+    assert os.path.isfile(path[:-3] + CACHE_EXTENSION)
+    assert output(path, "-Dengine", "py") == expected
@@ -0,0 +1,53 @@
+"""
+Helpers of the tests, which run programs by tpl.py in a subprocess like a user does.
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TPL = os.path.join(ROOT, "tpl.py")
+PROGRAMS_DIR = os.path.join(ROOT, "test", "programs")
+PROGRAMS = sorted(name for name in os.listdir(PROGRAMS_DIR) if name.endswith(".tp"))
+
+# programs whose output does not depend on the length of ints, since they do not print sizes
+SIZE_FREE_PROGRAMS = ["control.tp", "heap.tp"]
+
+# option sets under which every engine is compared with the tree walker
+OPTIONS = [[], ["-Dalloc", "buddy"], ["-np"], ["-gc"], ["-Dint", "32"]]
+
+# the warning tpl.py prints when an engine other than the tree walker runs with '-na'
+NO_ANALYSIS_WARNING = re.compile(r"Warning: the '\w+' engine compiles only the nodes of analyzed types, so with "
+                                 r"'-na' it runs mostly as the tree walker\n")
+
+
+def program_path(name: str) -> str:
+    return os.path.join(PROGRAMS_DIR, name)
+
+
+def run(program: str, *options: str) -> subprocess.CompletedProcess:
+    """ Runs <program> with <options>, and returns the finished process with its output as text. """
+    args = [sys.executable, TPL, *options, "-e", program]
+    return subprocess.run(args, cwd=ROOT, capture_output=True, text=True, timeout=300)
+
+
+def output(program: str, *options: str) -> (str, str):
+    """ Returns the stdout and stderr of running <program> with <options>, which must succeed. """
+    result = run(program, *options)
+    assert result.returncode == 0, result.stderr
+    return result.stdout, NO_ANALYSIS_WARNING.sub("", result.stderr)
+
+
+def error(program: str, *options: str) -> str:
+    """ Returns the stderr of running <program> with <options>, which must fail. """
+    result = run(program, *options)
+    assert result.returncode != 0, result.stdout
+    return result.stderr
+
+
+def assert_engine_matches(engine: str, name: str, options: list):
+    """ Checks that <engine> runs the program <name> like the tree walker under <options>. """
+    expected = output(program_path(name), *options)
+    assert output(program_path(name), *options, "-nc", "-Dengine", engine) == expected
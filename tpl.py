@@ -1,16 +1,27 @@
 """ The main SPL runner. """
 
 import sys
+import json
+import hashlib
 import script
 import time
 import os
-from bin import spl_lexer, spl_parser as psr, spl_interpreter
+from bin import spl_lexer, spl_parser as psr, spl_interpreter, spl_analyzer, spl_closures, \
+    spl_memory as mem, spl_vm, spl_transpiler, spl_registers, spl_folder
 import bin.tpl_pre_processor as tpp
 
-sys.setrecursionlimit(10000)
+sys.setrecursionlimit(1000000)
 
 EXE_NAME = "tpl.py"
 
+# memory flags, which are saved in a snapshot, so they cannot be given when running one
+SNAPSHOT_MEMORY_FLAGS = {"allocator": "-Dalloc", "int_size": "-Dint", "vm_size": "-Dmem", "max_vm_size": "-Dmaxmem",
+                         "stack_size": "-Dstack", "max_stack_size": "-Dmaxstack", "backing": "-Dbacking",
+                         "memory_file": "-Dmemfile"}
+
+ENGINES = {"closure": spl_closures.ClosureEngine, "vm": spl_vm.VirtualMachine, "py": spl_transpiler.Transpiler,
+           "ir": spl_registers.RegisterMachine}
+
 INSTRUCTION = """Welcome to Slowest Programming Language.
 
 Try "{} help" to see usage.""".format(EXE_NAME)
@@ -20,33 +31,66 @@ HELP = """Name
 
 Usage
     {} [OPTIONS]... [FLAGS]... FILE [ARGV]...
+    {} [OPTIONS]... SNAPSHOT.tpi [ARGV]...
     
 Description
 OPTIONS:    
     -a,   --ast,     abstract syntax tree    shows the structure of the abstract syntax tree     
     -d,   --debug,   debugger                enables debugger
     -et,             execution               shows the execution times of each node
+    -gc,  --gc,      garbage collector       reclaims unreachable heap blocks when the heap is full or 'gc' is called
     -e,   --exit,    exit value              shows the program's exit value
+    -ir,  --ir,      intermediate code       shows the optimized SSA form of the functions, see '-Dengine ir'
     -l,   --link,    link                    write the linked script to file
+    -na,  --noanalysis, no analysis          resolves the types of expressions while running, instead of before,
+                                             the engines other than "tree" then run mostly as the tree walker
+    -nc,  --nocache, no cache                the "py" engine does not keep the generated source in FILE.tpy
+    -nf,  --nofold,  no folding              evaluates the constant expressions while running, instead of before
+    -np,  --nopool,  no pools                'malloc' of a struct size does not use slab pools
     -t,   --timer,   timer                   enables the timer
     -tk,  --tokens,   tokens                 shows language tokens
+    -u,   --unchecked, unchecked             only checks the pointers computed by the program, for faster execution
     -v,   --vars,    variables               prints out all global variables after execution
     
 FLAGS:
+    -Dalloc NAME       heap allocator        changes the heap allocator, "segregated" (default) or "buddy"
     -Dfile ENCODING    --file encoding       changes the tp file decoding
+    -Dint BITS         int size              length of ints and pointers, 64 (default) or 32
+    -Dmem SIZE         memory size           initial size of the virtual memory, for example 32K (default)
+    -Dmaxmem SIZE      max memory size       size the virtual memory may grow to, for example 256M (default)
+    -Dsnapshot FILE    snapshot              writes the initialized program to FILE instead of running it, FILE
+                                             should end with '.tpi', and can be run later without parsing, with
+                                             the memory flags it was written with, only run snapshots you trust
+    -Dstack SIZE       stack size            size of the first call stack segment, for example 1K (default)
+    -Dmaxstack SIZE    max stack size        total size the call stack may grow to, for example 1M (default)
+    -Dbacking NAME     memory backing        "bytearray" (default), or "mmap" for a memory mapped address space
+    -Dmemfile FILE     memory file           maps the memory to FILE, the heap in FILE is kept between runs
+    -Dmemstats FILE    memory statistics     writes the heap and stack counters to FILE as json at exit
+    -Dengine NAME      execution engine      "tree" (default) walks the syntax tree, "closure" compiles the functions
+                                             to closures before running them, "vm" compiles them to bytecode run
+                                             by a virtual machine, "py" generates Python source of them, which is
+                                             kept in FILE.tpy next to FILE, "ir" lowers them to SSA form, which is
+                                             optimized and run by a register machine
+    -Dtrace FILE       memory trace          counts the reads and writes of every address range, region and heap
+                                             block, and writes the hottest ones to FILE at exit
     
 ARGV:
     command-line argument for the spl program
     
 Example
     {} -ast -tokens example.tp -something
-""".format(EXE_NAME, EXE_NAME, EXE_NAME)
+""".format(EXE_NAME, EXE_NAME, EXE_NAME, EXE_NAME)
 
 
 def parse_arg(args):
     d = {"file": None, "dir": None, "debugger": False, "timer": False, "ast": False, "tokens": False,
          "vars": False, "argv": [], "encoding": None, "exit": False, "exec_time": False, "link": False,
-         "import": True, "out": sys.stdout, "in": sys.stdin, "err": sys.stderr}
+         "import": True, "allocator": None, "int_size": None, "vm_size": None,
+         "max_vm_size": None, "stack_size": None, "max_stack_size": None,
+         "backing": None, "memory_file": None, "snapshot": None, "mem_stats": None, "trace": None,
+         "engine": "tree", "pools": True, "checked": True, "gc": False, "analysis": True, "cache": True, "ir": False,
+         "fold": True,
+         "out": sys.stdout, "in": sys.stdin, "err": sys.stderr}
     i = 1
     while i < len(args):
         arg: str = args[i]
@@ -71,9 +115,59 @@ def parse_arg(args):
                     d["link"] = True
                 elif flag == "ni" or flag == "-noimport":
                     d["import"] = False
+                elif flag == "gc" or flag == "-gc":
+                    d["gc"] = True
+                elif flag == "u" or flag == "-unchecked":
+                    d["checked"] = False
+                elif flag == "np" or flag == "-nopool":
+                    d["pools"] = False
+                elif flag == "na" or flag == "-noanalysis":
+                    d["analysis"] = False
+                elif flag == "nc" or flag == "-nocache":
+                    d["cache"] = False
+                elif flag == "nf" or flag == "-nofold":
+                    d["fold"] = False
+                elif flag == "ir" or flag == "-ir":
+                    d["ir"] = True
                 elif flag == "Dfile":
                     i += 1
                     d["encoding"] = args[i]
+                elif flag == "Dint":
+                    i += 1
+                    d["int_size"] = int(args[i]) // 8
+                elif flag == "Dalloc":
+                    i += 1
+                    d["allocator"] = args[i]
+                elif flag == "Dmem":
+                    i += 1
+                    d["vm_size"] = parse_size(args[i])
+                elif flag == "Dmaxmem":
+                    i += 1
+                    d["max_vm_size"] = parse_size(args[i])
+                elif flag == "Dsnapshot":
+                    i += 1
+                    d["snapshot"] = args[i]
+                elif flag == "Dstack":
+                    i += 1
+                    d["stack_size"] = parse_size(args[i])
+                elif flag == "Dmaxstack":
+                    i += 1
+                    d["max_stack_size"] = parse_size(args[i])
+                elif flag == "Dbacking":
+                    i += 1
+                    d["backing"] = args[i]
+                elif flag == "Dmemfile":
+                    i += 1
+                    d["memory_file"] = args[i]
+                elif flag == "Dmemstats":
+                    i += 1
+                    d["mem_stats"] = args[i]
+                elif flag == "Dengine":
+                    i += 1
+                    d["engine"] = args[i]
+                elif flag == "Dtrace":
+                    i += 1
+                    d["trace"] = args[i]
                 elif flag == "et":
                     d["exec_time"] = True
                 else:
@@ -93,6 +187,15 @@ def parse_arg(args):
         return d
 
 
+def parse_size(s: str) -> int:
+    """ Parses a size like '4096', '64K' or '16M' to number of bytes. """
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    unit = s[-1].upper()
+    if unit in units:
+        return int(s[:-1]) * units[unit]
+    return int(s)
+
+
 def print_usage():
     print(INSTRUCTION)
 
@@ -102,6 +205,13 @@ def print_help():
 
 
 def interpret(mode: str):
+    memory = mem.Memory()
+    memory.configure(argv["vm_size"], argv["stack_size"], argv["max_vm_size"], argv["backing"],
+                     argv["memory_file"], argv["pools"], argv["int_size"],
+                     argv["max_stack_size"], argv["checked"])
+    if argv["allocator"] is not None:
+        memory.set_allocator(argv["allocator"])
+
     lex_start = time.time()
 
     if mode == "tp":
@@ -119,8 +229,10 @@ def interpret(mode: str):
 
     parse_start = time.time()
 
-    parser = psr.Parser(lexer.get_tokens())
+    parser = psr.Parser(lexer.get_tokens(), memory.get_type_size("int"))
     block = parser.parse()
+    if argv["fold"]:
+        spl_folder.Folder(parser, memory).fold(block)
 
     # pre = tpp.PreProcessor()
     # pre.process(block)
@@ -136,9 +248,29 @@ def interpret(mode: str):
 
     # ioe = (argv["in"], argv["out"], argv["err"])
 
-    itr = spl_interpreter.Interpreter()
+    itr = spl_interpreter.Interpreter(memory)
     itr.set_ast(block, parser.literal_bytes)
-    result = itr.interpret()
+    if argv["gc"]:
+        itr.enable_gc()
+    try:
+        if argv["trace"] is not None and argv["snapshot"] is None:
+            memory.enable_trace()
+        itr.initialize()
+        if argv["analysis"]:
+            spl_analyzer.Analyzer(itr.global_env).analyze()
+        if argv["snapshot"] is not None:
+            itr.save_snapshot(argv["snapshot"])
+            return
+        if argv["ir"]:
+            print("===== Intermediate Representation =====")
+            print(spl_registers.RegisterMachine(itr).ir_text())
+            print("===== End of IR =====")
+        program = b"".join(token.to_binary() for token in lexer.get_tokens())
+        result = run_main(itr, hashlib.sha256(program + bytes((argv["analysis"], argv["fold"]))).hexdigest())
+    finally:
+        write_mem_stats(itr.memory)
+        write_trace(itr.memory)
+        itr.memory.close()
 
     end = time.time()
 
@@ -159,6 +291,76 @@ def interpret(mode: str):
         print(block)
 
 
+def run_snapshot():
+    flags = [flag for key, flag in SNAPSHOT_MEMORY_FLAGS.items() if argv[key] is not None]
+    if not argv["pools"]:
+        flags.append("-np")
+    if flags:
+        raise ArgumentsException("{} cannot be used when running a snapshot, whose memory is saved in it, give "
+                                 "them when writing the snapshot".format(", ".join(flags)))
+
+    load_start = time.time()
+
+    itr = spl_interpreter.Interpreter(mem.Memory())
+    itr.load_snapshot(file_name)
+    itr.memory.set_checked(argv["checked"])
+    if argv["gc"]:
+        itr.enable_gc()
+    if argv["trace"] is not None:
+        itr.memory.enable_trace()
+
+    interpret_start = time.time()
+
+    try:
+        with open(file_name, "rb") as snapshot_file:
+            result = run_main(itr, hashlib.sha256(snapshot_file.read()).hexdigest())
+    finally:
+        write_mem_stats(itr.memory)
+        write_trace(itr.memory)
+        itr.memory.close()
+
+    end = time.time()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    if argv["exit"]:
+        print("Process finished with exit value " + str(result))
+
+    if argv["timer"]:
+        print("Time used: load snapshot: {}s, execute: {}s.".format
+              (interpret_start - load_start, end - interpret_start))
+
+
+def run_main(itr: spl_interpreter.Interpreter, program_key: str) -> int:
+    """
+    Runs the function 'main' of the initialized program by the engine selected by '-Dengine'.
+
+    :param program_key: a hash of the program, under which the "py" engine caches its generated source
+    """
+    if argv["engine"] == "tree":
+        return itr.run_main()
+    if not argv["analysis"]:
+        print("Warning: the '{}' engine compiles only the nodes of analyzed types, so with '-na' it runs mostly as "
+              "the tree walker".format(argv["engine"]), file=sys.stderr)
+    engine = ENGINES[argv["engine"]](itr)
+    if isinstance(engine, spl_transpiler.Transpiler) and argv["cache"]:
+        engine.use_cache(os.path.splitext(file_name)[0] + spl_transpiler.CACHE_EXTENSION, program_key)
+    return engine.run_main()
+
+
+def write_mem_stats(memory: mem.Memory):
+    if argv["mem_stats"] is not None:
+        with open(argv["mem_stats"], "w") as stats_file:
+            json.dump(memory.stats(), stats_file, indent=2)
+
+
+def write_trace(memory: mem.Memory):
+    if memory.trace is not None:
+        with open(argv["trace"], "w") as trace_file:
+            trace_file.write(memory.trace.report())
+
+
 class ArgumentsException(Exception):
     def __init__(self, msg=""):
         Exception.__init__(self, msg)
@@ -196,5 +398,8 @@ if __name__ == "__main__":
                 raise e
             finally:
                 f.close()
+        elif file_name[-4:] == ".tpi":
+            run_snapshot()
         else:
-            raise ArgumentsException("Input file can either be SPL script '.tp' or linked SPL script '.lsp'.")
+            raise ArgumentsException("Input file can either be SPL script '.tp', linked SPL script '.lsp' or "
+                                     "snapshot '.tpi'.")